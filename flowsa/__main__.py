@@ -0,0 +1,25 @@
+"""
+Command line interface of flowsa
+
+    python -m flowsa build --help
+    flowsa build --help
+"""
+
+import argparse
+import sys
+
+
+def main(argv: list = None) -> int:
+    ap = argparse.ArgumentParser(prog='flowsa')
+    ap.add_argument('command', choices=['build'])
+    ap.add_argument('args', nargs=argparse.REMAINDER,
+                    help='Arguments of the command')
+    args = ap.parse_args(argv)
+    if args.command == 'build':
+        from flowsa import build
+        report = build.main(**build.parse_args(args.args))
+        return 1 if report['counts']['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,504 @@
+# build.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Batch builds of FlowByActivity and FlowBySector datasets. Targets are FBA
+sources with years and FBS methods, given by name or glob pattern, or every
+FBS method without an active entry in method_status.yaml. The FBAs and FBSs
+used by each FBS method are found with planner.plan() and built before it,
+across a pool of workers.
+
+A dataset is skipped if its output is current: the local parquet exists
+and is newer than its method yaml, the modules of the functions the yaml
+calls, and the outputs of the datasets it uses. Each build writes a json
+report of the status, duration, peak memory and any error of each dataset.
+Peak memory is that of the worker process while building the dataset on
+linux, and the process peak elsewhere. If a worker process is killed (e.g.
+when out of memory), the datasets building at the time fail and the pool
+is replaced.
+
+    python -m flowsa build --fba "USDA_CoA_*:2017" --fbs Water_national_2015_m1
+    python -m flowsa build --all --max-workers 4
+    python -m flowsa.build --all --executor serial --force
+
+FBA targets are <source>[:<years>], where years is a year, a range
+(2015-2017) or a list (2015,2017), default all years in the source yaml.
+Datasets with an active entry in method_status.yaml are only built when
+requested by name.
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from functools import partial
+from pathlib import Path
+import pandas as pd
+from flowsa import generateflowbyactivity, parallel, planner, settings
+from flowsa.cache import _atomic_write, _function_files, find_input_file
+from flowsa.common import check_method_status, get_flowsa_base_name, \
+    load_yaml_dict, seeAvailableFlowByModels
+from flowsa.flowbysector import FlowBySector
+from flowsa.flowsa_log import log, thread_log_file
+from flowsa.generateflowbyactivity import set_fba_name
+
+reportpath = settings.outputpath / 'BuildReports'
+STATUSES = ['built', 'current', 'failed', 'skipped', 'excluded']
+
+
+def parse_years(years: str) -> list:
+    """List of years from '2017', '2015-2017' or '2015,2017'"""
+    if '-' in years:
+        first, last = years.split('-')
+        return [str(y) for y in range(int(first), int(last) + 1)]
+    return [y.strip() for y in years.split(',')]
+
+
+def _match(patterns: list, names: list, flowbytype: str) -> list:
+    """Names matching any of patterns, in the order of the patterns"""
+    matched = []
+    for pattern in patterns:
+        found = fnmatch.filter(names, pattern)
+        if not found:
+            log.error('No %s method matches %s', flowbytype, pattern)
+            raise ValueError(f'No {flowbytype} method matches {pattern}')
+        matched.extend(n for n in found if n not in matched)
+    return matched
+
+
+def _is_active(method_status: dict, name: str) -> bool:
+    """Whether name has an active entry in method_status.yaml"""
+    return bool((method_status.get(name) or {}).get('Active'))
+
+
+def method_dependencies(method: str) -> dict:
+    """
+    The FBAs and FBSs an FBS method uses, found with planner.plan(), and
+    the files its output depends on: the method yaml and the modules of
+    the functions it calls.
+    :return: dict, 'fba' list of (name, year), 'fbs' list of method names,
+        'inputs' list of paths, and 'error' if the method can not be planned
+    """
+    try:
+        method_plan = planner.plan(method)
+    except Exception as e:
+        log.error('Unable to plan FBS %s: %s', method, e)
+        return {'fba': [], 'fbs': [], 'inputs': [],
+                'error': f'{type(e).__name__}: {e}'}
+    fba, fbs = [], []
+    inputs = {settings.flowbysectormethodpath / f'{method}.yaml'}
+    nodes = method_plan.nodes
+    for node_id, name, kind in zip(nodes.node_id, nodes.name, nodes.kind):
+        config = method_plan.configs[node_id]
+        inputs.update(_function_files(config))
+        if kind == 'activity_set':
+            continue
+        if config.get('data_format') == 'FBA':
+            fba.append((name, config.get('year')))
+        elif config.get('data_format') == 'FBS':
+            fbs.append(name)
+    return {'fba': list(dict.fromkeys(fba)), 'fbs': list(dict.fromkeys(fbs)),
+            'inputs': sorted(str(f) for f in inputs), 'error': None}
+
+
+def resolve(fba: list = None, fbs: list = None, all_methods: bool = False,
+            method_status: dict = None, executor_type: str = 'serial',
+            max_workers: int = None) -> dict:
+    """
+    Find the datasets to build for the targets and the datasets they use.
+    FBS methods are planned with ordered_map(), as loading a method yaml
+    can take a while.
+    :param fba: list, FBA targets, '<source>[:<years>]', glob patterns
+        allowed in source
+    :param fbs: list, FBS method names or glob patterns
+    :param all_methods: bool, also build every FBS method without an
+        active entry in method_status.yaml
+    :param method_status: dict, default read from method_status.yaml
+    :param executor_type: str, one of 'serial', 'thread' or 'process'
+    :param max_workers: int, number of workers, default is the cpu count
+    :return: dict, job of each dataset by id, ordered so that a job comes
+        after the jobs it depends on
+    """
+    if method_status is None:
+        method_status = check_method_status() or {}
+    jobs = {}
+    fba_names = [f.stem for f in settings.sourceconfigpath.glob('*.yaml')
+                 if all(s not in f.stem for s in ['_common', '_Common'])]
+    fbs_names = seeAvailableFlowByModels('FBS', print_method=False)
+    for target in fba or []:
+        pattern, _, years = target.partition(':')
+        for source in _match([pattern], fba_names, 'FBA'):
+            for year in (parse_years(years) if years else
+                         load_yaml_dict(source, 'FBA').get('years', [])):
+                _add_fba(jobs, source, year, method_status, requested=True)
+    methods = _match(fbs or [], fbs_names, 'FBS')
+    if all_methods:
+        methods.extend(m for m in fbs_names if m not in methods
+                       and not _is_active(method_status, m))
+
+    # plan the methods, then the FBS methods they use, and so on
+    planned = {}
+    to_plan = methods
+    while to_plan:
+        planned.update(zip(to_plan, parallel.ordered_map(
+            method_dependencies, to_plan, executor_type, max_workers)))
+        to_plan = list(dict.fromkeys(
+            m for d in planned.values() for m in d['fbs']
+            if m not in planned))
+    for method in methods:
+        _add_fbs(jobs, method, planned, method_status, requested=True)
+    log.info('Resolved %s FBA and %s FBS jobs',
+             sum(j['kind'] == 'FBA' for j in jobs.values()),
+             sum(j['kind'] == 'FBS' for j in jobs.values()))
+    return jobs
+
+
+def _add_fba(jobs: dict, name: str, year, method_status: dict,
+             requested: bool = False) -> str:
+    """Add the job generating FBA name for year, return its id"""
+    source = get_flowsa_base_name(settings.sourceconfigpath, name, 'yaml')
+    year = None if year is None else str(year)
+    job_id = f'FBA:{set_fba_name(source, year)}'
+    if job_id not in jobs:
+        inputs, error = {settings.sourceconfigpath / f'{source}.yaml'}, None
+        try:
+            inputs.update(_function_files(load_yaml_dict(source, 'FBA')))
+        except Exception as e:
+            log.error('Unable to load FBA %s: %s', source, e)
+            error = f'{type(e).__name__}: {e}'
+        jobs[job_id] = {
+            'job': job_id, 'kind': 'FBA', 'name': source, 'year': year,
+            'outputs': [], 'dependencies': [], 'requested': False,
+            'inputs': sorted(str(f) for f in inputs),
+            'excluded': None, 'error': error}
+    job = jobs[job_id]
+    if name not in job['outputs']:
+        job['outputs'].append(name)
+    job['requested'] = job['requested'] or requested
+    active = [n for n in [name, source] if _is_active(method_status, n)]
+    if job['requested']:
+        job['excluded'] = None
+    elif active:
+        job['excluded'] = method_status[active[0]].get('Status', 'Unknown')
+    return job_id
+
+
+def _add_fbs(jobs: dict, method: str, planned: dict, method_status: dict,
+             requested: bool = False, parents: tuple = ()) -> str:
+    """
+    Add the job generating FBS method after the jobs it uses, return its id
+    :param planned: dict, method_dependencies() of each FBS method
+    """
+    job_id = f'FBS:{method}'
+    if method in parents:
+        raise ValueError(f'FBS {method} depends on itself: '
+                         f'{" -> ".join([*parents, method])}')
+    if job_id not in jobs:
+        dependencies = planned[method]
+        jobs[job_id] = {
+            'job': job_id, 'kind': 'FBS', 'name': method, 'year': None,
+            'outputs': [method], 'requested': False,
+            'dependencies': list(dict.fromkeys([
+                *[_add_fba(jobs, name, year, method_status)
+                  for name, year in dependencies['fba']],
+                *[_add_fbs(jobs, name, planned, method_status,
+                           parents=(*parents, method))
+                  for name in dependencies['fbs']]])),
+            'inputs': dependencies['inputs'],
+            'excluded': None, 'error': dependencies['error']}
+    job = jobs[job_id]
+    job['requested'] = job['requested'] or requested
+    job['excluded'] = (method_status[method].get('Status', 'Unknown')
+                       if not job['requested']
+                       and _is_active(method_status, method) else None)
+    return job_id
+
+
+def _output_files(job: dict) -> list:
+    """Local parquet of each of a job's outputs, None if missing"""
+    return [find_input_file(name, {'data_format': job['kind'],
+                                   'year': job['year']})
+            for name in job['outputs']]
+
+
+def stale_reason(job: dict, jobs: dict):
+    """
+    Why the outputs of a job need to be built, or None if they are current
+    """
+    outputs = _output_files(job)
+    if None in outputs:
+        return 'output not found'
+    built = min(f.stat().st_mtime for f in outputs)
+    inputs = [Path(f) for f in job['inputs']]
+    for dependency in job['dependencies']:
+        inputs.extend(f for f in _output_files(jobs[dependency]) if f)
+    for f in inputs:
+        if f.exists() and f.stat().st_mtime > built:
+            return f'{f.name} is newer than the output'
+    return None
+
+
+def _reset_peak_memory() -> None:
+    """Reset the peak resident memory of this process, on linux"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory_mb():
+    """
+    Peak resident memory of this process in MB, since the last
+    _reset_peak_memory() on linux. None if unavailable.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / 1024 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def run_job(job: dict, download: bool = False) -> dict:
+    """
+    Generate the FBA or FBS of a job in the current process, with a log
+    file of its own.
+    :param job: dict, job returned by resolve()
+    :param download: bool, download source FBAs and FBSs that are missing
+        locally, see FlowBySector.generateFlowBySector()
+    :return: dict, status, seconds, peak_memory_mb and error
+    """
+    _reset_peak_memory()
+    start = time.perf_counter()
+    result = {'status': 'built', 'error': None}
+    with thread_log_file(f'flowsa_build_{job["job"].replace(":", "_")}.log'):
+        try:
+            if job['kind'] == 'FBA':
+                generateflowbyactivity.main(source=job['name'],
+                                            year=job['year'])
+            else:
+                FlowBySector.generateFlowBySector(
+                    job['name'], download_sources_ok=download)
+        except Exception as e:
+            log.exception('Failed to build %s', job['job'])
+            result = {'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+    return {**result, 'seconds': round(time.perf_counter() - start, 3),
+            'peak_memory_mb': peak_memory_mb()}
+
+
+def _check(job: dict, jobs: dict, results: dict, force: bool):
+    """
+    Result of a job whose dependencies are done if it is not built, else
+    None. Returns the reason it is (or is not) built.
+    """
+    if job['error']:
+        return {'status': 'failed', 'error': job['error']}, 'not planned'
+    failed = [d for d in job['dependencies']
+              if results[d]['status'] in ['failed', 'skipped']]
+    if failed:
+        return {'status': 'skipped'}, f'{", ".join(failed)} not built'
+    if job['excluded']:
+        return {'status': 'excluded'}, job['excluded']
+    if force:
+        return None, 'forced'
+    reason = stale_reason(job, jobs)
+    if reason is None:
+        return {'status': 'current'}, 'output is current'
+    return None, reason
+
+
+def _executor(executor_type: str, max_workers: int, queue=None):
+    if executor_type == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers)
+    if executor_type == 'process':
+        return parallel.process_pool(max_workers, queue)
+    return None
+
+
+def run_jobs(jobs: dict, executor_type: str = 'serial',
+             max_workers: int = None, force: bool = False,
+             download: bool = False) -> dict:
+    """
+    Run the jobs returned by resolve(), each once the jobs it depends on are
+    done. Jobs whose dependencies failed are skipped.
+    :param jobs: dict, jobs by id
+    :param executor_type: str, one of 'serial', 'thread' or 'process'
+    :param max_workers: int, number of workers, default is the cpu count
+    :param force: bool, build outputs that are current
+    :param download: bool, see run_job()
+    :return: dict, result of each job by id, in the order of jobs
+    """
+    fxn = partial(run_job, download=download)
+    if executor_type == 'thread':
+        fxn = partial(parallel._run_in_thread, fxn)
+    results = {}
+    waiting = list(jobs)
+    running = {}
+    workers = max_workers or os.cpu_count()
+    with ExitStack() as stack:
+        queue = (stack.enter_context(parallel.log_queue())
+                 if executor_type == 'process' else None)
+        executor = _executor(executor_type, max_workers, queue)
+        broken = False
+        try:
+            while waiting or running:
+                for job_id in list(waiting):
+                    job = jobs[job_id]
+                    if any(d not in results for d in job['dependencies']):
+                        continue
+                    result, reason = _check(job, jobs, results, force)
+                    if result is not None:
+                        waiting.remove(job_id)
+                        results[job_id] = {**result, 'reason': reason}
+                        log.info('%s %s: %s', result['status'].capitalize(),
+                                 job_id, reason)
+                        continue
+                    # only submit jobs that start right away, so that a
+                    # killed worker fails as few jobs as possible
+                    if len(running) == workers:
+                        continue
+                    waiting.remove(job_id)
+                    log.info('Building %s: %s', job_id, reason)
+                    if executor is None:
+                        results[job_id] = {**fxn(job), 'reason': reason}
+                        continue
+                    if broken:
+                        # a worker was killed, e.g. when out of memory
+                        executor.shutdown(wait=False)
+                        executor = _executor(executor_type, max_workers,
+                                             queue)
+                        broken = False
+                    running[executor.submit(fxn, job)] = (job_id, reason)
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id, reason = running.pop(future)
+                    try:
+                        results[job_id] = {**future.result(),
+                                           'reason': reason}
+                    except BrokenProcessPool as e:
+                        log.error('Failed to build %s: %s', job_id, e)
+                        results[job_id] = {
+                            'status': 'failed', 'reason': reason,
+                            'error': f'{type(e).__name__}: {e}'}
+                        broken = True
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+    return {job_id: results[job_id] for job_id in jobs}
+
+
+def write_report(jobs: dict, results: dict, started: datetime,
+                 path: Path = None, **settings_used) -> dict:
+    """
+    Write the json report of a build, by default to
+    BuildReports/flowsa_build_<start time>.json in the flowsa output folder.
+    :return: dict, report
+    """
+    report = {
+        'started': started.isoformat(),
+        'finished': datetime.now(timezone.utc).isoformat(),
+        **settings_used,
+        'counts': {status: sum(r['status'] == status
+                               for r in results.values())
+                   for status in STATUSES},
+        'jobs': [{'job': job_id,
+                  **{k: jobs[job_id][k] for k in
+                     ['kind', 'name', 'year', 'outputs', 'dependencies',
+                      'requested']},
+                  'status': results[job_id]['status'],
+                  'reason': results[job_id].get('reason'),
+                  'seconds': results[job_id].get('seconds'),
+                  'peak_memory_mb': results[job_id].get('peak_memory_mb'),
+                  'error': results[job_id].get('error')}
+                 for job_id in jobs]}
+    if path is None:
+        path = reportpath / f'flowsa_build_{started:%Y%m%d_%H%M%S}.json'
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _atomic_write(path, lambda p: p.write_text(json.dumps(report, indent=2)))
+    log.info('Build report saved to %s', path)
+    return report
+
+
+def parse_args(argv: list = None):
+    """
+    Make arguments for command prompt
+    :return: dictionary, arguments
+    """
+    ap = argparse.ArgumentParser(
+        prog='flowsa build',
+        description='Build FBAs and FBSs, and the datasets they use')
+    ap.add_argument('--fba', nargs='+', default=[],
+                    help='FBA sources to build, as <source>[:<years>], '
+                         'e.g. "USDA_CoA_*:2017" or BLS_QCEW:2013-2015')
+    ap.add_argument('--fbs', nargs='+', default=[],
+                    help='FBS methods to build, names or glob patterns')
+    ap.add_argument('--all', dest='all_methods', action='store_true',
+                    help='Build every FBS method without an active entry '
+                         'in method_status.yaml')
+    ap.add_argument('--executor', choices=parallel.EXECUTOR_TYPES,
+                    help='Run the builds serially or with a pool of threads '
+                         'or processes, default process')
+    ap.add_argument('--max-workers', dest='max_workers', type=int,
+                    help='Number of datasets built at once')
+    ap.add_argument('--force', action='store_true',
+                    help='Build datasets whose outputs are current')
+    ap.add_argument('--download', action='store_true',
+                    help='Download source datasets that are not built')
+    ap.add_argument('--report', default=None,
+                    help='Path of the json build report')
+    return vars(ap.parse_args(argv))
+
+
+def main(**kwargs):
+    """
+    Build FBAs and FBSs
+    :param kwargs: 'fba', 'fbs', 'all_methods', 'executor', 'max_workers',
+        'force', 'download' and 'report', see parse_args(). The executor
+        defaults to the FLOWSA_BUILD_EXECUTOR environment variable, or
+        'process'.
+    :return: dict, build report
+    """
+    if len(kwargs) == 0:
+        kwargs = parse_args()
+    started = datetime.now(timezone.utc)
+    executor = parallel.get_executor_settings(
+        {'build_executor': (kwargs.get('executor')
+                            or os.environ.get('FLOWSA_BUILD_EXECUTOR')
+                            or 'process'),
+         'max_workers': kwargs.get('max_workers')},
+        'build_executor')
+    jobs = resolve(fba=kwargs.get('fba'), fbs=kwargs.get('fbs'),
+                   all_methods=kwargs.get('all_methods', False), **executor)
+    results = run_jobs(jobs, force=kwargs.get('force', False),
+                       download=kwargs.get('download', False), **executor)
+    report = write_report(jobs, results, started, kwargs.get('report'),
+                          **executor)
+    summary = pd.DataFrame(report['jobs'],
+                           columns=['job', 'status', 'seconds',
+                                    'peak_memory_mb'])
+    log.info('Build of %s datasets complete %s:\n%s', len(jobs),
+             report['counts'],
+             summary.to_string(index=False, float_format='{:.1f}'.format))
+    return report
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main()['counts']['failed'] else 0)
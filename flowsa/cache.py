@@ -0,0 +1,448 @@
+# cache.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Persistent, content-addressed cache of prepared attribution and clean
+sources, so that regenerating related FBS methods (e.g. the m1/m2 and state
+variants of a method) reuses prepared attribution data.
+
+A prepared source is keyed by a hash of its name, its effective config, the
+flowsa version and git hash, and the contents of the FBA/FBS files it is
+prepared from. Entries are parquet files under settings.paths.local_path and
+the least recently used entries are evicted once the cache exceeds its size
+limit.
+
+The cache is off by default; enable it with the method yaml key
+`intermediate_cache: True` or the FLOWSA_INTERMEDIATE_CACHE environment
+variable.
+
+The same directory holds the per-source FBS fragments used for incremental
+FBS generation. A fragment is reused while the fingerprint of its source
+(config, input files, crosswalks, and the code of the functions it uses)
+is unchanged. To list or clear the cache:
+
+    python -m flowsa.cache --list
+    python -m flowsa.cache --clear
+"""
+
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import uuid
+from functools import partial
+from pathlib import Path
+from flowsa import settings, planner
+from flowsa.common import get_flowsa_base_name, str2bool
+from flowsa.flowsa_log import log
+
+cachepath = settings.outputpath / 'IntermediateCache'
+fragmentpath = cachepath / 'fragments'
+hashpath = cachepath / 'file_hashes'
+DEFAULT_MAX_SIZE_GB = 5
+# flowsa modules and crosswalks used when preparing any source
+CORE_MODULES = ['common', 'flowby', 'flowbyactivity', 'flowbysector',
+                'flowbyclean', 'flowbyfunctions', 'geo', 'naics',
+                'sectormapping']
+CORE_CROSSWALKS = ['NAICS_Crosswalk_TimeSeries', 'FIPS_Crosswalk',
+                   'Household_SectorCodes', 'Government_SectorCodes']
+
+
+def enabled(config: dict) -> bool:
+    """
+    Whether to use the persistent cache, from config['intermediate_cache']
+    or the FLOWSA_INTERMEDIATE_CACHE environment variable.
+    """
+    value = config.get('intermediate_cache',
+                       os.environ.get('FLOWSA_INTERMEDIATE_CACHE', False))
+    return str2bool(value if isinstance(value, bool) else str(value))
+
+
+def max_size() -> int:
+    """Cache size limit in bytes, from FLOWSA_INTERMEDIATE_CACHE_GB"""
+    gb = float(os.environ.get('FLOWSA_INTERMEDIATE_CACHE_GB',
+                              DEFAULT_MAX_SIZE_GB))
+    return int(gb * 1024 ** 3)
+
+
+def _atomic_write(path: Path, write) -> None:
+    """Write to a temporary file and move it into place"""
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp')
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def file_hash(path: Path) -> str:
+    """
+    sha256 of a file's contents. Hashes are stored alongside the cache, in
+    a file per hashed file so that concurrent processes do not overwrite
+    one another's entries, and only recomputed when the file's size or
+    modification time changes.
+    """
+    entry_file = (hashpath /
+                  f'{hashlib.sha1(str(path).encode()).hexdigest()}.json')
+    try:
+        with open(entry_file) as f:
+            entry = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        entry = None
+    stat = path.stat()
+    if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    entry = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+    hashpath.mkdir(parents=True, exist_ok=True)
+    _atomic_write(entry_file, lambda p: p.write_text(json.dumps(entry)))
+    return sha.hexdigest()
+
+
+def find_input_file(name: str, config: dict):
+    """
+    Most recent local FBA or FBS parquet for a dataset, mirroring the file
+    esupy loads. Returns None if the file does not exist locally (yet), or
+    the dataset is not loaded from a flowsa output file.
+    """
+    data_format = config.get('data_format')
+    if data_format == 'FBA':
+        category = 'FlowByActivity'
+        year = config.get('year')
+        meta_name = name if year is None else f'{name}_{year}'
+    elif data_format == 'FBS':
+        category = 'FlowBySector'
+        meta_name = name
+    else:
+        return None
+    folder = (Path(config.get('external_data_path')
+                   or settings.paths.local_path) / category)
+    files = list(folder.glob(f'{meta_name}_v*.{settings.WRITE_FORMAT}'))
+    if not files:
+        return None
+    return max(files, key=lambda f: f.stat().st_mtime)
+
+
+def cache_key(name: str, config: dict):
+    """
+    Key of a prepared source, or None if any of its input files are not
+    available locally. The source and the sources it depends on are found
+    in the plan of the FBS method using it (config['method_plan']), so that
+    dependencies resolved by the method, such as its sources_to_cache, are
+    keyed by their own configs and input files.
+    :param name: str, source name
+    :param config: dict, effective config of the source
+    :return: str or None
+    """
+    method_plan = config.get('method_plan')
+    node_id = planner.node_key(name, config)
+    if method_plan is None or node_id not in method_plan.configs:
+        # not used by a planned FBS method
+        method_plan = planner.MethodPlan(name)
+        node_id = method_plan.add_source(name, config, kind='attribution')
+    kinds = method_plan.nodes.set_index('node_id')['kind']
+    node_ids = sorted({node_id, *method_plan.descendants(node_id)})
+    inputs = []
+    for n in node_ids:
+        if kinds[n] == 'activity_set':
+            continue
+        input_file = find_input_file(method_plan.names[n],
+                                     method_plan.configs[n])
+        if input_file is None:
+            return None
+        inputs.append(file_hash(input_file))
+    digest = hashlib.sha256('|'.join(
+        [*node_ids, settings.PKG_VERSION_NUMBER,
+         str(settings.GIT_HASH), *sorted(inputs)]).encode()).hexdigest()
+    return f'{name}_{digest[:16]}'
+
+
+def load(name: str, config: dict):
+    """
+    Load a prepared source from the cache.
+    :return: FlowBySector, or None if not cached
+    """
+    from flowsa.flowbysector import FlowBySector
+    import pandas as pd
+
+    key = cache_key(name, config)
+    if key is None:
+        return None
+    data_file = cachepath / f'{key}.{settings.WRITE_FORMAT}'
+    meta_file = cachepath / f'{key}.pkl'
+    if not (data_file.exists() and meta_file.exists()):
+        return None
+    try:
+        with open(meta_file, 'rb') as f:
+            meta = pickle.load(f)
+        df = pd.read_parquet(data_file)
+    except Exception as e:
+        log.warning('Unable to load %s from the intermediate cache: %s',
+                    name, e)
+        return None
+    # mark as recently used
+    os.utime(data_file)
+    log.info('Loaded prepared %s from intermediate cache %s', name, key)
+    return FlowBySector(df, full_name=meta['full_name'],
+                        config={**meta['config'],
+                                'cache': config.get('cache', {}),
+                                'method_plan': config.get('method_plan')})
+
+
+def save(fbs, name: str, config: dict) -> None:
+    """Store a prepared source in the cache and evict old entries"""
+    key = cache_key(name, config)
+    if key is None:
+        log.debug('Inputs to %s are not stored locally, not caching', name)
+        return
+    cachepath.mkdir(parents=True, exist_ok=True)
+    meta = {'name': name, 'full_name': fbs.full_name,
+            'config': {k: v for k, v in fbs.config.items()
+                       if k not in ['cache', 'method_plan']}}
+    try:
+        _atomic_write(cachepath / f'{key}.pkl',
+                      lambda p: p.write_bytes(pickle.dumps(meta)))
+        _atomic_write(cachepath / f'{key}.{settings.WRITE_FORMAT}',
+                      lambda p: fbs.to_parquet(p))
+    except Exception as e:
+        log.warning('Unable to save %s to the intermediate cache: %s',
+                    name, e)
+        return
+    log.info('Saved prepared %s to intermediate cache %s', name, key)
+    evict()
+
+
+def incremental(config: dict) -> bool:
+    """
+    Whether to generate an FBS incrementally, from config['incremental'] or
+    the FLOWSA_INCREMENTAL environment variable.
+    """
+    value = config.get('incremental',
+                       os.environ.get('FLOWSA_INCREMENTAL', False))
+    return str2bool(value if isinstance(value, bool) else str(value))
+
+
+def _function_files(obj) -> set:
+    """Source files of the functions found in a config value"""
+    if isinstance(obj, dict):
+        return set().union(*[_function_files(v) for v in obj.values()])
+    if isinstance(obj, (list, tuple, set)):
+        return set().union(*[_function_files(v) for v in obj])
+    if isinstance(obj, partial):
+        return _function_files(obj.func)
+    if callable(obj):
+        try:
+            return {Path(inspect.getsourcefile(obj))}
+        except TypeError:
+            return set()
+    return set()
+
+
+def source_fingerprint(method_plan: planner.MethodPlan, node_id: str):
+    """
+    Fingerprint of a source in an FBS method plan, covering the configs of
+    the source and every source it uses, their input FBA/FBS files and
+    activity-to-sector crosswalks, and the modules of any functions called.
+    :return: str, or None if an input file is not available locally or
+        the source uses data not generated by flowsa
+    """
+    files = {settings.MODULEPATH / f'{m}.py' for m in CORE_MODULES}
+    files.update(settings.datapath / f'{cw}.csv' for cw in CORE_CROSSWALKS)
+    nodes = method_plan.nodes.set_index('node_id')
+    for n in sorted({node_id, *method_plan.descendants(node_id)}):
+        config = method_plan.configs[n]
+        files.update(_function_files(config))
+        if nodes.at[n, 'kind'] == 'activity_set':
+            continue
+        if config.get('target_naics_year'):
+            files.add(settings.datapath /
+                      f"NAICS_{config['target_naics_year']}_Crosswalk.csv")
+        input_file = find_input_file(method_plan.names[n], config)
+        if input_file is None:
+            return None
+        files.add(input_file)
+        if config.get('data_format') == 'FBA':
+            mapping = get_flowsa_base_name(
+                settings.crosswalkpath,
+                'NAICS_Crosswalk_' + (config.get('activity_to_sector_mapping')
+                                      or method_plan.names[n]),
+                'csv')
+            files.add(settings.crosswalkpath / f'{mapping}.csv')
+    digest = hashlib.sha256('|'.join([
+        settings.PKG_VERSION_NUMBER,
+        *sorted({node_id, *method_plan.descendants(node_id)}),
+        *sorted(f'{f.name}:{file_hash(f)}' for f in files if f.is_file())
+    ]).encode()).hexdigest()
+    return digest
+
+
+def load_fragment(method: str, source_name: str, fingerprint: str):
+    """
+    Load the stored FBS fragment for one of a method's source_names.
+    :return: FlowBySector, or None if missing or the fingerprint differs
+    """
+    from flowsa.flowbysector import FlowBySector
+    import pandas as pd
+
+    folder = fragmentpath / method
+    try:
+        with open(folder / f'{source_name}.json') as f:
+            meta = json.load(f)
+        if meta['fingerprint'] != fingerprint:
+            return None
+        df = pd.read_parquet(folder / f'{source_name}.'
+                                      f'{settings.WRITE_FORMAT}')
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return None
+    except Exception as e:
+        log.warning('Unable to load stored %s for %s: %s',
+                    source_name, method, e)
+        return None
+    return FlowBySector(df, full_name=meta['full_name'])
+
+
+def save_fragment(fbs, method: str, source_name: str,
+                  fingerprint: str) -> None:
+    """Store the FBS fragment for one of a method's source_names"""
+    folder = fragmentpath / method
+    folder.mkdir(parents=True, exist_ok=True)
+    try:
+        _atomic_write(folder / f'{source_name}.{settings.WRITE_FORMAT}',
+                      lambda p: fbs.to_parquet(p))
+        _atomic_write(folder / f'{source_name}.json',
+                      lambda p: p.write_text(json.dumps(
+                          {'fingerprint': fingerprint,
+                           'full_name': fbs.full_name})))
+    except Exception as e:
+        log.warning('Unable to store %s for %s: %s', source_name, method, e)
+
+
+def write_part(df, path: Path, caller: str) -> bool:
+    """
+    Write a part of a larger dataset (e.g. an attribution chunk or an FBA
+    fragment) to a parquet file, so it need not be held in memory. Return
+    False if parquet files can not be written, because pyarrow is
+    unavailable or can not convert the data, in which case the caller
+    keeps its parts in memory.
+    :param df: DataFrame, part to write
+    :param path: Path, parquet file
+    :param caller: str, description of the parts, for the log message
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(path, index=False)
+    except (ImportError, ValueError, TypeError, NotImplementedError) as e:
+        # ^^^ pyarrow's ArrowInvalid, ArrowTypeError and
+        #     ArrowNotImplementedError subclass the last three
+        log.warning('Unable to write parquet files, keeping %s in memory: '
+                    '%s', caller, e)
+        return False
+    return True
+
+
+def entries() -> list:
+    """Cached parquet files, least recently used first"""
+    if not cachepath.exists():
+        return []
+    return sorted(cachepath.glob(f'*.{settings.WRITE_FORMAT}'),
+                  key=lambda f: f.stat().st_mtime)
+
+
+def evict(size: int = None) -> list:
+    """
+    Remove least recently used entries until the cache is at most size
+    bytes, default max_size().
+    :return: list, removed keys
+    """
+    size = max_size() if size is None else size
+    files = entries()
+    sizes = {f: sum(p.stat().st_size for p in [f, f.with_suffix('.pkl')]
+                    if p.exists())
+             for f in files}
+    total = sum(sizes.values())
+    removed = []
+    for f in files:
+        if total <= size:
+            break
+        total -= sizes[f]
+        f.unlink()
+        f.with_suffix('.pkl').unlink(missing_ok=True)
+        removed.append(f.stem)
+    if removed:
+        log.info('Evicted %s entries from the intermediate cache',
+                 len(removed))
+    return removed
+
+
+def clear(name: str = None) -> list:
+    """
+    Remove all entries, or the entries for a single source name.
+    :return: list, removed keys
+    """
+    removed = []
+    for f in entries():
+        if name is None or f.stem.rsplit('_', 1)[0] == name:
+            f.unlink()
+            f.with_suffix('.pkl').unlink(missing_ok=True)
+            removed.append(f.stem)
+    if name is None:
+        if hashpath.exists():
+            shutil.rmtree(hashpath)
+        if fragmentpath.exists():
+            shutil.rmtree(fragmentpath)
+    return removed
+
+
+def parse_args():
+    """
+    Make arguments for command prompt
+    :return: dictionary, arguments
+    """
+    ap = argparse.ArgumentParser(
+        description='Manage the flowsa intermediate cache')
+    ap.add_argument('--list', action='store_true',
+                    help='List cached sources')
+    ap.add_argument('--clear', action='store_true',
+                    help='Remove cached sources')
+    ap.add_argument('--source', default=None,
+                    help='Only clear entries for this source name')
+    ap.add_argument('--method', default=None,
+                    help='Only clear the stored sources of this FBS method, '
+                         'forcing a full rebuild in incremental mode')
+    ap.add_argument('--evict', action='store_true',
+                    help='Evict least recently used entries above the '
+                         'size limit')
+    return vars(ap.parse_args())
+
+
+def main(**kwargs):
+    if len(kwargs) == 0:
+        kwargs = parse_args()
+    if kwargs.get('clear') and kwargs.get('method'):
+        shutil.rmtree(fragmentpath / kwargs['method'], ignore_errors=True)
+        print(f'Removed stored sources of {kwargs["method"]}')
+    elif kwargs.get('clear'):
+        removed = clear(kwargs.get('source'))
+        print(f'Removed {len(removed)} entries from {cachepath}')
+    if kwargs.get('evict'):
+        removed = evict()
+        print(f'Evicted {len(removed)} entries from {cachepath}')
+    if kwargs.get('list'):
+        files = entries()
+        for f in files:
+            print(f'{f.stem}\t{f.stat().st_size / 1024 ** 2:.1f} MB')
+        print(f'{len(files)} entries, '
+              f'{sum(f.stat().st_size for f in files) / 1024 ** 2:.1f} MB '
+              f'in {cachepath}')
+
+
+if __name__ == '__main__':
+    main()
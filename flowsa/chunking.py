@@ -0,0 +1,244 @@
+# chunking.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Memory-bounded attribution of large (e.g. county-level) FlowByActivity
+datasets. Mapping activities to all possible sectors multiplies the number
+of rows of an FBA before it is attributed, so instead of mapping and
+attributing the whole FBA at once, the FBA is split into chunks by state
+(or by ranges of rows, i.e. group_id), each sized to fit a memory budget.
+Each chunk is mapped and attributed on its own, with the attribution
+sources filtered to the chunk's states, and its result is written to a
+parquet part file. Once all chunks are done, the parts are aggregated in
+batches (flowby.aggregate_parquet), so neither the mapped FBA nor the
+attributed flows are held in memory at once. Attribution sources are
+loaded and prepared once and shared by the chunks.
+
+Chunking is off by default; enable it with the method yaml key
+`attribution_chunks: state` (or `group_id`). The memory budget per chunk,
+in GB, is set with `attribution_memory_budget` or the
+FLOWSA_ATTRIBUTION_MEMORY_GB environment variable.
+"""
+
+import os
+import shutil
+import uuid
+from collections import ChainMap
+from typing import List
+import numpy as np
+import pandas as pd
+from flowsa import settings, planner
+from flowsa.cache import write_part
+from flowsa.flowsa_log import log
+
+CHUNK_TYPES = ['state', 'group_id']
+DEFAULT_MEMORY_BUDGET_GB = 2
+# Approximate ratio of the memory used while mapping and attributing a chunk
+# to the memory used by the chunk before mapping. Activities are commonly
+# mapped to several sectors, each of which is merged with attribution data.
+MAPPING_EXPANSION = 25
+chunkpath = settings.outputpath / 'AttributionChunks'
+
+
+def chunk_type(config: dict):
+    """
+    How to chunk attribution, from config['attribution_chunks']: 'state',
+    'group_id', or None (default) to attribute all flows at once.
+    """
+    value = config.get('attribution_chunks')
+    if value in [None, False, 'none', 'None']:
+        return None
+    if value not in CHUNK_TYPES:
+        log.warning(f'Unrecognized attribution_chunks "{value}", must be one '
+                    f'of {CHUNK_TYPES}. Attributing all flows at once.')
+        return None
+    return value
+
+
+def memory_budget(config: dict) -> int:
+    """
+    Memory budget per chunk in bytes, from config['attribution_memory_budget']
+    or the FLOWSA_ATTRIBUTION_MEMORY_GB environment variable, in GB.
+    """
+    gb = (config.get('attribution_memory_budget')
+          or os.environ.get('FLOWSA_ATTRIBUTION_MEMORY_GB')
+          or DEFAULT_MEMORY_BUDGET_GB)
+    return int(float(gb) * 1024 ** 3)
+
+
+def plan_chunks(fb: pd.DataFrame, by: str, budget: int) -> List[np.ndarray]:
+    """
+    Split the rows of fb into chunks whose estimated memory use while being
+    mapped and attributed is within budget.
+    :param fb: FlowBy to attribute
+    :param by: str, 'state' to keep the flows of each state (first two
+        digits of Location) in the same chunk, or 'group_id' for ranges of
+        rows
+    :param budget: int, memory budget per chunk in bytes
+    :return: list of arrays of row positions, one per chunk
+    """
+    if len(fb) == 0:
+        return [np.arange(0)]
+    row_bytes = (fb.memory_usage(deep=True).sum() / len(fb)
+                 * MAPPING_EXPANSION)
+    rows_per_chunk = max(int(budget // row_bytes), 1)
+    if by == 'group_id':
+        return np.array_split(np.arange(len(fb)),
+                              -(-len(fb) // rows_per_chunk))
+
+    # states are added to a chunk, in order, until it is full. A state
+    # larger than the budget makes up a chunk on its own.
+    states = fb['Location'].astype(str).str[:2].to_numpy()
+    order = np.argsort(states, kind='stable')
+    unique_states, start, counts = np.unique(states[order],
+                                             return_index=True,
+                                             return_counts=True)
+    chunks, chunk, size = [], [], 0
+    for state_start, count in zip(start, counts):
+        if chunk and size + count > rows_per_chunk:
+            chunks.append(np.sort(np.concatenate(chunk)))
+            chunk, size = [], 0
+        chunk.append(order[state_start:state_start + count])
+        size += count
+    chunks.append(np.sort(np.concatenate(chunk)))
+    return chunks
+
+
+def filter_to_chunk(other: 'pd.DataFrame', config: dict):
+    """
+    Subset an attribution source to the states of the chunk being
+    attributed (config['attribution_chunk']). National data, and sources
+    used by chunks containing national flows, are not filtered.
+    """
+    states = config.get('attribution_chunk')
+    if not states or '00' in states:
+        return other
+    state = other['Location'].astype(str).str[:2]
+    return other[state.isin(states) | (state == '00')]
+
+
+def _attribution_source_keys(fb) -> List[str]:
+    """
+    Keys, as in config['cache'], of the attribution sources loaded by
+    attribute_flows_to_sectors(), so that they are prepared only once.
+    """
+    steps = fb.config.get('attribute', fb.config)
+    if isinstance(steps, dict):
+        steps = [steps]
+    parent_config = {k: v for k, v in fb.config.items()
+                     if k not in ['activity_sets',
+                                  'clean_fba_before_activity_sets']
+                     and not k.startswith('_')}
+    keys = []
+    for step_config in steps:
+        source = (step_config or {}).get('attribution_source')
+        if source is None:
+            continue
+        name, config = ((source, {}) if isinstance(source, str)
+                        else next(iter(source.items())))
+        keys.append(planner.node_key(
+            name, planner.subsource_config({**parent_config, **step_config},
+                                           name, config or {})))
+    return keys
+
+
+def log_percent_change(full_name: str, fbsum: float, attsum: float) -> None:
+    """Log the percent change in FlowAmount caused by attribution"""
+    percent_change = round(((attsum - fbsum) / fbsum) * 100, 3)
+    if percent_change == 0:
+        log.info(f"No change in {full_name} FlowAmount after attribution.")
+    else:
+        log.warning(f"Percent change in {full_name} after attribution is "
+                    f"{percent_change}%")
+
+
+def attribute_in_chunks(fb, chunks: List[np.ndarray],
+                        columns_to_drop: List[str], **kwargs):
+    """
+    Run attribute_flows_to_sectors() on each chunk of fb and drop
+    columns_to_drop, writing the results to parquet part files, and return
+    the aggregated result, as attribute_and_aggregate() would. The parts
+    are aggregated in batches with aggregate_parquet(), so the attributed
+    flows are never all held in memory at once. If parquet files can not
+    be written, or flows are rates or ratios, which are not aggregated, the
+    results are instead combined in memory.
+    Validation totals are summed over the chunks and logged once.
+    :param fb: FlowBy to attribute
+    :param chunks: list of arrays of row positions, from plan_chunks(); if
+        empty, fb is attributed as a single chunk
+    :param columns_to_drop: list, columns to drop before aggregating
+    :param kwargs: passed to attribute_flows_to_sectors()
+    """
+    from flowsa.flowby import aggregate_parquet
+
+    if len(chunks) == 0:
+        chunks = [np.arange(len(fb))]
+    log.info(f'Attributing {fb.full_name} in {len(chunks)} chunks')
+    shared = fb.config.get('cache')
+    if shared is None:
+        shared = {}
+    # attribution sources are prepared by the first chunk and shared with
+    # the others through a cache local to these chunks, layered over the
+    # method's cache, which may be used by other threads
+    cache = ChainMap(dict.fromkeys(key for key in _attribution_source_keys(fb)
+                                   if key not in shared),
+                     shared)
+
+    run_path = chunkpath / uuid.uuid4().hex
+    parts, validation_totals, result, template = [], {}, None, None
+    flow_total, spill = 0, True
+    try:
+        for i, rows in enumerate(chunks):
+            chunk = fb.take(rows)
+            states = sorted(set(chunk['Location'].astype(str).str[:2]))
+            chunk.config = {**fb.config, 'cache': cache,
+                            'attribution_chunk': states}
+            log.info(f'Attributing chunk {i + 1} of {len(chunks)} of '
+                     f'{fb.full_name} ({len(chunk):,} flows in states '
+                     f'{", ".join(states)})')
+            result = (chunk
+                      .attribute_flows_to_sectors(
+                          validation_totals=validation_totals, **kwargs)
+                      .drop(columns=columns_to_drop))
+            del chunk
+            if len(result) == 0:
+                continue
+            template = result.iloc[:0]
+            flow_total += result['FlowAmount'].sum()
+            # rates and ratios are not aggregated, see aggregate_flowby()
+            spill = spill and not result['Unit'].str.contains('/').any()
+            path = run_path / f'part-{i:05d}.{settings.WRITE_FORMAT}'
+            spill = spill and write_part(
+                result, path, f'attribution chunks of {fb.full_name}')
+            parts.append(path if spill else result)
+
+        for fbsum, attsum in validation_totals.values():
+            log_percent_change(fb.full_name, fbsum, attsum)
+        config = {**{k: v for k, v in result.config.items()
+                     if k not in ['attribution_chunk', 'cache']},
+                  **({'cache': fb.config['cache']}
+                     if 'cache' in fb.config else {})}
+        if not spill or template is None:
+            attributed = pd.concat(
+                [result.iloc[:0],
+                 *[pd.read_parquet(p) if not isinstance(p, pd.DataFrame)
+                   else p for p in parts]],
+                ignore_index=True)
+            attributed = type(result)(attributed)
+            attributed.config = config
+            return attributed.aggregate_flowby()
+
+        columns_to_average = [x for x in template.columns
+                              if template[x].dtype == 'float'
+                              and x != 'FlowAmount']
+        aggregated = aggregate_parquet(parts, template.groupby_cols,
+                                       columns_to_average)
+        template.config = config
+        if len(aggregated) == 0:
+            log.warning('Error, dataframe is empty')
+            return template
+        return template._restore_aggregated(
+            template._constructor(aggregated).__finalize__(template),
+            flow_total)
+    finally:
+        shutil.rmtree(run_path, ignore_errors=True)
@@ -6,6 +6,8 @@
 
 import os
 import pprint
+import threading
+from functools import wraps
 from os import path
 import re
 import yaml
@@ -68,6 +70,104 @@ def load_env_file_key(env_file, key):
     return value
 
 
+def _make_hashable(obj):
+    """
+    Convert a (possibly nested) dictionary/list argument, such as an
+    industry_spec, to a hashable equivalent. Dictionary order is retained
+    because the order of the keys in an industry_spec is meaningful.
+    :param obj: any argument passed to a memoized function
+    :return: hashable representation of obj
+    """
+    if isinstance(obj, dict):
+        return tuple((k, _make_hashable(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(_make_hashable(v) for v in obj)
+    if isinstance(obj, set):
+        return frozenset(_make_hashable(v) for v in obj)
+    return obj
+
+
+class CrosswalkRegistry:
+    """
+    Process-wide store of the crosswalks in flowsa/data and of the keys
+    derived from them (e.g. naics.industry_spec_key()), so each csv is read
+    and each key is built once per process rather than once per activity
+    set or attribution step.
+
+    Crosswalks are held as categorical dataframes to limit memory, and every
+    call returns a new object-dtype copy, so callers are free to modify what
+    they are given. Long-running processes can call clear() to release the
+    stored data; hits and misses count lookups since the last clear().
+    """
+    def __init__(self):
+        self._crosswalks = {}
+        self._keys = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, crosswalk_name: str) -> pd.DataFrame:
+        """
+        Return the crosswalk saved as flowsa/data/<crosswalk_name>.csv
+        :param crosswalk_name: str, name of csv without the extension
+        :return: df, all columns of object dtype
+        """
+        with self._lock:
+            cw = self._crosswalks.get(crosswalk_name)
+            if cw is None:
+                self.misses += 1
+                cw = (pd.read_csv(datapath / f'{crosswalk_name}.csv',
+                                  dtype="str")
+                      .astype('category'))
+                self._crosswalks[crosswalk_name] = cw
+            else:
+                self.hits += 1
+        return cw.astype(object)
+
+    def memoize(self, fxn):
+        """
+        Decorator caching the dataframe returned by fxn for each distinct
+        set of arguments. A copy of the cached dataframe is returned.
+        """
+        @wraps(fxn)
+        def wrapper(*args, **kwargs):
+            key = (fxn.__module__, fxn.__qualname__,
+                   _make_hashable(args), _make_hashable(kwargs))
+            with self._lock:
+                df = self._keys.get(key)
+                if df is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            if df is None:
+                df = fxn(*args, **kwargs)
+                with self._lock:
+                    self._keys[key] = df
+            return df.copy()
+        return wrapper
+
+    def clear(self) -> None:
+        """Release all stored crosswalks and keys and reset the counters"""
+        with self._lock:
+            self._crosswalks.clear()
+            self._keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """
+        :return: dict, number of hits, misses, and stored crosswalks and keys
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'crosswalks': len(self._crosswalks),
+                    'keys': len(self._keys)}
+
+
+crosswalk_registry = CrosswalkRegistry()
+
+
 def load_crosswalk(crosswalk_name):
     """
     Used to load the crosswalks:
@@ -77,16 +177,18 @@ def load_crosswalk(crosswalk_name):
     'Government_SectorCodes', 'NAICS_to_BEA_Crosswalk_2012',
     'NAICS_to_BEA_Crosswalk_2017'
 
-    as a dataframe
+    as a dataframe. Each csv is only read once per process, see
+    CrosswalkRegistry.
 
     :return: df, NAICS crosswalk over the years
     """
 
-    cw = pd.read_csv(datapath / f'{crosswalk_name}.csv', dtype="str")
+    cw = crosswalk_registry.load(crosswalk_name)
 
     return cw
 
 
+@crosswalk_registry.memoize
 def load_sector_length_cw_melt(year='2012'):
     cw_load = load_crosswalk(f'NAICS_{year}_Crosswalk')
     cw_melt = cw_load.melt(var_name="SectorLength", value_name='Sector'
@@ -285,11 +387,13 @@ def get_flowsa_base_name(filedirectory, filename, extension):
     return filename
 
 
-def return_true_source_catalog_name(sourcename):
+def return_true_source_catalog_name(sourcename, source_catalog=None):
     """
     Drop any extensions on source name until find the name in source catalog
     """
-    while (load_yaml_dict('source_catalog').get(sourcename) is None) & (
+    if source_catalog is None:
+        source_catalog = load_yaml_dict('source_catalog')
+    while (source_catalog.get(sourcename) is None) & (
             '_' in sourcename):
         sourcename = sourcename.rsplit("_", 1)[0]
     return sourcename
@@ -317,13 +421,15 @@ def check_method_status():
     return method_status
 
 
-def get_catalog_info(source_name: str) -> dict:
+def get_catalog_info(source_name: str, source_catalog: dict = None) -> dict:
     '''
     Retrieves the information on a given source from source_catalog.yaml.
     Replaces various pieces of code that load the source_catalog yaml.
+    :param source_catalog: dict, optional, an already loaded source_catalog
     '''
-    source_catalog = load_yaml_dict('source_catalog')
-    source_name = return_true_source_catalog_name(source_name)
+    if source_catalog is None:
+        source_catalog = load_yaml_dict('source_catalog')
+    source_name = return_true_source_catalog_name(source_name, source_catalog)
     return source_catalog.get(source_name, {})
 
 
@@ -52,3 +52,13 @@ class FBSMethodConstructionError(Exception):
                        "by '!script_function:<data_source_module>'")
         self.message = message
         super().__init__(self.message)
+
+
+class ResponseNotCachedError(FileNotFoundError):
+    """Url requested in offline mode without a cached response"""
+    def __init__(self, url=None):
+        message = "No cached response in offline mode"
+        if url:
+            message = " ".join((message, f"for {url}"))
+        self.message = message
+        super().__init__(self.message)
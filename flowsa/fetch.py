@@ -0,0 +1,195 @@
+# fetch.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Concurrent requests for the urls of a FlowByActivity source. Urls are
+requested by a pool of threads, and responses are returned in the order of
+the urls so that they are handed to the source's call_response_fxn in a
+deterministic order.
+
+The FBA method yaml key `time_delay` (in seconds) is applied per host as a
+token bucket rate limit: requests to the same host start at least
+time_delay apart, while the pool keeps waiting on slow responses. Requests
+that fail with a connection error, timeout, 429 or 5xx status are retried
+with exponential backoff.
+
+Concurrency is opt-in: the number of concurrent requests is read from the
+method yaml key `max_concurrency` or the FLOWSA_MAX_CONCURRENCY environment
+variable, and defaults to 1.
+
+Responses are read from and stored in the response cache according to the
+response_cache mode, see flowsa.response_cache.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib import parse
+import requests
+from esupy.remote import make_url_request
+from flowsa import response_cache
+from flowsa.flowsa_log import log
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 1  # seconds, doubled after each failed attempt
+
+
+def get_max_concurrency(config: dict) -> int:
+    """
+    Number of concurrent requests, from config['max_concurrency'] or the
+    FLOWSA_MAX_CONCURRENCY environment variable, default 1.
+    """
+    raw = (config.get('max_concurrency')
+           or os.environ.get('FLOWSA_MAX_CONCURRENCY')
+           or 1)
+    try:
+        value = int(raw)
+    except ValueError:
+        value = 0
+    if value < 1:
+        log.warning(f'Unrecognized max_concurrency "{raw}", must be a '
+                    f'positive integer. Requesting urls one at a time.')
+        return 1
+    return value
+
+
+class RateLimiter:
+    """
+    Token bucket rate limit per host. Each host's bucket holds up to burst
+    tokens and refills one token every delay seconds; acquire() takes a
+    token, waiting until one is available. Thread safe.
+    """
+    def __init__(self, delay: float = 0, burst: int = 1):
+        self.delay = float(delay or 0)
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def acquire(self, url: str) -> float:
+        """
+        Wait until a request to the host of url may start
+        :return: float, seconds waited
+        """
+        if self.delay <= 0:
+            return 0
+        host = parse.urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self._buckets.get(host, (self.burst, now))
+            # tokens below 0 are reserved by requests that are waiting
+            tokens = min(self.burst, tokens + (now - last) / self.delay) - 1
+            self._buckets[host] = (tokens, now)
+        wait = max(-tokens * self.delay, 0)
+        time.sleep(wait)
+        return wait
+
+
+def _is_retryable(err: requests.exceptions.RequestException) -> bool:
+    """Whether a failed request may succeed if repeated"""
+    if isinstance(err, requests.exceptions.HTTPError):
+        status = getattr(err.response, 'status_code', None)
+        return status is None or status == 429 or status >= 500
+    return isinstance(err, (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout))
+
+
+def request_url(url: str, limiter: RateLimiter = None,
+                max_retries: int = DEFAULT_MAX_RETRIES,
+                backoff: float = DEFAULT_RETRY_BACKOFF, **kwargs):
+    """
+    Request url with make_url_request(), retrying failed requests with
+    exponential backoff.
+    :param url: str
+    :param limiter: RateLimiter, applied to each attempt
+    :param max_retries: int, number of times a failed request is repeated
+    :param backoff: float, seconds to wait before the first retry
+    :param kwargs: passed to make_url_request()
+    :return: response
+    """
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire(url)
+        log.info("Calling %s", url)
+        try:
+            return make_url_request(url, **kwargs)
+        except requests.exceptions.RequestException as err:
+            if attempt == max_retries or not _is_retryable(err):
+                raise
+            wait = backoff * 2 ** attempt
+            log.warning(f'Request failed ({err}), retrying in {wait}s')
+            time.sleep(wait)
+
+
+def fetch_urls(url_list: list, config: dict, manifest: list = None):
+    """
+    Request each of url_list, yielding (url, response) in the order of
+    url_list. At most 2 * max_concurrency responses are requested ahead of
+    the one being yielded.
+    :param url_list: list, urls to call
+    :param config: dict, FBA method yaml, for time_delay, max_concurrency,
+        max_retries, retry_backoff, response_cache, response_cache_ttl,
+        allow_http_request_cookies and confirm_gdrive
+    :param manifest: list, if given, a manifest_record() of each response
+        is appended to it
+    """
+    cache_mode = response_cache.mode(config)
+    max_age = response_cache.ttl(config)
+    fetch = partial(
+        response_cache.cached_request,
+        request=partial(
+            request_url,
+            limiter=RateLimiter(config.get('time_delay', 0)),
+            max_retries=config.get('max_retries', DEFAULT_MAX_RETRIES),
+            backoff=config.get('retry_backoff', DEFAULT_RETRY_BACKOFF)),
+        cache_mode=cache_mode,
+        max_age=max_age,
+        set_cookies=config.get('allow_http_request_cookies'),
+        confirm_gdrive=config.get('confirm_gdrive'))
+    for url, (response, key, cached) in _ordered_fetch(
+            fetch, url_list, get_max_concurrency(config)):
+        if manifest is not None:
+            manifest.append(response_cache.manifest_record(
+                url, response, key, cached))
+        yield url, response
+    if cache_mode in ['use', 'refresh']:
+        response_cache.evict(max_age=max_age)
+
+
+def _submit(executor, fxn, *args):
+    """
+    Submit fxn(*args) to run in a copy of the current context, so that its
+    log records reach the log file of the dataset being generated (see
+    flowsa_log.thread_log_file())
+    """
+    return executor.submit(contextvars.copy_context().run, fxn, *args)
+
+
+def _ordered_fetch(fetch, url_list: list, max_concurrency: int):
+    """Yield (url, fetch(url)) in the order of url_list"""
+    if max_concurrency == 1 or len(url_list) < 2:
+        for url in url_list:
+            yield url, fetch(url)
+        return
+
+    log.info(f'Requesting {len(url_list)} urls, {max_concurrency} at a time')
+    urls = iter(url_list)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        for url in urls:
+            pending.append((url, _submit(executor, fetch, url)))
+            if len(pending) == 2 * max_concurrency:
+                break
+        while pending:
+            url, future = pending.popleft()
+            response = future.result()
+            for next_url in urls:
+                pending.append((next_url, _submit(executor, fetch, next_url)))
+                break
+            yield url, response
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
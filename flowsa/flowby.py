@@ -3,15 +3,19 @@ The functions defined in this script can be applied to both
 FlowByActivity and FlowBySector classes.
 """
 
+import os
 from typing import List, Literal, TypeVar, TYPE_CHECKING
 import pandas as pd
 import numpy as np
-from functools import partial, reduce
+from functools import lru_cache, partial, reduce
 from copy import deepcopy
 from flowsa import (settings, literature_values, flowsa_yaml, geo, schema,
-                    naics)
-from flowsa.common import get_catalog_info
+                    naics, planner)
+from flowsa.common import get_catalog_info, str2bool
+from flowsa import cache as intermediate_cache
+from flowsa import chunking
 from flowsa.flowsa_log import log, vlog
+from pandas.core.indexing import _iLocIndexer, _LocIndexer
 import esupy.processed_data_mgmt
 import esupy.dqi
 
@@ -85,11 +89,625 @@ def get_flowby_from_config(
 
 
 
+def load_prepare_source(
+    name: str,
+    config: dict,
+    download_sources_ok: bool = True
+) -> 'FlowBySector':
+    """
+    Load and prepare an attribution or clean source. If the FBS method plan
+    found the same source (with the same config) is used more than once,
+    it is prepared the first time it is needed and stored in
+    config['cache'], and a copy is returned on later calls. If the
+    intermediate cache is enabled, prepared sources are also reused across
+    FBS methods and runs.
+    :param name: str, source name
+    :param config: dict, effective config of the source
+    :return: prepared FlowBySector
+    """
+    shared = config.get('cache', {})
+    key = planner.node_key(name, config)
+    if shared.get(key) is not None:
+        log.info('Using previously prepared %s', name)
+        fbs = shared[key].copy()
+        fbs.config = {**shared[key].config}
+        return fbs
+
+    use_intermediate_cache = (intermediate_cache.enabled(config)
+                              and config.get('data_format') !=
+                              'FBS_outside_flowsa')
+    fbs = (intermediate_cache.load(name, config)
+           if use_intermediate_cache else None)
+    if fbs is None:
+        fbs = get_flowby_from_config(
+            name=name,
+            config=config,
+            download_sources_ok=download_sources_ok
+        ).prepare_fbs(download_sources_ok=download_sources_ok)
+        if use_intermediate_cache:
+            intermediate_cache.save(fbs, name, config)
+    if key in shared:
+        shared[key] = fbs
+        fbs = fbs.copy()
+        fbs.config = {**shared[key].config}
+    return fbs
+
+
+DTYPE_PROFILES = ['object', 'category', 'string']
+
+
+@lru_cache(maxsize=None)
+def _profile_dtype(profile: str) -> str:
+    """dtype used for the text columns of a FlowBy under a dtype profile"""
+    if profile == 'string':
+        try:
+            import pyarrow  # noqa: F401
+            return 'string[pyarrow]'
+        except ImportError:
+            log.warning('pyarrow is not installed, using python-backed '
+                        'strings for dtype_profile "string"')
+            return 'string'
+    if profile not in DTYPE_PROFILES:
+        log.warning(f'Unrecognized dtype_profile "{profile}", must be one '
+                    f'of {DTYPE_PROFILES}. Using object.')
+        return 'object'
+    return profile
+
+
+def get_dtype_profile(config: dict) -> str:
+    """
+    dtype profile for the text columns of a FlowBy, from
+    config['dtype_profile'] or the FLOWSA_DTYPE_PROFILE environment variable.
+    'object' (default) stores text as python strings, 'category' as pandas
+    categoricals, and 'string' as pyarrow-backed strings.
+    """
+    return ((config or {}).get('dtype_profile')
+            or os.environ.get('FLOWSA_DTYPE_PROFILE')
+            or 'object')
+
+
+def profile_dtypes(fields: dict, profile: str) -> dict:
+    """Replace 'object' in a dict of field dtypes per the dtype profile"""
+    dtype = _profile_dtype(profile)
+    return {field: dtype if field_dtype == 'object' else field_dtype
+            for field, field_dtype in fields.items()}
+
+
+def is_text_dtype(dtype) -> bool:
+    """True for object, categorical and string dtypes"""
+    return (dtype == 'object'
+            or isinstance(dtype, (pd.CategoricalDtype, pd.StringDtype)))
+
+
+ATTRIBUTION_ENGINES = ['merge', 'sparse']
+
+
+@lru_cache(maxsize=None)
+def _attribution_engine(engine: str) -> str:
+    """Attribution engine to use, falling back to 'merge' if unavailable"""
+    if engine not in ATTRIBUTION_ENGINES:
+        log.warning(f'Unrecognized attribution_engine "{engine}", must be '
+                    f'one of {ATTRIBUTION_ENGINES}. Using merge.')
+        return 'merge'
+    if engine == 'sparse':
+        try:
+            import scipy.sparse  # noqa: F401
+        except ImportError:
+            log.warning('scipy is not installed, using attribution_engine '
+                        '"merge"')
+            return 'merge'
+    return engine
+
+
+def get_attribution_engine(config: dict) -> str:
+    """
+    Engine used for proportional attribution, from
+    config['attribution_engine'] or the FLOWSA_ATTRIBUTION_ENGINE
+    environment variable. 'merge' (default) merges the attribution source
+    onto the flows with pandas; 'sparse' matches flows to the attribution
+    source and sums the denominators with scipy sparse matrices. Both give
+    the same result.
+    """
+    return _attribution_engine((config or {}).get('attribution_engine')
+                               or os.environ.get('FLOWSA_ATTRIBUTION_ENGINE')
+                               or 'merge')
+
+
+AGGREGATION_ENGINES = ['groupby', 'factorized']
+
+
+@lru_cache(maxsize=None)
+def _aggregation_engine(engine: str) -> str:
+    """Aggregation engine to use, falling back to 'groupby' if unknown"""
+    if engine not in AGGREGATION_ENGINES:
+        log.warning(f'Unrecognized aggregation_engine "{engine}", must be '
+                    f'one of {AGGREGATION_ENGINES}. Using groupby.')
+        return 'groupby'
+    return engine
+
+
+def prune_columns_enabled(config: dict) -> bool:
+    """
+    Whether to set aside columns that attribution carries unchanged while
+    flows are attributed (see _passthrough_columns()), from
+    config['prune_columns'] or the FLOWSA_PRUNE_COLUMNS environment
+    variable. Off by default.
+    """
+    value = (config or {}).get('prune_columns',
+                               os.environ.get('FLOWSA_PRUNE_COLUMNS', False))
+    return str2bool(value if isinstance(value, bool) else str(value))
+
+
+def get_aggregation_engine(config: dict) -> str:
+    """
+    Engine used by aggregate_flowby(), from config['aggregation_engine'] or
+    the FLOWSA_AGGREGATION_ENGINE environment variable. 'groupby' (default)
+    aggregates with a pandas groupby; 'factorized' combines integer codes
+    of the columns to group by into a single key and sums with numpy
+    bincount. Both give the same result.
+    """
+    return _aggregation_engine((config or {}).get('aggregation_engine')
+                               or os.environ.get('FLOWSA_AGGREGATION_ENGINE')
+                               or 'groupby')
+
+
+NULL_STRINGS = ['nan', '<NA>', 'None', '']
+NULL_VALUES = [*NULL_STRINGS, np.nan, pd.NA, None]
+# pandas methods whose results only contain values of the calling FlowBy,
+# so the columns it has already normalized remain normalized
+NORMALIZED_METHODS = ['copy', 'take', 'sort_values', 'sort_index']
+
+
+def normalize_nulls(data: pd.DataFrame, fields: dict,
+                    string_null=np.nan) -> None:
+    """
+    Fill nulls in data, in place, with a single pass over each field:
+    numeric fields are filled with 0, and nulls or null strings ('nan',
+    '<NA>', 'None', '') in text fields are replaced with string_null.
+    Integer columns are skipped, and only the categories of categorical
+    columns are checked.
+    :param data: DataFrame containing all of fields
+    :param fields: dict, dtype of each field, as in flowby_config.yaml
+    :param string_null: value for missing text
+    """
+    for field, dtype in fields.items():
+        column = data[field]
+        if dtype in ['int', 'float']:
+            if column.dtype.kind in 'iub':
+                continue
+            null = column.isna()
+            fill = 0
+        elif (isinstance(column.dtype, pd.CategoricalDtype)
+              and column.cat.categories.dtype == 'object'
+              and string_null is np.nan):
+            categories = column.cat.categories
+            null_categories = categories[categories.isin(NULL_STRINGS)]
+            if len(null_categories):
+                data[field] = column.cat.remove_categories(null_categories)
+            continue
+        elif column.dtype == 'object':
+            # NaN is left in place when it is already the fill value
+            null = column.isin(NULL_VALUES if string_null is not np.nan
+                               else [*NULL_STRINGS, pd.NA, None])
+            fill = string_null
+        else:
+            null = column.isna() | column.isin(NULL_STRINGS)
+            fill = string_null
+        if null.any():
+            values = column.to_numpy(dtype='object', copy=True)
+            values[null.to_numpy()] = fill
+            data[field] = values
+
+
+def _listify_values(fields: dict) -> dict:
+    """Wrap scalar values of selection or exclusion fields in a list"""
+    return {k: [v] if not isinstance(v, (list, dict)) else v
+            for k, v in fields.items()}
+
+
+def _codes(values) -> np.ndarray:
+    """Integer codes of values, with all nulls sharing one code"""
+    codes, uniques = pd.factorize(values)
+    codes[codes < 0] = len(uniques)
+    return codes
+
+
+def _pair_codes(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Integer codes of the pairs of integer codes in a and b"""
+    return _codes(a.astype(np.int64) * (b.max(initial=0) + 1) + b)
+
+
+def _nunique_by(groups: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    For each element, the number of unique values (integer codes) in its
+    group, equivalent to groupby(groups)[values].transform('nunique').
+    """
+    width = values.max(initial=0) + 1
+    groups_with_value = np.unique(groups.astype(np.int64) * width + values)
+    return np.bincount(groups_with_value // width,
+                       minlength=groups.max(initial=-1) + 1)[groups]
+
+
+def _key_index(
+    left: pd.DataFrame,
+    right: pd.DataFrame,
+    left_on: List[str],
+    right_on: List[str]
+) -> tuple:
+    """
+    Index of the rows of right with the key of each row of left. The keys
+    of both frames are factorized together into integers, and the rows of
+    right are indexed in the layout of a CSR (key x row) matrix: the rows
+    with key k, in their original order, are rows[start[k]:start[k + 1]].
+    Rows of left with a key not in right are given the last key, which has
+    no rows. Nulls match nulls, as in pandas merges.
+    :return: tuple of (key of each row of left, start, rows)
+    """
+    keys = np.zeros(len(left) + len(right), dtype=np.int64)
+    for lcol, rcol in zip(left_on, right_on):
+        codes = _codes(pd.concat([left[lcol], right[rcol]],
+                                 ignore_index=True))
+        keys = keys * (codes.max(initial=0) + 1) + codes
+        if keys.max(initial=0) > len(keys):
+            keys = _codes(keys)
+    unique_keys, right_keys = np.unique(keys[len(left):], return_inverse=True)
+    lookup = np.full(keys.max(initial=0) + 1, len(unique_keys))
+    lookup[unique_keys] = np.arange(len(unique_keys))
+    start = np.concatenate(
+        [[0], np.cumsum(np.bincount(right_keys,
+                                    minlength=len(unique_keys) + 1))])
+    return (lookup[keys[:len(left)]], start,
+            np.argsort(right_keys, kind='stable'))
+
+
+def _left_join(
+    left: '_FlowBy',
+    right: pd.DataFrame,
+    key_index: tuple,
+    columns: List[str],
+    fill_value=0
+) -> tuple:
+    """
+    Left join of columns of right onto left, using the key index from
+    _key_index(). Gives the same result as left.merge(right, how='left',
+    suffixes=[None, '_other']) restricted to those columns: columns also in
+    left are suffixed with '_other', and a row of left is repeated for each
+    row of right with its key. Unless fill_value is None, it replaces nulls
+    in FlowAmount_other. When no key matches more than one row of right,
+    the columns of left are not copied.
+    :return: tuple of (joined FlowBy, row of left of each joined row, or
+        None if the rows of left are unchanged)
+    """
+    left_keys, start, rows = key_index
+    matches = np.diff(start)[left_keys]
+    n_rows = np.maximum(matches, 1)
+    right_rows = np.full(n_rows.sum(), len(right))
+    if (n_rows == 1).all():
+        left_rows = None
+        joined = pd.DataFrame(left).set_axis(pd.RangeIndex(len(left)),
+                                             copy=False)
+        right_rows[matches > 0] = rows[start[left_keys[matches > 0]]]
+    else:
+        left_rows = np.repeat(np.arange(len(left)), n_rows)
+        joined = pd.DataFrame(left).take(left_rows).reset_index(drop=True)
+        matched = np.repeat(matches, n_rows) > 0
+        right_rows[matched] = rows[
+            (np.repeat(start[left_keys], n_rows)
+             + np.arange(len(left_rows))
+             - np.repeat(np.cumsum(n_rows) - n_rows, n_rows))[matched]]
+
+    right = pd.DataFrame(right)[columns].reset_index(drop=True)
+    if (right_rows == len(right)).any():
+        # unmatched rows of left are paired with an all-null row
+        right = right.reindex(np.arange(len(right) + 1))
+    right = right.take(right_rows).reset_index(drop=True)
+    right.columns = [f'{c}_other' if c in left.columns else c
+                     for c in right.columns]
+    if fill_value is not None and 'FlowAmount_other' in right:
+        right['FlowAmount_other'] = (right['FlowAmount_other']
+                                     .fillna(fill_value))
+    for column in right.columns:
+        joined[column] = right[column]
+    return left._constructor(joined._mgr).__finalize__(left), left_rows
+
+
+def _sparse_merge_with_denominator(
+    left: '_FlowBy',
+    right: pd.DataFrame,
+    left_on: List[str],
+    right_on: List[str],
+    distinct_on: List[str] = None
+) -> '_FlowBy':
+    """
+    Sparse matrix implementation of _FlowBy._merge_with_denominator().
+
+    right is encoded as a sparse (key x row) matrix from the key index.
+    Each row of left gets a weight from the FlowAmount of the rows of right
+    with its key, and the denominators are the product of a sparse
+    (group_id x row) indicator matrix with those weights. The merged
+    columns are built with _left_join().
+    """
+    import scipy.sparse
+
+    key_index = _key_index(left, right, left_on, right_on)
+    left_keys, start, rows = key_index
+    key_rows = scipy.sparse.csr_matrix(
+        (np.ones(len(rows)), rows, start),
+        shape=(len(start) - 1, len(right)))
+
+    groups = pd.factorize(left['group_id'])[0]
+    amount = right['FlowAmount'].fillna(0).to_numpy(dtype='float')
+    if distinct_on is None:
+        weights = (key_rows @ amount)[left_keys]
+    else:
+        # only the first row for each group_id and distinct_on is counted,
+        # with the FlowAmount of the first row of right with its key
+        first_row = np.append(rows, len(right))[start[:-1]]
+        weights = np.append(amount, 0)[first_row[left_keys]]
+        counted = np.zeros(len(left))
+        counted[np.unique(
+            reduce(_pair_codes,
+                   [groups + 1] + [_codes(left[c]) for c in distinct_on]),
+            return_index=True)[1]] = 1
+        weights = weights * counted
+    valid = groups >= 0
+    group_rows = scipy.sparse.csr_matrix(
+        (np.ones(valid.sum()), (groups[valid], np.flatnonzero(valid))),
+        shape=(groups.max(initial=-1) + 1, len(left)))
+    denominator = np.append(group_rows @ weights, np.nan)[groups]
+
+    merged, left_rows = _left_join(
+        left, right, key_index,
+        columns=[c for c in right.columns
+                 if c not in [rcol for lcol, rcol in zip(left_on, right_on)
+                              if lcol == rcol]])
+    merged['denominator'] = (denominator if left_rows is None
+                             else denominator[left_rows])
+    return merged
+
+
+def _weighted_columns(
+    data: pd.DataFrame,
+    columns_to_average: List[str]
+) -> dict:
+    """
+    Columns summed when aggregating: FlowAmount and the columns to
+    average, and for each column to average, its sum weighted by
+    FlowAmount ('_{column}_weighted') and the sum of the weights
+    ('_{column}_weights').
+    :return: dict of column name and numpy array
+    """
+    flow = data['FlowAmount'].to_numpy(dtype='float')
+    columns = {'FlowAmount': flow}
+    for c in columns_to_average:
+        values = data[c].to_numpy(dtype='float')
+        columns[c] = values
+        columns[f'_{c}_weighted'] = values * flow
+        columns[f'_{c}_weights'] = flow * ~np.isnan(values)
+    return columns
+
+
+def _factorized_sums(
+    data: pd.DataFrame,
+    columns_to_group_by: List[str],
+    values: dict,
+    sort: bool = True
+) -> pd.DataFrame:
+    """
+    Sum values (dict of column name and numpy array, aligned with data)
+    over the groups of data by columns_to_group_by, as
+    groupby(columns_to_group_by, dropna=False, observed=True).sum(). The
+    columns to group by are factorized once each and combined into a single
+    integer key, and the values are summed with np.bincount. Nulls are
+    summed as 0, and null keys form their own group.
+    :param sort: bool, order the groups as groupby does (by the values of
+        columns_to_group_by, nulls last); otherwise in order of appearance
+    :return: DataFrame of columns_to_group_by and the summed values
+    """
+    keys = np.zeros(len(data), dtype=np.int64)
+    for c in columns_to_group_by:
+        codes = _codes(data[c])
+        keys = keys * (codes.max(initial=0) + 1) + codes
+        if keys.max(initial=0) > len(keys):
+            keys = _codes(keys)
+    keys = _codes(keys)
+    n_groups = keys.max(initial=-1) + 1
+    # first row of each group, which holds the values of its keys
+    first = np.empty(n_groups, dtype=np.int64)
+    first[keys[::-1]] = np.arange(len(keys) - 1, -1, -1)
+
+    aggregated = (pd.DataFrame(data)[columns_to_group_by]
+                  .take(first)
+                  .reset_index(drop=True))
+    for column, column_values in values.items():
+        aggregated[column] = np.bincount(
+            keys, weights=np.nan_to_num(column_values), minlength=n_groups)
+    if sort and n_groups > 1 and columns_to_group_by:
+        ranks = []
+        for c in columns_to_group_by:
+            rank, uniques = pd.factorize(aggregated[c], sort=True)
+            ranks.append(np.where(rank < 0, len(uniques), rank))
+        aggregated = (aggregated
+                      .take(np.lexsort(ranks[::-1]))
+                      .reset_index(drop=True))
+    return aggregated
+
+
+def _weighted_averages(
+    aggregated: pd.DataFrame,
+    columns_to_average: List[str]
+) -> pd.DataFrame:
+    """Replace summed columns to average with their weighted averages"""
+    return (
+        aggregated
+        .assign(**{c: (aggregated[f'_{c}_weighted']
+                       / aggregated[f'_{c}_weights'])
+                   for c in columns_to_average})
+        .drop(columns=([*[f'_{c}_weighted' for c in columns_to_average],
+                        *[f'_{c}_weights' for c in columns_to_average]]))
+    )
+
+
+def aggregate_parquet(
+    paths,
+    columns_to_group_by: List[str],
+    columns_to_average: List[str] = None,
+    retain_zeros: bool = False,
+    batch_rows: int = 1_000_000
+) -> pd.DataFrame:
+    """
+    Aggregate a FlowBy stored as parquet, as aggregate_flowby() would,
+    without loading it into memory at once. Batches of rows are read and
+    summed by group in turn, and the sums are combined whenever they
+    exceed batch_rows rows, so memory use depends on batch_rows and the
+    number of groups rather than the size of the files. Used to aggregate
+    the parts written when attributing in chunks (see flowsa.chunking).
+    :param paths: str or Path, parquet file, or list of parquet files
+        (e.g. the parts of a dataset) with the same columns
+    :param columns_to_group_by: list, names of columns to group by
+    :param columns_to_average: list, names of columns for which an average,
+        weighted by 'FlowAmount', should be calculated
+    :param retain_zeros: bool, if False, rows with a FlowAmount of 0 are
+        dropped before aggregating
+    :param batch_rows: int, number of rows read at a time
+    :return: DataFrame, with aggregated columns
+    """
+    import pyarrow.parquet as pq
+
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    columns_to_average = columns_to_average or []
+    partials, n_rows = [], 0
+    batches = (batch for path in paths
+               for batch in pq.ParquetFile(path).iter_batches(
+                   batch_size=batch_rows,
+                   columns=[*columns_to_group_by, 'FlowAmount',
+                            *columns_to_average]))
+    for batch in batches:
+        data = batch.to_pandas()
+        if not retain_zeros:
+            data = data[data['FlowAmount'] != 0]
+        partials.append(_factorized_sums(
+            data, columns_to_group_by,
+            _weighted_columns(data, columns_to_average), sort=False))
+        n_rows += len(partials[-1])
+        if n_rows > batch_rows and len(partials) > 1:
+            partials = [_combine_sums(partials, columns_to_group_by,
+                                      sort=False)]
+            n_rows = len(partials[0])
+    if not partials:
+        return pd.DataFrame(columns=[*columns_to_group_by, 'FlowAmount',
+                                     *columns_to_average])
+    return _weighted_averages(
+        _combine_sums(partials, columns_to_group_by, sort=True),
+        columns_to_average)
+
+
+def _combine_sums(
+    partials: List[pd.DataFrame],
+    columns_to_group_by: List[str],
+    sort: bool
+) -> pd.DataFrame:
+    """Sum the partial results of _factorized_sums() for the same groups"""
+    combined = pd.concat(partials, ignore_index=True)
+    return _factorized_sums(
+        combined, columns_to_group_by,
+        {c: combined[c].to_numpy(dtype='float') for c in combined
+         if c not in columns_to_group_by},
+        sort=sort)
+
+
+# Fields that attribution carries unchanged. Unless used by attribute_on or
+# fill_columns, they are set aside while flows are attributed and
+# re-attached, by group_id, afterwards.
+PASSTHROUGH_FIELDS = [*schema.dq_fields, 'Description', 'LocationSystem',
+                      'Year', 'FlowName', 'Compartment', 'FlowUUID',
+                      'SectorSourceName']
+
+
+def _passthrough_columns(fb: pd.DataFrame, config: dict) -> List[str]:
+    """
+    Columns of fb (with a group_id column) that can be set aside while it
+    is attributed: PASSTHROUGH_FIELDS not needed by the attribution step,
+    which have a single value within each group_id. Returns no columns
+    unless pruning is enabled (see prune_columns_enabled()).
+    """
+    if not prune_columns_enabled(config) or len(fb) == 0:
+        return []
+    fill_columns = config.get('fill_columns') or []
+    needed = {*(config.get('attribute_on') or []),
+              *([fill_columns] if isinstance(fill_columns, str)
+                else fill_columns)}
+    candidates = [c for c in PASSTHROUGH_FIELDS
+                  if c in fb and c not in needed]
+    if not candidates:
+        return []
+    group_id = fb['group_id'].to_numpy(dtype='int')
+    first = np.empty(group_id.max() + 1, dtype=np.int64)
+    first[group_id[::-1]] = np.arange(len(fb) - 1, -1, -1)
+    first_row = first[group_id]
+    passthrough = []
+    for c in candidates:
+        codes = _codes(fb[c])
+        if (codes[first_row] == codes).all():
+            passthrough.append(c)
+    return passthrough
+
+
+def _set_aside(fb: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """Values of columns for each group_id of fb, indexed by group_id"""
+    return (pd.DataFrame(fb)[['group_id', *columns]]
+            .drop_duplicates('group_id')
+            .set_index('group_id'))
+
+
+def _reattach(
+    fb: FB,
+    side: pd.DataFrame,
+    column_order: List[str]
+) -> FB:
+    """
+    Add the columns set aside by _set_aside() back to fb by group_id, each
+    after the column that preceded it in column_order. Columns are inserted
+    rather than concatenated, so the columns of fb are not copied.
+    """
+    rows = side.index.get_indexer(fb['group_id'])
+    reattached = pd.DataFrame(fb).copy(deep=False)
+    for c in column_order:
+        if c not in side:
+            continue
+        values = side[c].array.take(rows)
+        if c in reattached:
+            reattached[c] = values
+            continue
+        preceding = [x for x in column_order[:column_order.index(c)]
+                     if x in reattached]
+        reattached.insert(reattached.columns.get_loc(preceding[-1]) + 1
+                          if preceding else 0, c, values)
+    return fb._constructor(reattached._mgr).__finalize__(fb)
+
+
+class _FlowByLocIndexer(_LocIndexer):
+    def __setitem__(self, key, value) -> None:
+        self.obj._forget_normalized()
+        super().__setitem__(key, value)
+
+
+class _FlowByiLocIndexer(_iLocIndexer):
+    def __setitem__(self, key, value) -> None:
+        self.obj._forget_normalized()
+        super().__setitem__(key, value)
+
+
 class _FlowBy(pd.DataFrame):
-    _metadata = ['full_name', 'config']
+    _metadata = ['full_name', 'config', '_normalized']
 
     full_name: str
     config: dict
+    _normalized: frozenset
+    # ^^^ Columns whose nulls have already been normalized by the FlowBy
+    #     constructor. They are skipped when the FlowBy is passed to a
+    #     FlowBy constructor again, unless modified in the meantime.
 
     def __init__(
         self,
@@ -104,7 +722,8 @@ class _FlowBy(pd.DataFrame):
         '''
         Extends pandas DataFrame. Attaches metadata if provided as kwargs and
         ensures that all columns described in  flowby_config.yaml are present
-        and of the correct datatype.
+        and of the correct datatype. Text columns are stored according to
+        the dtype profile in the config (see get_dtype_profile()).
 
         All args and kwargs not specified above or in FBA/FBS metadata are
         passed to the DataFrame constructor.
@@ -124,28 +743,34 @@ class _FlowBy(pd.DataFrame):
                 )
 
         if isinstance(data, pd.DataFrame) and fields is not None:
+            normalized = (getattr(data, '_normalized', None) or frozenset()
+                          if string_null is np.nan else frozenset())
+            # ^^^ Columns already normalized by a FlowBy constructor
+            data = pd.DataFrame(data)
             if add_missing_columns:
-                data = data.assign(**{field: None
-                                      for field in fields
-                                      if field not in data.columns})
+                missing = {field: 0 if dtype in ['int', 'float']
+                           else string_null
+                           for field, dtype in fields.items()
+                           if field not in data.columns}
+                data = data.assign(**missing)
+                normalized = normalized.union(missing)
             else:
                 fields = {k: v for k, v in fields.items() if k in data.columns}
-
-            fill_na_dict = {
-                field: 0 if dtype in ['int', 'float'] else string_null
-                for field, dtype in fields.items()
-            }
-            null_string_dict = {
-                field: {null: string_null
-                        for null in ['nan', '<NA>', 'None', '',
-                                     np.nan, pd.NA, None]}
-                for field, dtype in fields.items() if dtype == 'object'
-            }
-
-            data = (data
-                    .fillna(fill_na_dict)
-                    .replace(null_string_dict)
-                    .astype(fields))
+                data = data.copy()
+
+            normalize_nulls(
+                data,
+                {k: v for k, v in fields.items() if k not in normalized},
+                string_null)
+            dtypes = {field: dtype for field, dtype
+                      in profile_dtypes(fields,
+                                        get_dtype_profile(self.config)).items()
+                      if data[field].dtype != dtype}
+            if dtypes:
+                data = data.astype(dtypes)
+            super().__setattr__('_normalized',
+                                normalized.union(fields)
+                                if string_null is np.nan else frozenset())
 
         if isinstance(data, pd.DataFrame) and column_order is not None:
             data = data[[c for c in column_order if c in data.columns]
@@ -180,6 +805,15 @@ class _FlowBy(pd.DataFrame):
                 object.__setattr__(self, attribute,
                                    getattr(other.left, attribute, None))
 
+        # Only results made up of values of a normalized FlowBy are known to
+        # be normalized; concat is handled below
+        if method in NORMALIZED_METHODS:
+            self._forget_normalized(
+                (getattr(self, '_normalized', None) or frozenset())
+                .difference(self.columns))
+        elif method != 'concat':
+            self._forget_normalized()
+
         # When concatenating, use shared portion of full_name or config. For
         # other attributes, use metadata from the first FlowBy
         if method == 'concat':
@@ -198,14 +832,78 @@ class _FlowBy(pd.DataFrame):
                 if all(v == getattr(x, 'config', {}).get(k)
                        for x in other.objs[1:])
             }
+            _normalized = frozenset.intersection(
+                *[getattr(x, '_normalized', None) or frozenset()
+                  for x in other.objs])
             object.__setattr__(self, 'full_name', _full_name)
             object.__setattr__(self, 'config', _config)
+            object.__setattr__(self, '_normalized', _normalized)
             for attribute in [x for x in self._metadata
-                              if x not in ['full_name', 'config']]:
+                              if x not in ['full_name', 'config',
+                                           '_normalized']]:
                 object.__setattr__(self, attribute,
                                    getattr(other.objs[0], attribute, None))
         return self
 
+    def _forget_normalized(self, columns: list = None) -> None:
+        """
+        Called before data are modified in place, so that the modified
+        columns (or all columns, if not given) are normalized again the next
+        time the FlowBy is passed to a FlowBy constructor.
+        """
+        normalized = getattr(self, '_normalized', None) or frozenset()
+        object.__setattr__(self, '_normalized',
+                           frozenset() if columns is None
+                           else normalized.difference(columns))
+
+    def __setitem__(self, key, value) -> None:
+        if isinstance(key, list):
+            self._forget_normalized(key)
+        elif pd.api.types.is_hashable(key):
+            self._forget_normalized([key])
+        else:
+            self._forget_normalized()
+        super().__setitem__(key, value)
+
+    def insert(self, loc, column, *args, **kwargs) -> None:
+        self._forget_normalized([column])
+        super().insert(loc, column, *args, **kwargs)
+
+    def _update_inplace(self, result, **kwargs) -> None:
+        # methods called with inplace=True
+        self._forget_normalized()
+        super()._update_inplace(result, **kwargs)
+
+    def _set_value(self, *args, **kwargs) -> None:
+        # .at and .iat
+        self._forget_normalized()
+        super()._set_value(*args, **kwargs)
+
+    def _iset_item_mgr(self, loc, *args, **kwargs) -> None:
+        # columns replaced by position, e.g. by replace(inplace=True)
+        columns = self.columns[loc]
+        self._forget_normalized(columns if isinstance(columns, pd.Index)
+                                else [columns])
+        super()._iset_item_mgr(loc, *args, **kwargs)
+
+    def _maybe_cache_changed(self, item, value, *args, **kwargs) -> None:
+        # a column modified in place through the Series returned by fb[item]
+        self._forget_normalized([item])
+        super()._maybe_cache_changed(item, value, *args, **kwargs)
+
+    def _set_axis(self, axis, labels) -> None:
+        if self._get_axis_number(axis) == 1:
+            self._forget_normalized()
+        super()._set_axis(axis, labels)
+
+    @property
+    def loc(self) -> _FlowByLocIndexer:
+        return _FlowByLocIndexer('loc', self)
+
+    @property
+    def iloc(self) -> _FlowByiLocIndexer:
+        return _FlowByiLocIndexer('iloc', self)
+
     @property
     def source_name(self) -> str:
         return self.full_name.split('.', maxsplit=1)[0]
@@ -217,7 +915,8 @@ class _FlowBy(pd.DataFrame):
     @property
     def groupby_cols(self) -> List[str]:
         return [x for x in self
-                if self[x].dtype in ['int', 'object', 'int32', 'int64']
+                if (self[x].dtype in ['int', 'int32', 'int64']
+                    or is_text_dtype(self[x].dtype))
                 and x not in ['Description', 'group_id']]
 
     @classmethod
@@ -444,42 +1143,85 @@ class _FlowBy(pd.DataFrame):
         '''
         if skip_select_by:
             return self
-        exclusion_fields = (exclusion_fields or
-                            self.config.get('exclusion_fields', {}))
-        exclusion_fields = {k: [v] if not isinstance(v, (list, dict)) else v
-                            for k, v in exclusion_fields.items()}
+        exclusion_fields = _listify_values(
+            exclusion_fields or self.config.get('exclusion_fields', {}))
+        selection_fields = (selection_fields
+                            or self.config.get('selection_fields'))
+
+        if selection_fields is None or selection_fields == 'null':
+            keep = self._selection_mask(None, exclusion_fields)
+            return self if keep.all() else self[keep]
+
+        selection_fields = _listify_values(selection_fields)
+        col_types = [k for k in ['Activity', 'Sector']
+                     if f'Primary{k}' in selection_fields]
+        fb = self._add_primary_columns(col_types)
+        return (fb
+                .take(np.flatnonzero(
+                    fb._selection_mask(selection_fields, exclusion_fields)))
+                ._finish_selection(
+                    selection_fields,
+                    ['PrimaryActivity', 'PrimarySector',
+                     *[f'Secondary{k}' for k in col_types]]))
+
+    def _add_primary_columns(self: FB, col_types: List[str]) -> FB:
+        """Add Primary... columns, as used for selection, for col_types"""
+        if not col_types:
+            return self
+        return self.assign(**{
+            f'Primary{k}':
+                self.add_primary_secondary_columns(k)[f'Primary{k}']
+            for k in col_types})
+
+    def _selection_mask(
+        self: FB,
+        selection_fields: dict,
+        exclusion_fields: dict
+    ) -> np.ndarray:
+        """
+        Boolean mask of the rows kept by select_by_fields(), built from
+        isin() lookups without copying the data. Values of selection_fields
+        and exclusion_fields are lists or dicts, and any Primary... columns
+        selected on must already be present.
+        """
+        keep = np.ones(len(self), dtype=bool)
         for field, values in exclusion_fields.items():
             if field == 'conditional':
-                qry = ' & '.join(
-                    ["({} in {})".format(
-                        k, [v] if not isinstance(v, (list,dict)) else v)
-                        for k, v in exclusion_fields['conditional'].items()]
-                    )
-                self = self.query(f'~({qry})')
+                keep &= ~np.logical_and.reduce(
+                    [self[k].isin([v] if not isinstance(v, (list, dict))
+                                  else v).to_numpy()
+                     for k, v in values.items()])
             else:
                 if field not in self:
                     log.warning(f'{field} not found, can not apply '
                                 'exclusion_fields')
                 else:
-                    self = self.query(f'{field} not in @values')
-
-        selection_fields = (selection_fields
-                            or self.config.get('selection_fields'))
-
-        if selection_fields is None or selection_fields == 'null':
-            return self
+                    keep &= ~self[field].isin(values).to_numpy()
 
-        selection_fields = {k: [v] if not isinstance(v, (list, dict)) else v
-                            for k, v in selection_fields.items()}
+        for field, values in (selection_fields or {}).items():
+            check_values = ([*values.keys(), *values.values()]
+                            if isinstance(values, dict) else values)
+            if field in ['Activity', 'Sector']:
+                keep &= (self[f'{field}ProducedBy'].isin(check_values)
+                         .to_numpy()
+                         | self[f'{field}ConsumedBy'].isin(check_values)
+                         .to_numpy())
+            else:
+                keep &= self[field].isin(check_values).to_numpy()
+        return keep
 
-        if 'PrimaryActivity' in selection_fields:
-            self = (self
-                    .add_primary_secondary_columns('Activity')
-                    .drop(columns='SecondaryActivity'))
-        if 'PrimarySector' in selection_fields:
-            self = (self
-                    .add_primary_secondary_columns('Sector')
-                    .drop(columns='SecondarySector'))
+    def _finish_selection(
+        self: FB,
+        selection_fields: dict,
+        drop_cols: List[str]
+    ) -> FB:
+        """
+        Apply the replacements given in selection_fields to the rows selected
+        by select_by_fields(). The calling FlowBy must be a new FlowBy, taken
+        from the data being selected from, as it is modified in place.
+        """
+        if self.empty:
+            log.warning(f'{self.full_name} FBA is empty')
 
         special_fields = {
             k: v for k, v in selection_fields.items()
@@ -489,27 +1231,11 @@ class _FlowBy(pd.DataFrame):
             k: v for k, v in selection_fields.items()
             if k not in ['Activity', 'Sector']
         }
-
-        filtered_fb = self
-        for field, values in special_fields.items():
-            check_values = ([*values.keys(), *values.values()]
-                            if isinstance(values, dict) else values)
-            filtered_fb = filtered_fb.query(
-                f'{field}ProducedBy in @check_values '
-                f'| {field}ConsumedBy in @check_values'
-            )
-        for field, values in other_fields.items():
-            check_values = ([*values.keys(), *values.values()]
-                            if isinstance(values, dict) else values)
-            filtered_fb = filtered_fb.query(f'{field} in @check_values')
-
-        if filtered_fb.empty:
-            log.warning(f'{filtered_fb.full_name} FBA is empty')
-
         for k in ['Activity', 'Sector']:
             if isinstance(other_fields.get(f'Primary{k}'), dict):
                 if isinstance(special_fields.get(k), dict):
-                    special_fields[k].update(other_fields.pop(f'Primary{k}'))
+                    special_fields[k] = {**special_fields[k],
+                                         **other_fields.pop(f'Primary{k}')}
                 else:
                     special_fields[k] = other_fields.pop(f'Primary{k}')
 
@@ -522,19 +1248,21 @@ class _FlowBy(pd.DataFrame):
                if isinstance(v, dict)}
         }
 
-        replaced_fb = (
-            filtered_fb
-            .replace(replace_dict)
-            .drop(columns=['PrimaryActivity', 'PrimarySector'],
-                  errors='ignore')
-            .reset_index(drop=True)
-        )
+        # replacements are only made in the affected columns
+        fb = self
+        for k, v in replace_dict.items():
+            if k in fb:
+                fb[k] = fb[k].replace(v)
+        drop_cols = [c for c in drop_cols if c in fb]
+        if drop_cols:
+            fb = fb.drop(columns=drop_cols)
+        fb.index = pd.RangeIndex(len(fb))
         # Reset blank values to nan
         for k in replace_dict.keys():
-            if all(replaced_fb[k] == ''):
-                replaced_fb[k] = np.nan
+            if (fb[k] == '').all():
+                fb[k] = np.nan
 
-        return replaced_fb
+        return fb
 
     def aggregate_flowby(
             self: FB,
@@ -582,29 +1310,36 @@ class _FlowBy(pd.DataFrame):
         if len(self) == 0:
             log.warning('Error, dataframe is empty')
             return self
-        aggregated = (
-            fb
-            .assign(**{f'_{c}_weighted': fb[c] * fb.FlowAmount
-                    for c in columns_to_average},
-                    **{f'_{c}_weights': fb.FlowAmount * fb[c].notnull()
-                    for c in columns_to_average})
-            .groupby(columns_to_group_by, dropna=False)
-            .agg(sum)
-            .reset_index()
-        )
-        aggregated = (
-            aggregated
-            .assign(**{c: (aggregated[f'_{c}_weighted']
-                           / aggregated[f'_{c}_weights'])
-                       for c in columns_to_average})
-            .drop(columns=([*[f'_{c}_weighted' for c in columns_to_average],
-                            *[f'_{c}_weights' for c in columns_to_average]]))
-        )
-        aggregated = aggregated.astype(
+        if get_aggregation_engine(self.config) == 'factorized':
+            aggregated = fb._constructor(_factorized_sums(
+                fb, columns_to_group_by,
+                _weighted_columns(fb, columns_to_average))).__finalize__(fb)
+        else:
+            aggregated = (
+                fb
+                .assign(**{f'_{c}_weighted': fb[c] * fb.FlowAmount
+                        for c in columns_to_average},
+                        **{f'_{c}_weights': fb.FlowAmount * fb[c].notnull()
+                        for c in columns_to_average})
+                .groupby(columns_to_group_by, dropna=False, observed=True)
+                .agg(sum)
+                .reset_index()
+            )
+        aggregated = _weighted_averages(aggregated, columns_to_average)
+        return self._restore_aggregated(aggregated, self['FlowAmount'].sum())
+
+    def _restore_aggregated(self: FB, aggregated: FB, flow_total: float) -> FB:
+        """
+        Finish the aggregation of the calling FlowBy: cast the aggregated
+        columns back to FlowBy dtypes, reset group totals, and check that
+        the total FlowAmount (flow_total before aggregating) is unchanged.
+        """
+        aggregated = aggregated.astype(profile_dtypes(
             {column: type for column, type
              in set([*flowby_config['all_fba_fields'].items(),
                      *flowby_config['all_fbs_fields'].items()])
-             if column in aggregated}
+             if column in aggregated},
+            get_dtype_profile(self.config))
         )
         # ^^^ Need to convert back to correct dtypes after aggregating;
         #     otherwise, columns of NaN will become float dtype.
@@ -615,7 +1350,7 @@ class _FlowBy(pd.DataFrame):
                 'FlowAmount'])
 
         # check flowamounts equal after aggregating
-        self_flow = self['FlowAmount'].sum()
+        self_flow = flow_total
         agg_flow = aggregated['FlowAmount'].sum()
         percent_diff = int(((agg_flow - self_flow) * 100) / self_flow)
         if percent_diff > 0:
@@ -625,15 +1360,53 @@ class _FlowBy(pd.DataFrame):
 
         return aggregated
 
-    def attribute_flows_to_sectors(
+    def attribute_and_aggregate(
         self: FB,
+        columns_to_drop: List[str] = None,
         external_config_path: str = None,
         download_sources_ok: bool = True
+    ) -> FB:
+        """
+        Attribute the flows of the calling FBA to sectors, drop
+        columns_to_drop, and aggregate the result.
+
+        If the config sets attribution_chunks and the FBA does not fit the
+        memory budget, it is attributed in chunks, and the attributed chunks
+        are aggregated from parquet part files rather than combined in
+        memory (see flowsa.chunking).
+        :param columns_to_drop: list, columns to drop before aggregating
+        """
+        by = chunking.chunk_type(self.config)
+        if by is not None:
+            chunks = chunking.plan_chunks(
+                self, by, chunking.memory_budget(self.config))
+            if len(chunks) > 1:
+                return chunking.attribute_in_chunks(
+                    self, chunks, columns_to_drop or [],
+                    external_config_path=external_config_path,
+                    download_sources_ok=download_sources_ok)
+        return (
+            self
+            .attribute_flows_to_sectors(
+                external_config_path=external_config_path,
+                download_sources_ok=download_sources_ok)
+            .drop(columns=columns_to_drop or [])
+            .aggregate_flowby()
+        )
+
+    def attribute_flows_to_sectors(
+        self: FB,
+        external_config_path: str = None,
+        download_sources_ok: bool = True,
+        validation_totals: dict = None
     ) -> FB:
         """
         The calling FBA has its activities mapped to sectors, then its flows
         attributed to those sectors, by the methods specified in the calling
         FBA's configuration dictionary.
+        :param validation_totals: dict, if given, the FlowAmount before and
+            after each attribution step is added to it, by step, instead of
+            logging the percent change (used when attributing in chunks)
         """
 
         from flowsa.flowbyactivity import FlowByActivity
@@ -712,6 +1485,17 @@ class _FlowBy(pd.DataFrame):
             else:
                 fb = fb.assign(AttributionSources=attribution_name)
 
+            # columns not used by attribution are set aside and re-attached
+            # after, so they are not carried through the merges with the
+            # attribution source
+            passthrough = (_passthrough_columns(fb, fb.config)
+                           if attribution_method in planner.LOADING_METHODS
+                           else [])
+            if passthrough:
+                column_order = list(fb.columns)
+                side = _set_aside(fb, passthrough)
+                fb = fb.drop(columns=passthrough)
+
             if attribution_method == 'proportional':
                 log.info(f"Proportionally attributing {self.full_name} to "
                          f"target sectors with {attribution_name}")
@@ -777,6 +1561,9 @@ class _FlowBy(pd.DataFrame):
                              f"target sectors.")
                     attributed_fb = fb.equally_attribute()
 
+            if passthrough:
+                attributed_fb = _reattach(attributed_fb, side, column_order)
+
             # depending on att method, check that new df values equal
             # original df values
             if validate and attribution_method not in [
@@ -802,13 +1589,12 @@ class _FlowBy(pd.DataFrame):
                          .drop_duplicates())['group_total'].sum()
                 attsum = (validation_fb[['group_id', 'validation_total']]
                           .drop_duplicates())['validation_total'].sum()
-                percent_change = round(((attsum - fbsum)/fbsum)*100,3)
-                if percent_change == 0:
-                    log.info(f"No change in {self.full_name} FlowAmount after "
-                             "attribution.")
+                if validation_totals is None:
+                    chunking.log_percent_change(self.full_name, fbsum, attsum)
                 else:
-                    log.warning(f"Percent change in {self.full_name} after "
-                                f"attribution is {percent_change}%")
+                    totals = validation_totals.setdefault(index, [0, 0])
+                    totals[0] += fbsum
+                    totals[1] += attsum
 
             # run function to clean fbs after attribution
             attributed_fb = attributed_fb.function_socket(
@@ -841,49 +1627,84 @@ class _FlowBy(pd.DataFrame):
             return [self]
 
         log.info(f'Splitting {self.full_name} into activity sets')
+        child_df_list = []
+        for child_df in self.partition_activity_sets():
+            if not child_df.empty:
+                child_df_list.append(child_df)
+            else:
+                log.error(f'Activity set {child_df.full_name} is empty. '
+                          'Check activity set definition!')
+        return child_df_list
+
+    def partition_activity_sets(self: FB) -> List[FB]:
+        '''
+        Split the calling FlowBy into one FlowBy per activity set in its
+        config, including empty activity sets, as select_by_fields() would
+        for each activity set.
+
+        The selection and exclusion masks of all activity sets are evaluated
+        on the calling FlowBy in one pass. The number of activity sets
+        matching each row identifies rows assigned to multiple activity sets
+        (logged as critical, as they are double-counted) or to none, and each
+        activity set is then taken from the calling FlowBy once.
+        '''
         activities = self.config['activity_sets']
         parent_config = {k: v for k, v in self.config.items()
                          if k not in ['activity_sets',
                                       'clean_fba_before_activity_sets']
                          and not k.startswith('_')}
-        parent_df = self.reset_index().rename(columns={'index': 'row'})
+        selections = {}
+        for activity_set, activity_config in activities.items():
+            selection_fields = (activity_config.get('selection_fields')
+                                or self.config.get('selection_fields'))
+            selections[activity_set] = (
+                None if selection_fields in [None, 'null']
+                else _listify_values(selection_fields),
+                _listify_values(activity_config.get('exclusion_fields')
+                                or self.config.get('exclusion_fields', {})))
+
+        col_types = [k for k in ['Activity', 'Sector']
+                     if any(f'Primary{k}' in (selection or {})
+                            for selection, _ in selections.values())]
+        parent = self._add_primary_columns(col_types)
+        added_cols = [f'Primary{k}' for k in col_types
+                      if f'Primary{k}' not in self]
+
+        assigned = np.column_stack(
+            [parent._selection_mask(selection, exclusion)
+             for selection, exclusion in selections.values()]
+            or [np.zeros(len(self), dtype=bool)])
+        set_count = assigned.sum(axis=1)
+        if (set_count > 1).any():
+            log.critical(f"Some rows from {self.full_name} assigned "
+                         f"to multiple activity sets. This will lead to "
+                         f"double-counting:"
+                         f"\n{self[set_count > 1]}")
+            # raise ValueError('Some rows in multiple activity sets')
+        if (set_count == 0).any():
+            log.warning(f'Some rows from {self.full_name} not assigned '
+                        f'to an activity set. Is this intentional?')
 
         child_df_list = []
-        assigned_rows = set()
-        for activity_set, activity_config in activities.items():
+        for i, (activity_set, (selection, _)) in enumerate(
+                selections.items()):
             log.info(f'Creating subset for {activity_set}')
-
-            child_df = (
-                parent_df
-                .add_full_name(
-                    f'{parent_df.full_name}{NAME_SEP_CHAR}{activity_set}')
-                .select_by_fields(
-                    selection_fields=activity_config.get('selection_fields'),
-                    exclusion_fields=activity_config.get('exclusion_fields'))
-            )
-
-            child_df.config = {**parent_config, **activity_config}
-            child_df = child_df.assign(SourceName=child_df.full_name)
-
-            if set(child_df.row) & assigned_rows:
-                log.critical(f"Some rows from {parent_df.full_name} assigned "
-                             f"to multiple activity sets. This will lead to "
-                             f"double-counting:"
-                             f"\n{child_df.query(f'row in {list(set(child_df.row) & assigned_rows)}')}")
-                # raise ValueError('Some rows in multiple activity sets')
-
-            assigned_rows.update(child_df.row)
-            if not child_df.empty:
-                child_df_list.append(child_df.drop(columns='row'))
+            rows = np.flatnonzero(assigned[:, i])
+            child_df = parent.take(rows)
+            child_df.full_name = (f'{self.full_name}{NAME_SEP_CHAR}'
+                                  f'{activity_set}')
+            child_df.config = {**parent_config, **activities[activity_set]}
+            if selection is None:
+                child_df.index = pd.Index(rows)
+                child_df = child_df.drop(columns=added_cols)
             else:
-                log.error(f'Activity set {child_df.full_name} is empty. '
-                          'Check activity set definition!')
-
-        if set(parent_df.row) - assigned_rows:
-            log.warning(f'Some rows from {parent_df.full_name} not assigned '
-                        f'to an activity set. Is this intentional?')
-            unassigned = parent_df.query('row not in @assigned_rows')
-
+                child_df = child_df._finish_selection(
+                    selection,
+                    ['PrimaryActivity', 'PrimarySector',
+                     *[f'Secondary{k}' for k in col_types
+                       if f'Primary{k}' in selection]])
+            child_df['SourceName'] = child_df.full_name
+            child_df_list.append(child_df)
         return child_df_list
 
     def load_prepare_attribution_source(
@@ -916,17 +1737,14 @@ class _FlowBy(pd.DataFrame):
             attribution_fbs = attribution_fbs.prepare_fbs(
                 download_sources_ok=download_sources_ok)
         else:
-            attribution_fbs = get_flowby_from_config(
+            attribution_fbs = load_prepare_source(
                 name=name,
-                config={**{k: v for k, v in self.config.items()
-                           if k in self.config['method_config_keys']
-                           or k == 'method_config_keys'},
-                        **get_catalog_info(name),
-                        **config},
+                config=planner.subsource_config(self.config, name, config),
                 download_sources_ok=download_sources_ok
-            ).prepare_fbs(download_sources_ok=download_sources_ok)
+            )
 
-        return attribution_fbs
+        # when attributing in chunks, only the chunk's states are needed
+        return chunking.filter_to_chunk(attribution_fbs, self.config)
 
     def harmonize_geoscale(
         self: 'FB',
@@ -985,6 +1803,83 @@ class _FlowBy(pd.DataFrame):
 
         return fb_geoscale, other_geoscale, fb, other
 
+    def join_other(
+        self: FB,
+        other: 'FlowBySector',
+        columns: List[str],
+        left_on: List[str] = None,
+        right_on: List[str] = None,
+        fill_value=0
+    ) -> FB:
+        """
+        Left join columns of other (an FBS, harmonized with
+        harmonize_geoscale()) onto self, as used when attributing self
+        using other. Rows are matched on integer codes of the keys rather
+        than by merging on the key columns, and only the given columns of
+        other are carried. Columns also in self are suffixed with '_other'.
+        :param other: FlowBy to join
+        :param columns: list, columns of other to carry
+        :param left_on: list, key columns of self, by default PrimarySector
+            and temp_location (if present) or Location
+        :param right_on: list, key columns of other, by default
+            PrimarySector and Location
+        :param fill_value: value for FlowAmount_other in rows of self
+            without a match, or None to leave them null
+        :return: FlowBy with the rows of self (repeated for each matching
+            row of other) and the joined columns
+        """
+        if left_on is None:
+            left_on = ['PrimarySector',
+                       'temp_location' if 'temp_location' in self
+                       else 'Location']
+        if right_on is None:
+            right_on = ['PrimarySector', 'Location']
+        return _left_join(self, other,
+                          _key_index(self, other, left_on, right_on),
+                          columns, fill_value)[0]
+
+    def _merge_with_denominator(
+        self: FB,
+        other: 'FlowBySector',
+        left_on: List[str],
+        right_on: List[str],
+        distinct_on: List[str] = None
+    ) -> FB:
+        """
+        Left merge other onto self (suffixing overlapping columns of other
+        with '_other') and add the denominator used for proportional
+        attribution: the sum of FlowAmount_other in each group_id. If
+        distinct_on is given, each combination of group_id and distinct_on
+        is only counted once.
+
+        Uses the attribution engine set in the config (see
+        get_attribution_engine()).
+        """
+        if get_attribution_engine(self.config) == 'sparse':
+            return _sparse_merge_with_denominator(self, other, left_on,
+                                                  right_on, distinct_on)
+
+        merged = (
+            self
+            .merge(other,
+                   how='left',
+                   left_on=left_on,
+                   right_on=right_on,
+                   suffixes=[None, '_other'])
+            .fillna({'FlowAmount_other': 0})
+        )
+        if distinct_on is not None:
+            denominator_flag = ~merged.duplicated(subset=['group_id',
+                                                          *distinct_on])
+            weighted = merged.assign(FlowAmount_other=(merged.FlowAmount_other
+                                                       * denominator_flag))
+        else:
+            weighted = merged
+        return merged.assign(denominator=(weighted
+                                          .groupby('group_id')
+                                          ['FlowAmount_other']
+                                          .transform('sum')))
+
     def proportionally_attribute(
         self: 'FB',  # flowbyactivity or flowbysector
         other: 'FlowBySector'
@@ -1021,30 +1916,14 @@ class _FlowBy(pd.DataFrame):
                     .drop(columns='group_count')
                 )
 
-                merged = (
-                    needs_attribution
-                    .merge(other,
-                           how='left',
-                           left_on=[f'{rank}Sector',
-                                    'temp_location'
-                                    if 'temp_location' in needs_attribution
-                                    else 'Location'],
-                           right_on=['PrimarySector', 'Location'],
-                           suffixes=[None, '_other'])
-                    .fillna({'FlowAmount_other': 0})
-                )
-
-                denominator_flag = ~merged.duplicated(subset=[*groupby_cols,
-                                                      f'{rank}Sector'])
-                with_denominator = (
-                    merged
-                    .assign(denominator=(
-                        merged
-                        .assign(FlowAmount_other=(merged.FlowAmount_other
-                                                  * denominator_flag))
-                        .groupby(groupby_cols)
-                        ['FlowAmount_other']
-                        .transform('sum')))
+                with_denominator = needs_attribution._merge_with_denominator(
+                    other,
+                    left_on=[f'{rank}Sector',
+                             'temp_location'
+                             if 'temp_location' in needs_attribution
+                             else 'Location'],
+                    right_on=['PrimarySector', 'Location'],
+                    distinct_on=[f'{rank}Sector']
                 )
 
                 non_zero_denominator = with_denominator.query(f'denominator != 0 ')
@@ -1099,22 +1978,8 @@ class _FlowBy(pd.DataFrame):
             for l in (left_on, right_on):
                 if 'Location' in self.config.get('fill_columns', []):
                     l.remove('Location')
-            merged = (
-                fb
-                .merge(other,
-                       how='left',
-                       left_on=left_on,
-                       right_on=right_on,
-                       suffixes=[None, '_other'])
-                .fillna({'FlowAmount_other': 0})
-            )
-
-            merged_with_denominator = (
-                merged
-                .assign(denominator=(merged
-                        .groupby('group_id')['FlowAmount_other']
-                        .transform('sum')))
-            )
+            merged_with_denominator = fb._merge_with_denominator(
+                other, left_on=left_on, right_on=right_on)
 
             non_zero_denominator = merged_with_denominator.query(f'denominator != 0 ')
             unattributable = merged_with_denominator.query(f'denominator == 0 ')
@@ -1189,26 +2054,16 @@ class _FlowBy(pd.DataFrame):
         fb_geoscale, other_geoscale, fb, other = self.harmonize_geoscale(
             other)
 
+        fill_col = self.config.get('fill_columns')
+        columns = ['FlowAmount', 'Unit'] + ([fill_col] if fill_col else [])
         if self.config.get('attribute_on') is not None:
-            left_merge = self.config['attribute_on']
-            right_merge = self.config['attribute_on']
+            merged = fb.join_other(other, columns,
+                                   left_on=self.config['attribute_on'],
+                                   right_on=self.config['attribute_on'])
         else:
-            left_merge = ['PrimarySector', 'temp_location'
-                                  if 'temp_location' in fb
-                                  else 'Location']
-            right_merge = ['PrimarySector', 'Location']
-
-        # multiply using each dfs primary sector col
-        merged = (fb
-                  .merge(other,
-                         how='left',
-                         left_on=left_merge,
-                         right_on=right_merge,
-                         suffixes=[None, '_other'])
-                  .fillna({'FlowAmount_other': 0})
-                  )
+            # multiply using each dfs primary sector col
+            merged = fb.join_other(other, columns)
 
-        fill_col = self.config.get('fill_columns')
         if fill_col is not None:
             log.info(f'Replacing {fill_col} values in primary data source '
                      f'with those from attribution source.')
@@ -1217,8 +2072,7 @@ class _FlowBy(pd.DataFrame):
         fb = (merged
               .assign(FlowAmount=lambda x: (x.FlowAmount
                                             * x.FlowAmount_other))
-              .drop(columns=['PrimarySector_other', 'Location_other',
-                             'FlowAmount_other', 'denominator'],
+              .drop(columns=['FlowAmount_other', 'denominator'],
                     errors='ignore')
               )
 
@@ -1288,22 +2142,12 @@ class _FlowBy(pd.DataFrame):
             other)
 
         # divide using each dfs primary sector col
-        merged = (fb
-                  .merge(other,
-                         how='left',
-                         left_on=['PrimarySector', 'temp_location'
-                                  if 'temp_location' in fb
-                                  else 'Location'],
-                         right_on=['PrimarySector', 'Location'],
-                         suffixes=[None, '_other'])
-                  .fillna({'FlowAmount_other': 0})
-                  )
+        merged = fb.join_other(other, ['FlowAmount', 'Unit'])
 
         fb = (merged
               .assign(FlowAmount=lambda x: (x.FlowAmount
                                             / x.FlowAmount_other))
-              .drop(columns=['PrimarySector_other', 'Location_other',
-                             'FlowAmount_other', 'denominator'],
+              .drop(columns=['FlowAmount_other', 'denominator'],
                     errors='ignore')
               )
 
@@ -1359,38 +2203,51 @@ class _FlowBy(pd.DataFrame):
         """
         naics_key = naics.map_target_sectors_to_less_aggregated_sectors(
             self.config['industry_spec'], self.config['target_naics_year'])
+        naics_cols = [f'_naics_{n}' for n in range(2, 8)]
+        # integer codes of the NAICS levels of each row of naics_key, with a
+        # final row of nulls for sectors that are not in naics_key
+        key_codes = {col: _codes(np.append(naics_key[col].to_numpy(
+                         dtype='object'), None))
+                     for col in naics_cols}
+        key_rows = pd.DataFrame({'target_naics': naics_key.target_naics,
+                                 '_key_row': np.arange(len(naics_key))})
 
         fba = self.add_primary_secondary_columns('Sector')
 
-        groupby_cols = ['group_id', 'Location']
+        # Each row is repeated for every row of naics_key matching its
+        # sector, as in a left merge. The number of unique sectors at each
+        # NAICS level, within each group_id and Location (and primary
+        # sector, for secondary sectors), is then counted on integer codes.
+        rows = np.arange(len(fba))
+        amount = fba.FlowAmount.to_numpy(dtype='float')
+        groups = (fba.groupby(['group_id', 'Location'], dropna=False,
+                              sort=False)
+                  .ngroup().to_numpy())
         for rank in ['Primary', 'Secondary']:
-            fba = (
-                fba
-                .merge(naics_key, how='left', left_on=f'{rank}Sector',
+            sectors = fba[f'{rank}Sector']
+            expanded = (
+                pd.DataFrame({'_row': np.arange(len(rows)),
+                              'sector': sectors.to_numpy()[rows]})
+                .merge(key_rows, how='left', left_on='sector',
                        right_on='target_naics')
-                .assign(
-                    **{f'_unique_naics_{n}_by_group': lambda x, i=n: (
-                            x.groupby(groupby_cols if i == 2
-                                      else [*groupby_cols, f'_naics_{i-1}'],
-                                      dropna=False)
-                            [[f'_naics_{i}']]
-                            .transform('nunique', dropna=False)
-                        )
-                        for n in range(2, 8)},
-                    FlowAmount=lambda x: reduce(
-                        lambda x, y: x / y,
-                        [x.FlowAmount, *[x[f'_unique_naics_{n}_by_group']
-                                         for n in range(2, 8)]]
-                    )
-                )
-                .drop(columns=naics_key.columns.values.tolist())
             )
-            groupby_cols.append(f'{rank}Sector')
-
-        return fba.drop(
-            columns=['PrimarySector', 'SecondarySector',
-                     *[f'_unique_naics_{n}_by_group' for n in range(2, 8)]]
-        )
+            expand = expanded['_row'].to_numpy()
+            key_row = (expanded['_key_row'].fillna(len(naics_key))
+                       .to_numpy(dtype='int'))
+            rows, amount, groups = rows[expand], amount[expand], groups[expand]
+            parents = groups
+            for col in naics_cols:
+                level = key_codes[col][key_row]
+                amount = amount / _nunique_by(parents, level)
+                parents = _pair_codes(groups, level)
+            groups = _pair_codes(groups, _codes(sectors)[rows])
+
+        fba = self.take(rows)
+        fba['FlowAmount'] = amount
+        fba.index = pd.RangeIndex(len(fba))
+        drop_cols = [c for c in ['PrimarySector', 'SecondarySector']
+                     if c in fba]
+        return fba.drop(columns=drop_cols) if drop_cols else fba
 
     def add_primary_secondary_columns(
         self: FB,
@@ -1444,34 +2301,30 @@ class _FlowBy(pd.DataFrame):
                 )
 
             else:
+                produced = self[f'{col_type}ProducedBy']
+                consumed = self[f'{col_type}ConsumedBy']
+                if (isinstance(produced.dtype, pd.CategoricalDtype)
+                        and isinstance(consumed.dtype, pd.CategoricalDtype)):
+                    # values are exchanged between the two columns below
+                    categories = produced.cat.categories.union(
+                        consumed.cat.categories)
+                    produced = produced.cat.set_categories(categories)
+                    consumed = consumed.cat.set_categories(categories)
+                consumed_is_primary = (
+                    ((self.FlowType == 'TECHNOSPHERE_FLOW')
+                     | (produced.isna())
+                     | (produced.isin(['22', '221', '2213', '22131', '221310'])
+                        & consumed.isin(['F010', 'F0100', 'F01000'])))
+                    & consumed.notna()
+                )
+                # The secondary column is whichever of ...ProducedBy and
+                # ...ConsumedBy is not primary (null if only one is given)
                 fb = self.assign(
                     **{f'Primary{col_type}':
-                        self[f'{col_type}ProducedBy'].mask(
-                            ((self.FlowType == 'TECHNOSPHERE_FLOW')
-                             | (self[f'{col_type}ProducedBy'].isna())
-                             | (self[f'{col_type}ProducedBy'].isin(
-                                 ['22', '221', '2213', '22131', '221310']
-                             )
-                             & self[f'{col_type}ConsumedBy'].isin(
-                                 ['F010', 'F0100', 'F01000']
-                             )))
-                            & self[f'{col_type}ConsumedBy'].notna(),
-                            self[f'{col_type}ConsumedBy']
-                        )
-                       }
-                )
-
-                def _identify_secondary(row: _FlowBySeries) -> str:
-                    sectors = [row[f'{col_type}ProducedBy'],
-                               row[f'{col_type}ConsumedBy']]
-                    sectors.remove(row[f'Primary{col_type}'])
-                    return sectors[0]
-
-                fb = fb.assign(
-                    **{f'Secondary{col_type}': (
-                        fb.apply(_identify_secondary, axis='columns')
-                        # ^^^ Applying with axis='columns' applies TO each row.
-                        .astype('object'))}
+                        produced.mask(consumed_is_primary, consumed),
+                       f'Secondary{col_type}':
+                        consumed.mask(consumed_is_primary, produced)
+                        .astype('object')}
                 )
 
             return fb
@@ -1482,10 +2335,15 @@ class _FlowBy(pd.DataFrame):
         return fb
 
     def to_parquet(self: FB, *args, **kwargs) -> None:
-        pd.DataFrame(self).to_parquet(*args, **kwargs)
+        df = pd.DataFrame(self)
+        df.astype({c: 'object' for c in df.columns
+                   if is_text_dtype(df[c].dtype) and df[c].dtype != 'object'}
+                  ).to_parquet(*args, **kwargs)
         # ^^^ For some reason, the extra features of a FlowBy stop the
         #     to_parquet method inherited from DatFrame from working, so this
         #     casts the data back to plain DataFrame to write to a parquet.
+        #     Text columns are written as object regardless of dtype profile
+        #     so that files are the same for all profiles.
 
     def astype(self: FB, *args, **kwargs) -> FB:
         '''
@@ -1501,9 +2359,13 @@ class _FlowBy(pd.DataFrame):
         column names back properly). This function fixes the problem by making
         it so DataFrame.astype() is not called by a FlowBy dataframe, but
         instead by a plain pd.DataFrame.
+
+        As the result is passed through the FlowBy constructor, text columns
+        of the FlowBy fields are returned in the config's dtype profile.
         '''
         metadata = {attribute: self.__getattr__(attribute)
-                    for attribute in self._metadata}
+                    for attribute in self._metadata
+                    if attribute != '_normalized'}
         df = pd.DataFrame(self).astype(*args, **kwargs)
         fb = type(self)(df, add_missing_columns=False, **metadata)
 
@@ -20,11 +20,11 @@ import pandas as pd
 
 import flowsa.exceptions
 from flowsa import settings, metadata, geo, validation, naics, common, \
-    sectormapping, generateflowbyactivity
+    sectormapping, generateflowbyactivity, parallel
 from flowsa.flowsa_log import log
 from flowsa.settings import DEFAULT_DOWNLOAD_IF_MISSING
 from flowsa.flowbyfunctions import filter_by_geoscale
-from flowsa.flowby import _FlowBy, flowby_config, NAME_SEP_CHAR
+from flowsa.flowby import _FlowBy, flowby_config
 
 if TYPE_CHECKING:
     from flowsa.flowbysector import FlowBySector
@@ -463,16 +463,10 @@ class FlowByActivity(_FlowBy):
                     'Sector'].isin(sectors[f"NAICS_{self.config['target_naics_year']}_Code"].values)]
 
                 # drop parent sectors
-                existing_sectors_df = pd.DataFrame([])
-                for i in existing_sectors['Sector']:
-                    n = existing_sectors[
-                        existing_sectors['Sector'].apply(
-                            lambda x: x[0:len(str(i))] == i)]
-                    if len(n) == 1:
-                        existing_sectors_df = pd.concat(
-                            [existing_sectors_df, n])
-                existing_sectors_list = existing_sectors_df[
-                    'Sector'].values.tolist()
+                existing_sectors_list = existing_sectors['Sector'][
+                    naics.NAICSHierarchy(existing_sectors['Sector'])
+                    .leaf_filter(existing_sectors['Sector'])
+                ].values.tolist()
 
                 activity_to_target_naics_crosswalk = (
                     naics_key
@@ -518,7 +512,8 @@ class FlowByActivity(_FlowBy):
                     if self.config.get('sector_hierarchy') == 'parent-incompleteChild':
                         # add descendants column
                         fba_w_naics = drop_parentincompletechild_descendants(
-                            fba_w_naics, sector_col=f'Sector{direction}')
+                            fba_w_naics, sector_col=f'Sector{direction}',
+                            activity_col=f'Activity{direction}')
         else:
             log.info('Getting crosswalk between activities in %s and '
                      'NAICS codes.', self.full_name)
@@ -592,20 +587,17 @@ class FlowByActivity(_FlowBy):
                     ['Activity', 'Sector']]
 
                 # create list of sectors that exist in original df, which,
-                # if created when expanding sector list cannot be added
-                naics_df = pd.DataFrame([])
-                for i in existing_sectors['Activity'].unique():
-                    existing_sectors_sub = existing_sectors[
-                        existing_sectors['Activity'] == i]
-                    for j in existing_sectors_sub['Sector']:
-                        dig = len(str(j))
-                        n = existing_sectors[
-                            existing_sectors['Sector'].str.startswith(j)]
-                        if len(n) == 1:
-                            expanded_n = naics_key[naics_key['source_naics']
-                                                   == j]
-                            expanded_n = expanded_n.assign(Activity=i)
-                            naics_df = pd.concat([naics_df, expanded_n])
+                # if created when expanding sector list cannot be added.
+                # Only sectors without descendants in the crosswalk are
+                # expanded.
+                naics_df = (
+                    existing_sectors
+                    [naics.NAICSHierarchy(existing_sectors['Sector'])
+                     .leaf_filter(existing_sectors['Sector'])]
+                    .merge(naics_key, left_on='Sector',
+                           right_on='source_naics')
+                    [['source_naics', 'target_naics', 'Activity']]
+                )
 
                 activity_to_target_naics_crosswalk = (
                     activity_to_source_naics_crosswalk
@@ -705,20 +697,24 @@ class FlowByActivity(_FlowBy):
 
         if 'activity_sets' in self.config:
             try:
+                # activity sets are independent of one another, so may be
+                # run concurrently if requested in the method yaml
                 return (
-                    pd.concat([
-                        fba.prepare_fbs(
+                    pd.concat(parallel.ordered_map(
+                        partial(
+                            parallel.call_method,
+                            method='prepare_fbs',
                             external_config_path=external_config_path,
                             download_sources_ok=download_sources_ok,
                             skip_select_by=True,
-                            retain_activity_columns=retain_activity_columns)
-                        for fba in (
-                            self
-                            .select_by_fields()
-                            .function_socket('clean_fba_before_activity_sets')
-                            .activity_sets()
-                        )
-                    ])
+                            retain_activity_columns=retain_activity_columns),
+                        (self
+                         .select_by_fields()
+                         .function_socket('clean_fba_before_activity_sets')
+                         .activity_sets()),
+                        **parallel.get_executor_settings(
+                            self.config, 'activity_set_executor')
+                    ))
                     .reset_index(drop=True)
                 )
             except ValueError:
@@ -736,10 +732,10 @@ class FlowByActivity(_FlowBy):
             .convert_units_and_flows()  # and also map to flow lists
             .function_socket('clean_fba')
             .convert_to_geoscale()
-            .attribute_flows_to_sectors(external_config_path=external_config_path,
-                                        download_sources_ok=download_sources_ok)  # recursive call to prepare_fbs
-            .drop(columns=drop_cols)
-            .aggregate_flowby()
+            .attribute_and_aggregate(columns_to_drop=drop_cols,
+                                     external_config_path=external_config_path,
+                                     download_sources_ok=download_sources_ok)
+            # ^^^ recursive call to prepare_fbs
             .function_socket('clean_fbs_after_aggregation')
         )
 
@@ -758,54 +754,15 @@ class FlowByActivity(_FlowBy):
             return [self]
 
         log.info('Splitting %s into activity sets', self.full_name)
-        activities = self.config['activity_sets']
-        parent_config = {k: v for k, v in self.config.items()
-                         if k not in ['activity_sets',
-                                      'clean_fba_before_activity_sets']
-                         and not k.startswith('_')}
-        parent_fba = self.reset_index().rename(columns={'index': 'row'})
-
         child_fba_list = []
-        assigned_rows = set()
-        for activity_set, activity_config in activities.items():
-            log.info('Creating FlowByActivity for %s', activity_set)
-
-            child_fba = (
-                parent_fba
-                .add_full_name(
-                    f'{parent_fba.full_name}{NAME_SEP_CHAR}{activity_set}')
-                .select_by_fields(
-                    selection_fields=activity_config.get('selection_fields'),
-                    exclusion_fields=activity_config.get('exclusion_fields'))
-            )
-
-            child_fba.config = {**parent_config, **activity_config}
-            child_fba = child_fba.assign(SourceName=child_fba.full_name)
-
-            if set(child_fba.row) & assigned_rows:
-                log.critical(
-                    'Some rows from %s assigned to multiple activity '
-                    'sets. This will lead to double-counting:\n%s',
-                    parent_fba.full_name,
-                    child_fba.query(
-                        f'row in {list(set(child_fba.row) & assigned_rows)}'
-                    )
-                )
-                # raise ValueError('Some rows in multiple activity sets')
-
-            assigned_rows.update(child_fba.row)
+        for child_fba in self.partition_activity_sets():
             if ((not child_fba.empty) and
-                len(child_fba.query('FlowAmount != 0')) > 0):
-                child_fba_list.append(child_fba.drop(columns='row'))
+                    (child_fba.FlowAmount != 0).any()):
+                child_fba_list.append(child_fba)
             else:
                 log.error(f'Activity set {child_fba.full_name} is empty. '
                           'Check activity set definition!')
 
-        if set(parent_fba.row) - assigned_rows:
-            log.warning('Some rows from %s not assigned to an activity '
-                        'set. Is this intentional?', parent_fba.full_name)
-            unassigned = parent_fba.query('row not in @assigned_rows')
-
         return child_fba_list
 
     def convert_units_and_flows(
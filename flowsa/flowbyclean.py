@@ -5,13 +5,14 @@ from __future__ import annotations
 
 import numpy as np
 import pandas as pd
-from flowsa.flowby import FB, get_flowby_from_config
-from flowsa.common import get_catalog_info
+from flowsa.flowby import FB, load_prepare_source
 from flowsa.flowsa_log import log
+from flowsa.planner import subsource_config
 from flowsa import (geo, location)
 from flowsa.flowbyactivity import FlowByActivity
 from flowsa.flowbysector import FlowBySector
-from flowsa.naics import map_source_sectors_to_more_aggregated_sectors
+from flowsa.naics import (map_source_sectors_to_more_aggregated_sectors,
+                          NAICSHierarchy)
 from flowsa.validation import compare_summation_at_sector_lengths_between_two_dfs
 
 
@@ -47,15 +48,10 @@ def load_prepare_clean_source(
     except AttributeError:
         name, config = self.config['clean_source'], {}
 
-    clean_fbs = get_flowby_from_config(
+    clean_fbs = load_prepare_source(
         name=name,
-        config={**{k: v for k, v in self.config.items()
-                   if k in self.config['method_config_keys']
-                   or k == 'method_config_keys'},
-                **get_catalog_info(name),
-                **config},
-        download_sources_ok=download_sources_ok
-        ).prepare_fbs(download_sources_ok=download_sources_ok)
+        config=subsource_config(self.config, name, config),
+        download_sources_ok=download_sources_ok)
     return clean_fbs
 
 
@@ -77,17 +73,10 @@ def weighted_average(
     fba_geoscale, other_geoscale, fba, other = fba.harmonize_geoscale(
         other)
 
-    # merge dfs
-    merged = (fba
-              .merge(other,
-                     how='left',
-                     left_on=['PrimarySector', 'temp_location'
-                     if 'temp_location' in fba
-                     else 'Location'],
-                     right_on=['PrimarySector', 'Location'],
-                     suffixes=[None, '_other'])
-              .fillna({'FlowAmount_other': fba['FlowAmount']})
-              )
+    # join the weights, using the flow itself where there is no weight
+    merged = fba.join_other(other, ['FlowAmount'], fill_value=None)
+    merged['FlowAmount_other'] = (merged['FlowAmount_other']
+                                  .fillna(merged['FlowAmount']))
     # drop rows where flow is 0
     merged = merged[merged['FlowAmount'] != 0]
     # replace terms
@@ -191,6 +180,140 @@ def substitute_nonexistent_values(
     return merged
 
 
+# sectors reported as ranges of 2-digit sectors
+SECTOR_RANGES = {'31-33': ['31', '32', '33'],
+                 '44-45': ['44', '45'],
+                 '48-49': ['48', '49']}
+
+
+def _sum_to(keys: np.ndarray, other_keys: np.ndarray,
+            values: np.ndarray) -> np.ndarray:
+    """Sum values by other_keys, and return the sum for each of keys"""
+    codes, uniques = pd.factorize(np.concatenate([keys, other_keys]))
+    sums = np.bincount(codes[len(keys):], weights=np.nan_to_num(values),
+                       minlength=len(uniques))
+    return sums[codes[:len(keys)]]
+
+
+def estimate_suppressed_flows(
+        flows: pd.DataFrame,
+        activity_col: str,
+        ancestors: pd.DataFrame = None,
+        sector_ranges: dict = None,
+        residual_levels=(5, 4, 3, 2),
+        fill_levels=(2, 3, 4, 5, 6),
+        group_cols=('FlowName', 'Location'),
+        verify_integrity: bool = False
+) -> np.ndarray:
+    """
+    Estimate suppressed (0 or null) flows of sector-like activities by
+    equally attributing the unattributed flows of parent sectors to their
+    suppressed child sectors.
+
+    First, for each level in residual_levels (most detailed first), the
+    flows of all longer sectors are subtracted from the unattributed flow
+    of the sector they start with (not below 0), and added to its
+    attributed flow. Then, for each level in fill_levels (least detailed
+    first), the unattributed flow of each sector of that length is divided
+    equally among its suppressed children, which get that share plus their
+    attributed flow. Sectors, and their ancestors, are handled as integer
+    codes, so each level is a few grouped array operations within the
+    groups of group_cols.
+    :param flows: df with activity_col, FlowAmount and group_cols
+    :param activity_col: str, column of sector-like activities
+    :param ancestors: df indexed by sector with columns n2, n3, ... of the
+        sector's ancestor (or itself) at each level, as from
+        map_source_sectors_to_more_aggregated_sectors(). Suppressed flows of
+        sectors not in ancestors are not estimated. By default, the first
+        characters of each sector.
+    :param sector_ranges: dict of sector ranges (e.g. '31-33') and the
+        2-digit sectors in each, see SECTOR_RANGES. Ranges are treated as
+        2-digit sectors, and as the parent of sectors in the range.
+    :param verify_integrity: bool, if True, raise a ValueError if flows in
+        the same group have the same sector (or the same ancestors), for
+        which the estimates would be ambiguous
+    :return: np.ndarray, FlowAmount with suppressed flows estimated, or 0
+        where they could not be
+    """
+    sector_ranges = sector_ranges or {}
+    in_range = {code: sector for sector, codes in sector_ranges.items()
+                for code in codes}
+    codes, sectors = pd.factorize(flows[activity_col])
+    sectors = [str(x) for x in sectors]
+    groups = (pd.DataFrame(flows)
+              .groupby(list(group_cols), sort=False)
+              .ngroup().to_numpy())
+    # flows without a sector or group are left as they are
+    length = np.where(groups < 0, 0, np.array(
+        [2 if x in sector_ranges else len(x) for x in sectors] + [0])[codes])
+    n_groups = groups.max(initial=0) + 1
+    # key of the sector and group of each flow
+    own = np.where((codes < 0) | (groups < 0), -1,
+                   codes * n_groups + groups)
+
+    amount = flows['FlowAmount'].to_numpy(dtype='float')
+    unattributed = amount.copy()
+    attributed = np.zeros(len(flows))
+    names = pd.Index(sectors)
+    for level in residual_levels:
+        child = np.flatnonzero(length > level)
+        parents = names.get_indexer(
+            [in_range.get(x[:level], x[:level]) for x in sectors])
+        parents = np.where(parents < 0, len(sectors) + 1, parents)
+        descendant_flows = _sum_to(
+            own, parents[codes[child]] * n_groups + groups[child],
+            unattributed[child])
+        unattributed = unattributed - descendant_flows
+        unattributed[unattributed < 0] = 0
+        attributed = attributed + descendant_flows
+
+    # ancestors of each sector at each level, null if not estimated
+    if ancestors is None:
+        lineage = pd.DataFrame(
+            {f'n{n}': [x if x in sector_ranges else x[:n] for x in sectors]
+             for n in range(2, max(fill_levels) + 1)})
+        lineage['n2'] = lineage['n2'].replace(in_range)
+    else:
+        lineage = (ancestors[~ancestors.index.duplicated()]
+                   .reindex(sectors).reset_index(drop=True))
+    known = np.append(lineage.notna().all(axis='columns').to_numpy(),
+                      False)[codes] & (length > 0)
+    if verify_integrity:
+        lineage_keys, _ = pd.factorize(pd.MultiIndex.from_frame(lineage))
+        keys = pd.Series(lineage_keys[codes[known]] * n_groups
+                         + groups[known])
+        if keys.duplicated().any():
+            duplicates = (pd.DataFrame(flows)[[activity_col, *group_cols]]
+                          [known][keys.duplicated(keep=False).to_numpy()])
+            raise ValueError(f'Flows have duplicate sectors:\n{duplicates}')
+
+    flow_amount = np.where(amount == 0, np.nan, amount)
+    for level in fill_levels:
+        # flows are grouped by their ancestors up to level, and group_cols
+        lineage_keys, _ = pd.factorize(pd.MultiIndex.from_frame(
+            lineage[[f'n{n}' for n in range(2, level + 1)]].fillna('')))
+        key, _ = pd.factorize(np.append(lineage_keys, 0)[codes]
+                              * n_groups + groups)
+        parent = np.flatnonzero(known & (length == level))
+        child = np.flatnonzero(known & (length == level + 1)
+                               & np.isnan(flow_amount))
+        first_parent = np.full(key.max(initial=-1) + 1, -1)
+        first_parent[key[parent][::-1]] = parent[::-1]
+        child = child[first_parent[key[child]] >= 0]
+        n_children = np.bincount(key[child], minlength=len(first_parent))
+        value = (unattributed[first_parent[key[child]]]
+                 / n_children[key[child]])
+        value[value < 0] = 0
+        # as in DataFrame.update(), null estimates are not applied
+        flow_amount[child] = np.where(np.isnan(value + attributed[child]),
+                                      flow_amount[child],
+                                      value + attributed[child])
+        unattributed[child] = np.where(np.isnan(value),
+                                       unattributed[child], value)
+
+    return np.nan_to_num(flow_amount)
+
+
 def estimate_suppressed_sectors_equal_attribution(
         fba: FlowByActivity) -> FlowByActivity:
     """
@@ -235,119 +358,24 @@ def estimate_suppressed_sectors_equal_attribution(
     # only single parent:child
     fba3 = fba.merge(fba2, how='outer')
 
-    fba3 = (fba3
-            .assign(Unattributed=fba3.FlowAmount.copy(),
-                    Attributed=0)
-            .assign(descendants='')
-            )
-
     # drop rows that contain "&" and "-"
+    # todo: All hyphenated sectors are currently dropped, modify code so
+    #  they are not
     fba3 = (fba3
             .query(f"~{col}.str.contains('&')")
             .query(f"~{col}.str.contains('-')")
             )
 
-    for level in [6, 5, 4, 3, 2]:
-        descendants = (
-            fba3
-            .drop(columns='descendants')
-            .query(f'{col}.str.len() > {level}')
-            .assign(
-                parent=lambda x: x[col].str.slice(stop=level)
-            )
-            .groupby(['FlowName', 'Location', 'parent'])
-            .agg({'Unattributed': 'sum', col: ' '.join})
-            .reset_index()
-            .rename(columns={col: 'descendants',
-                             'Unattributed': 'descendant_flows',
-                             'parent': col})
-        )
-        fba3 = (
-            fba3
-            .merge(descendants,
-                   how='left',
-                   on=['FlowName', 'Location', col],
-                   suffixes=(None, '_y'))
-            .fillna({'descendant_flows': 0, 'descendants_y': ''})
-            .assign(
-                descendants=lambda x: x.descendants.mask(x.descendants == '',
-                                                         x.descendants_y),
-                Unattributed=lambda x: (x.Unattributed -
-                                        x.descendant_flows).mask(
-                    x.Unattributed - x.descendant_flows < 0, 0),
-                Attributed=lambda x: (x.Attributed +
-                                      x.descendant_flows)
-            )
-            .drop(columns=['descendant_flows', 'descendants_y'])
-        )
-
-    fba3 = fba3.drop(columns=['descendants'])
-
-    # todo: All hyphenated sectors are currently dropped, modify code so
-    #  they are not
-    fba_m = (
-        fba3
-        .merge(naics_key, how='left', left_on=col,
-               right_on='source_naics')
-        .assign(location=fba3.Location,
-                category=fba3.FlowName)
-        .replace({'FlowAmount': {0: np.nan}  #,
-                  # col: {'1125 & 1129': '112X',
-                  #       '11193 & 11194 & 11199': '1119X',
-                  #       '31-33': '3X',
-                  #       '44-45': '4X',
-                  #       '48-49': '4Y'},
-                  # 'n2': {'31': '3X', '32': '3X', '33': '3X',
-                  #        '44': '4X', '45': '4X',
-                  #        '48': '4Y', '49': '4Y'},
-                  # 'n4': {'1125': '112X', '1129': '112X'},
-                  # 'n5': {'11193': '1119X', '11194': '1119X', '11199': '1119X'}
-                  })
-        .dropna(subset='source_naics')
-        .drop(columns='source_naics')
-    )
-
-    indexed = fba_m.set_index(['n2', 'n3', 'n4', 'n5', 'n6', 'n7',
-                               'location', 'category'], verify_integrity=True)
-
-    def fill_suppressed(
-        flows, level: int, activity
-    ):
-        parent = flows[flows[activity].str.len() == level]
-        children = flows[flows[activity].str.len() == level + 1]
-        null_children = children[children['FlowAmount'].isna()]
-
-        if null_children.empty or parent.empty:
-            return flows
-        else:
-            value = max(parent['Unattributed'][0] / len(null_children), 0)
-            # update the null children by adding the unattributed data to
-            # the attributed data
-            null_children = (
-                null_children
-                .assign(FlowAmount=value+null_children['Attributed'])
-                .assign(Unattributed=value)
-            )
-            flows.update(null_children)
-            return flows
-
-    unsuppressed = indexed.copy()
-    for level in [2, 3, 4, 5, 6]:
-        groupcols = (["{}{}".format("n", i) for i in range(2, level+1)] +
-                     ['location', 'category'])
-        unsuppressed = (unsuppressed
-                        .groupby(level=groupcols)
-                        .apply(fill_suppressed, level, col)
-                        )
-    unsuppressed['Year'] = unsuppressed['Year'].astype('int')
+    flow_amount = estimate_suppressed_flows(
+        fba3, col, ancestors=naics_key.set_index('source_naics'),
+        residual_levels=[6, 5, 4, 3, 2], verify_integrity=True)
+    in_key = fba3[col].isin(naics_key['source_naics']).to_numpy()
     aggregated = (
-        unsuppressed
+        fba3
+        .assign(FlowAmount=flow_amount)
+        [in_key]
         .reset_index(drop=True)
-        .fillna({'FlowAmount': 0})
-        .drop(columns=['Unattributed', 'Attributed'])
-        # .replace({col: {'3X': '31-33',
-        #                 '4X': '44-45',
-        #                 '4Y': '48-49'}})
+        .astype({'Year': 'int'})
         .aggregate_flowby()
     )
 
@@ -479,20 +507,20 @@ def define_parentincompletechild_descendants(
     311221             |  55        |
 
     Additionally, this function adds a column called "descendants", which for
-    each industry holds all the descendant industries or industry groups that
-    have detailed information provided in the dataset. After mapping to
-    industries, but before attribution is performed, this column is used by the
-    drop_parentincompletechild_descendants function to drop any row that is mapped
-    from an aggregated industry group to a less aggregated industry or industry
-    group THAT HAS DETAILED INFORMATION GIVEN IN THE MECS (and therefore has
-    its own row already) to avoid the over-attribution issue.
-    Again using the previous example:
+    each industry holds the number of descendant industries or industry groups
+    that have detailed information provided in the dataset. After mapping to
+    industries, but before attribution is performed, the
+    drop_parentincompletechild_descendants function drops any row with
+    descendants that is mapped from an aggregated industry group to a less
+    aggregated industry or industry group THAT HAS DETAILED INFORMATION GIVEN
+    IN THE MECS (and therefore has its own row already) to avoid the
+    over-attribution issue. Again using the previous example:
 
     ActivityConsumedBy | FlowAmount | descendants | ...
     ---------------------------------------------------
-    311                |  45        | 3112 311221 |
-    3112               |  10        | 311221      |
-    311221             |  55        |             |
+    311                |  45        | 2           |
+    3112               |  10        | 1           |
+    311221             |  55        | 0           |
 
     Note that this function is not useful if the desired aggregation level is
     NAICS-2. In such a case, the MECS dataset can be filtered to include only
@@ -502,83 +530,91 @@ def define_parentincompletechild_descendants(
     fba = (
         fba
         .query(f'{activity_col} != "31-33"')
-        .assign(descendants='')
+        .reset_index(drop=True)
     )
 
+    # codes are numbered, so each level is a sum over integer keys
+    codes, activities = pd.factorize(fba[activity_col])
+    activities = pd.Index([str(x) for x in activities])
+    groups = (fba.groupby(['Flowable', 'Location'], sort=False)
+              .ngroup().to_numpy())
+    n_groups = groups.max(initial=0) + 1
+    length = np.where((codes < 0) | (groups < 0), 0, np.array(
+        [len(x) for x in activities] + [0])[codes])
+    own = np.where(length > 0, codes * n_groups + groups, -1)
+    flow_amount = fba['FlowAmount'].to_numpy(dtype='float')
+    descendants = np.zeros(len(fba), dtype=int)
+
     for level in [5, 4, 3]:
-        descendants = (
-            fba
-            .drop(columns='descendants')
-            .query(f'{activity_col}.str.len() > {level}')
-            .assign(
-                parent=lambda x: x[activity_col].str.slice(stop=level)
-            )
-            .groupby(['Flowable', 'Location', 'parent'])
-            .agg({'FlowAmount': 'sum', activity_col: ' '.join})
-            .reset_index()
-            .rename(columns={activity_col: 'descendants',
-                             'FlowAmount': 'descendant_flows',
-                             'parent': activity_col})
-        )
-
-        fba = (
-            fba
-            .merge(descendants,
-                   how='left',
-                   on=['Flowable', 'Location', activity_col],
-                   suffixes=(None, '_y'))
-            .fillna({'descendant_flows': 0, 'descendants_y': ''})
-            .assign(
-                descendants=lambda x: x.descendants.mask(x.descendants == '',
-                                                         x.descendants_y),
-                FlowAmount=lambda x: (x.FlowAmount -
-                                      x.descendant_flows).mask(
-                    x.FlowAmount - x.descendant_flows < 0, 0)
-            )
-            .drop(columns=['descendant_flows', 'descendants_y'])
-        )
+        child = np.flatnonzero(length > level)
+        parents = activities.get_indexer([x[:level] for x in activities])
+        parents = np.where(parents < 0, len(activities), parents)
+        parent_keys = parents[codes[child]] * n_groups + groups[child]
+        descendant_flows = _sum_to(own, parent_keys, flow_amount[child])
+        flow_amount = flow_amount - descendant_flows
+        flow_amount[flow_amount < 0] = 0
+        descendants[length == level] = _sum_to(
+            own, parent_keys, np.ones(len(child)))[length == level]
+
+    fba = fba.assign(FlowAmount=flow_amount, descendants=descendants)
     # Reset group_total after adjusting for descendents
     fba = (fba
            .drop(columns='group_total')
-           .merge((fba.groupby('group_id')
-                      .agg({'FlowAmount':sum})
-                      .rename(columns={'FlowAmount': 'group_total'})
-                      ),
-                  on='group_id', how='left', validate='m:1')
+           .assign(group_total=(fba.groupby('group_id')['FlowAmount']
+                                .transform('sum')))
            )
 
     return fba
 
 
 def drop_parentincompletechild_descendants(
-        fba: FlowByActivity, sector_col='SectorConsumedBy', **_) -> \
-        FlowByActivity:
+        fba: FlowByActivity, sector_col='SectorConsumedBy',
+        activity_col=None, **_) -> FlowByActivity:
     '''
     This function finishes handling the over-attribution issue described in
     the documentation for define_parentincompletechild_descendants by dropping any row in the
     MECS dataset which has been mapped to an industry or industry group which
-    is a subset (strict or otherwise) of an industry group listed in the
-    descendants columns. So, if 311 and 3112 both appear in the MECS datset,
-    3112 will be listed as a descendant of 311 and this function will therefore
+    is a subset (strict or otherwise) of a descendant industry group, i.e.
+    another activity of the same Flowable and Location which is more
+    detailed. So, if 311 and 3112 both appear in the MECS datset,
+    3112 is a descendant of 311 and this function will therefore
     drop a row mapping 311 to 311221 (since more detailed information on 3112,
     which contains 311221, is provided). If 31122 and 311221 do not appear in
     the dataset, a row mapping 3112 to 311221 will not be dropped, since no
     more detailed information on 311221 is given. Further attribution/
     disaggregation should be done using another datatset such as the QCEW.
+    :param sector_col: str, column of sectors the activities are mapped to
+    :param activity_col: str, column of activities, by default the
+        Activity column of the same direction as sector_col
     '''
-
-    fba2 = (
-        fba
-        .assign(to_keep=fba.apply(
-            lambda x: not any([str(x[sector_col]).startswith(d) for d in
-                               x.descendants.split()]),
-            axis='columns'
-        ))
-        .query('to_keep')
-        .drop(columns=['descendants', 'to_keep'])
-    )
-
-    return fba2
+    if activity_col is None:
+        activity_col = sector_col.replace('Sector', 'Activity')
+    activities = fba[activity_col].to_numpy(dtype='object')
+    sectors = fba[sector_col].to_numpy(dtype='object')
+    groups = (fba.groupby(['Flowable', 'Location'], sort=False)
+              .ngroup().to_numpy())
+    hierarchy = NAICSHierarchy(np.concatenate([activities, sectors]))
+    activity_nodes = hierarchy.node(activities)
+    # activities of each Flowable and Location
+    known = np.unique((groups * len(hierarchy) + activity_nodes)
+                      [(groups >= 0) & (activity_nodes >= 0)])
+
+    # a row is dropped if a more detailed activity of its group contains
+    # its sector, looking at each level between the activity and sector
+    rows = np.flatnonzero((fba['descendants'].fillna(0).to_numpy() > 0)
+                          & hierarchy.is_descendant(sectors, activities))
+    activity_length = hierarchy.length[activity_nodes[rows]]
+    sector_length = hierarchy.length[hierarchy.node(sectors[rows])]
+    dropped = np.zeros(len(fba), dtype=bool)
+    for level in range(activity_length.min(initial=0) + 1,
+                       sector_length.max(initial=0) + 1):
+        candidate = (activity_length < level) & (sector_length >= level)
+        descendant = hierarchy.node(hierarchy.ancestors_at_level(
+            sectors[rows[candidate]], level))
+        dropped[rows[candidate]] |= (descendant >= 0) & np.isin(
+            groups[rows[candidate]] * len(hierarchy) + descendant, known)
+
+    return fba[~dropped].drop(columns='descendants')
 
 
 def proxy_sector_data(
@@ -8,12 +8,17 @@ defined in this file are specific to FBS data.
 # to circular reasoning
 from __future__ import annotations
 
+import time
+from functools import partial
 import esupy.processed_data_mgmt
 import pandas as pd
 from pandas import ExcelWriter
-from flowsa import settings, metadata, common, exceptions, geo, naics
+from flowsa import settings, metadata, common, exceptions, geo, naics, \
+    parallel, planner
+from flowsa import cache as intermediate_cache
 from flowsa.common import get_catalog_info, load_crosswalk
-from flowsa.flowby import _FlowBy, flowby_config, get_flowby_from_config
+from flowsa.flowby import _FlowBy, flowby_config, get_flowby_from_config, \
+    load_prepare_source
 from flowsa.flowbyfunctions import collapse_fbs_sectors
 from flowsa.settings import DEFAULT_DOWNLOAD_IF_MISSING
 from flowsa.flowsa_log import reset_log_file, log
@@ -121,6 +126,7 @@ class FlowBySector(_FlowBy):
             download_sources_ok: bool = settings.DEFAULT_DOWNLOAD_IF_MISSING,
             retain_activity_columns: bool = False,
             append_sector_names=False,
+            incremental: bool = None,
             **kwargs
     ) -> 'FlowBySector':
         '''
@@ -131,6 +137,11 @@ class FlowBySector(_FlowBy):
         :param download_fba_ok: bool, optional. Whether to attempt to download
             source data FlowByActivity files from EPA server rather than
             generating them.
+        :param incremental: bool, optional. If True, reuse the stored FBS of
+            each source in source_names whose fingerprint is unchanged since
+            the last run, and only rebuild the others. Defaults to the
+            method yaml key `incremental` or the FLOWSA_INCREMENTAL
+            environment variable.
         :kwargs: keyword arguments to pass to load_yaml_dict(). Possible kwargs
             include config.
         '''
@@ -146,7 +157,43 @@ class FlowBySector(_FlowBy):
                         method)
 
         method_config['cache'] = {}
+        # Plan the method, so that attribution and clean sources used more
+        # than once (with the same config) are prepared only once
+        method_plan = planner.build_plan(method, method_config, to_cache)
+        log.info('%s', method_plan)
+        method_config['cache'].update(method_plan.cache_placeholders())
+
+        # In incremental mode, reuse the stored FBS of unchanged sources. Only
+        # cached and shared sources used by the remaining sources are needed.
+        if incremental is None:
+            incremental = intermediate_cache.incremental(method_config)
+        fingerprints = {}
+        fragments = {}
+        needed = None
+        if incremental:
+            for source_name, node_id in method_plan.sources.items():
+                fingerprints[source_name] = (
+                    intermediate_cache.source_fingerprint(method_plan,
+                                                          node_id))
+                fragment = (intermediate_cache.load_fragment(
+                    method, source_name, fingerprints[source_name])
+                    if fingerprints[source_name] else None)
+                if fragment is not None:
+                    fragments[source_name] = fragment
+            log.info('Incremental generation of %s: reusing %s of %s '
+                     'sources %s', method, len(fragments),
+                     len(method_plan.sources), list(fragments.keys()))
+            needed = set().union(*[
+                method_plan.descendants(node_id)
+                for source_name, node_id in method_plan.sources.items()
+                if source_name not in fragments])
+
         for source_name, config in to_cache.items():
+            if needed is not None and (method_plan.cached[source_name]
+                                       not in needed):
+                log.info('%s is not used by any changed source, skipping',
+                         source_name)
+                continue
             method_config['cache'][source_name] = (
                 get_flowby_from_config(
                     name=source_name,
@@ -167,26 +214,53 @@ class FlowBySector(_FlowBy):
             #     so that later entries in method_config['sources_to_cache']
             #     can make use of the cached copy of an earlier entry.
 
-        # Generate FBS from method_config
+        # Generate FBS from method_config. Sources are independent of one
+        # another (cached sources are already built and are only read), so
+        # may be prepared concurrently if requested in the method yaml
         sources = method_config.pop('source_names')
-
-        fbs = pd.concat([
-            get_flowby_from_config(
-                name=source_name,
-                config={
-                    **method_config,
-                    'method_config_keys': set(method_config.keys()),
-                    **get_catalog_info(source_name),
-                    **config
-                },
-                external_config_path=external_config_path,
-                download_sources_ok=download_sources_ok
-            ).prepare_fbs(external_config_path=external_config_path,
-                          download_sources_ok=download_sources_ok,
-                          retain_activity_columns=retain_activity_columns
-                          )
-            for source_name, config in sources.items()
-        ])
+        to_prepare = {k: v for k, v in sources.items() if k not in fragments}
+
+        # Prepare any remaining shared sources up front, so that concurrently
+        # prepared sources use the same copy
+        for node_id in method_plan.shared_nodes():
+            if (method_config['cache'][node_id] is None
+                    and (needed is None or node_id in needed)):
+                load_prepare_source(
+                    name=method_plan.names[node_id],
+                    config=method_plan.configs[node_id],
+                    download_sources_ok=download_sources_ok)
+
+        prepared = parallel.ordered_map(
+            partial(_prepare_source,
+                    method_config=method_config,
+                    external_config_path=external_config_path,
+                    download_sources_ok=download_sources_ok,
+                    retain_activity_columns=retain_activity_columns),
+            to_prepare.items(),
+            **parallel.get_executor_settings(method_config, 'source_executor')
+        )
+        if to_prepare:
+            log.info('Time to prepare each source for %s:\n%s', method,
+                     pd.DataFrame({'source': list(to_prepare.keys()),
+                                   'seconds': [round(t, 1)
+                                               for _, t in prepared]}
+                                  ).to_string(index=False))
+        prepared = dict(zip(to_prepare.keys(),
+                            [source_fbs for source_fbs, _ in prepared]))
+        if incremental:
+            for source_name, source_fbs in prepared.items():
+                # input files generated during this run are now available
+                fingerprint = (fingerprints[source_name]
+                               or intermediate_cache.source_fingerprint(
+                                   method_plan,
+                                   method_plan.sources[source_name]))
+                if fingerprint:
+                    intermediate_cache.save_fragment(
+                        source_fbs, method, source_name, fingerprint)
+        fbs = pd.concat([fragments[source_name]
+                         if source_name in fragments
+                         else prepared[source_name]
+                         for source_name in sources])
 
         fbs.full_name = method
         fbs.config = method_config
@@ -288,14 +362,12 @@ class FlowBySector(_FlowBy):
         if 'activity_sets' in self.config:
             try:
                 return (
-                    pd.concat([
-                        fbs.prepare_fbs()
-                        for fbs in (
-                            self
-                            .select_by_fields()
-                            .activity_sets()
-                        )
-                    ])
+                    pd.concat(parallel.ordered_map(
+                        partial(parallel.call_method, method='prepare_fbs'),
+                        self.select_by_fields().activity_sets(),
+                        **parallel.get_executor_settings(
+                            self.config, 'activity_set_executor')
+                    ))
                     .reset_index(drop=True)
                 )
             except ValueError:
@@ -305,9 +377,10 @@ class FlowBySector(_FlowBy):
             .function_socket('clean_fbs')
             .select_by_fields()
             .convert_fips_to_geoscale()
-            .attribute_flows_to_sectors(external_config_path=external_config_path,
-                                        download_sources_ok=download_sources_ok)
-            .aggregate_flowby()  # necessary after consolidating geoscale
+            .attribute_and_aggregate(
+                external_config_path=external_config_path,
+                download_sources_ok=download_sources_ok)
+            # ^^^ aggregating is necessary after consolidating geoscale
         )
 
 
@@ -382,6 +455,41 @@ class FlowBySector(_FlowBy):
         return table_dict
 
 
+def _prepare_source(
+        source: tuple,
+        method_config: dict,
+        external_config_path: str = None,
+        download_sources_ok: bool = True,
+        retain_activity_columns: bool = False
+) -> tuple:
+    """
+    Load and prepare a single entry of an FBS method's source_names. Module
+    level so that it can be sent to a worker process.
+    :param source: tuple, (source name, source config)
+    :param method_config: dict, FBS method config, without source_names
+    :return: tuple, (prepared FlowBySector, wall time in seconds)
+    """
+    source_name, config = source
+    start = time.perf_counter()
+    fbs = get_flowby_from_config(
+        name=source_name,
+        config={
+            **method_config,
+            'method_config_keys': set(method_config.keys()),
+            **get_catalog_info(source_name),
+            **config
+        },
+        external_config_path=external_config_path,
+        download_sources_ok=download_sources_ok
+    ).prepare_fbs(external_config_path=external_config_path,
+                  download_sources_ok=download_sources_ok,
+                  retain_activity_columns=retain_activity_columns
+                  )
+    seconds = time.perf_counter() - start
+    log.info('Prepared %s in %.1f seconds', source_name, seconds)
+    return fbs, seconds
+
+
 """
 The three classes extending pd.Series, together with the _constructor...
 methods of each class, are required for allowing pandas methods called on
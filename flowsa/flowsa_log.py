@@ -1,6 +1,11 @@
+import contextvars
 import logging
 import shutil
 import sys
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
 from esupy.processed_data_mgmt import mkdir_if_missing
 from .settings import logoutputpath
 
@@ -72,6 +77,65 @@ vlog = logging.getLogger('flowsa.validation')
 vlog.setLevel(logging.DEBUG)
 vlog.addHandler(validation_file_handler)
 
+# log file handler of the dataset being generated by the current thread
+_thread_log = threading.local()
+# id of the thread_log_file() context records are logged in. Thread pools
+# started within the context run their tasks in a copy of it (see
+# fetch._ordered_fetch() and parallel.ordered_map()), so that their records
+# are written to the dataset's log file too.
+_log_context = contextvars.ContextVar('flowsa_log_context', default=None)
+
+
+class _ContextFilter(logging.Filter):
+    """Pass only the records logged within one thread_log_file() context"""
+    def __init__(self, context: str):
+        super().__init__()
+        self.context = context
+
+    def filter(self, record):
+        return _log_context.get() == self.context
+
+
+def _get_thread_log_file_handler(name, level=logging.INFO):
+    h = get_log_file_handler(name, level)
+    h.addFilter(_ContextFilter(_log_context.get()))
+    return h
+
+
+@contextmanager
+def thread_log_file(name):
+    """
+    Also write the records logged within this context to their own log
+    file, so that datasets generated concurrently (e.g. the years of an
+    FBA) each get a complete log, while flowsa.log holds all records.
+    Records of threads started within the context are included if the
+    threads run in a copy of it (contextvars.copy_context()), as the thread
+    pools of flowsa.fetch and flowsa.parallel do; records of worker
+    processes are only written to flowsa.log. Within the context,
+    reset_log_file() renames and resets this file instead of flowsa.log.
+    Validation records are likewise written to <name>_validation.log. The
+    files are removed on exit.
+    :param name: str, log file name
+    """
+    validation_name = f'{Path(name).stem}_validation.log'
+    token = _log_context.set(uuid.uuid4().hex)
+    _thread_log.handler = _get_thread_log_file_handler(name)
+    _thread_log.vhandler = _get_thread_log_file_handler(validation_name,
+                                                        logging.DEBUG)
+    log.addHandler(_thread_log.handler)
+    vlog.addHandler(_thread_log.vhandler)
+    try:
+        yield
+    finally:
+        log.removeHandler(_thread_log.handler)
+        vlog.removeHandler(_thread_log.vhandler)
+        _thread_log.handler.close()
+        _thread_log.vhandler.close()
+        _thread_log.handler = _thread_log.vhandler = None
+        _log_context.reset(token)
+        (logoutputpath / name).unlink(missing_ok=True)
+        (logoutputpath / validation_name).unlink(missing_ok=True)
+
 
 def reset_log_file(filename, fb_meta):
     """
@@ -80,8 +144,11 @@ def reset_log_file(filename, fb_meta):
     :param filename: str, name of dataset
     :param fb_meta: metadata for parquet
     """
-    # original log file name - all log statements
-    log_file = logoutputpath / "flowsa.log"
+    # original log file name - all log statements, or those of the current
+    # thread if it has its own log file
+    thread_handler = getattr(_thread_log, 'handler', None)
+    log_file = (Path(thread_handler.baseFilename) if thread_handler
+                else logoutputpath / "flowsa.log")
     # generate new log name
     new_log_name = (logoutputpath / f'{filename}_v'
                     f'{fb_meta.tool_version}'
@@ -93,17 +160,29 @@ def reset_log_file(filename, fb_meta):
     # already exists)
     shutil.copy(log_file, new_log_name)
 
-    # Reset log file
-    for h in log.handlers:
-        if isinstance(h, logging.FileHandler):
-            log.removeHandler(h)
-    log.addHandler(get_log_file_handler('flowsa.log', logging.INFO))
+    # Reset log file. Handlers are closed so that the file is reopened
+    # empty, and the log files of other threads are left in place.
+    if thread_handler:
+        log.removeHandler(thread_handler)
+        thread_handler.close()
+        _thread_log.handler = _get_thread_log_file_handler(log_file.name)
+        log.addHandler(_thread_log.handler)
+    else:
+        for h in list(log.handlers):
+            if (isinstance(h, logging.FileHandler) and
+                    not any(isinstance(f, _ContextFilter)
+                            for f in h.filters)):
+                log.removeHandler(h)
+                h.close()
+        log.addHandler(get_log_file_handler('flowsa.log', logging.INFO))
 
     if fb_meta.category == 'FlowByActivity':
         return
 
     # original log file name - validation
-    log_file = logoutputpath / "flowsa_validation.log"
+    thread_vhandler = getattr(_thread_log, 'vhandler', None)
+    log_file = (Path(thread_vhandler.baseFilename) if thread_vhandler
+                else logoutputpath / "flowsa_validation.log")
     # generate new log name
     new_log_name = (logoutputpath / f'{filename}_v'
                     f'{fb_meta.tool_version}'
@@ -114,7 +193,16 @@ def reset_log_file(filename, fb_meta):
     shutil.copy(log_file, new_log_name)
 
     # Reset validation log file
-    for h in vlog.handlers:
-        if isinstance(h, logging.FileHandler):
+    if thread_vhandler:
+        vlog.removeHandler(thread_vhandler)
+        thread_vhandler.close()
+        _thread_log.vhandler = _get_thread_log_file_handler(log_file.name,
+                                                            logging.DEBUG)
+        vlog.addHandler(_thread_log.vhandler)
+        return
+    for h in list(vlog.handlers):
+        if (isinstance(h, logging.FileHandler) and
+                not any(isinstance(f, _ContextFilter) for f in h.filters)):
             vlog.removeHandler(h)
+            h.close()
     vlog.addHandler(get_log_file_handler('flowsa_validation.log'))
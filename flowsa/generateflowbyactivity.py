@@ -9,31 +9,58 @@ EX: --year 2015 --source USGS_NWIS_WU
 """
 
 import argparse
+import os
+import shutil
+import time
+import uuid
+from functools import partial
 import pandas as pd
 from urllib import parse
-import time
 import flowsa
 from esupy.processed_data_mgmt import write_df_to_file
-from esupy.remote import make_url_request
 from flowsa.common import load_env_file_key, sourceconfigpath, \
-    load_yaml_dict, get_flowsa_base_name
-from flowsa.settings import paths
-from flowsa.flowsa_log import log, reset_log_file
+    load_yaml_dict, get_flowsa_base_name, str2bool
+from flowsa.settings import paths, outputpath
+from flowsa.cache import write_part
+from flowsa.flowsa_log import log, reset_log_file, thread_log_file
+from flowsa.parallel import EXECUTOR_TYPES, get_executor_settings, \
+    ordered_map
 from flowsa.metadata import set_fb_meta, write_metadata
 from flowsa.schema import flow_by_activity_fields
 from flowsa.dataclean import clean_df
+from flowsa.fetch import fetch_urls
+from flowsa.response_cache import write_manifest
+
+fragmentpath = outputpath / 'FBAFragments'
 
 
 def parse_args():
     """
     Make year and source script parameters
-    :return: dictionary, 'year' and 'source'
+    :return: dictionary, 'year', 'source', 'response_cache',
+        'year_executor' and 'max_workers'
     """
     ap = argparse.ArgumentParser()
     ap.add_argument("-y", "--year", required=True,
                     help="Year for data pull and save")
     ap.add_argument("-s", "--source", required=True,
                     help="Data source code to pull and save")
+    ap.add_argument("--cache", dest="response_cache", action="store_const",
+                    const="use", help="Reuse cached responses, caching "
+                                      "any that are requested")
+    ap.add_argument("--refresh-cache", dest="response_cache",
+                    action="store_const", const="refresh",
+                    help="Request all urls and cache the responses")
+    ap.add_argument("--offline", dest="response_cache",
+                    action="store_const", const="offline",
+                    help="Only use cached responses, without requesting "
+                         "any urls")
+    ap.add_argument("--year-executor", dest="year_executor",
+                    choices=EXECUTOR_TYPES,
+                    help="Generate a range of years with a pool of threads "
+                         "or processes")
+    ap.add_argument("--max-workers", dest="max_workers", type=int,
+                    help="Number of years generated at once")
     args = vars(ap.parse_args())
     return args
 
@@ -88,6 +115,32 @@ def assemble_urls_for_query(*, source, year, config):
         return [build_url]
 
 
+def call_response(*, resp, url, source, year, config):
+    """
+    Convert a url response to a list of dfs with the source's
+    call_response_fxn
+    :param resp: response from url call
+    :param url: str, url called
+    :param source: str, data source
+    :param year: str, year
+    :param config: dictionary, FBA yaml
+    :return: list, dfs to concat and parse
+    """
+    df = None
+    fxn = config.get("call_response_fxn")
+    if callable(fxn):
+        df = fxn(resp=resp, source=source, year=year,
+                 config=config, url=url)
+    elif fxn:
+        raise flowsa.exceptions.FBSMethodConstructionError(
+            error_type='fxn_call')
+    if isinstance(df, pd.DataFrame):
+        return [df]
+    elif isinstance(df, list):
+        return df
+    return []
+
+
 def call_urls(*, url_list, source, year, config):
     """
     This method calls all the urls that have been generated.
@@ -100,36 +153,86 @@ def call_urls(*, url_list, source, year, config):
     :param config: dictionary, FBA yaml
     :return: list, dfs to concat and parse
     """
-    # identify if url request requires cookies set
-    set_cookies = config.get('allow_http_request_cookies')
-    confirm_gdrive = config.get('confirm_gdrive')
-    pause = config.get('time_delay', 0) # in seconds
-
-    # create dataframes list by iterating through url list
+    # create dataframes list by iterating through url list. Responses are
+    # requested concurrently (see flowsa.fetch) but handled in url order
     data_frames_list = []
     if url_list[0] is not None:
-        for url in url_list:
-            df = None
-            log.info("Calling %s", url)
-            resp = make_url_request(url,
-                                    set_cookies=set_cookies,
-                                    confirm_gdrive=confirm_gdrive)
-            fxn = config.get("call_response_fxn")
-            if callable(fxn):
-                df = fxn(resp=resp, source=source, year=year,
-                        config=config, url=url)
-            elif fxn:
-                raise flowsa.exceptions.FBSMethodConstructionError(
-                    error_type='fxn_call')
-            if isinstance(df, pd.DataFrame):
-                data_frames_list.append(df)
-            elif isinstance(df, list):
-                data_frames_list.extend(df)
-            time.sleep(pause)
+        manifest = []
+        for url, resp in fetch_urls(url_list, config, manifest):
+            data_frames_list.extend(call_response(
+                resp=resp, url=url, source=source, year=year,
+                config=config))
+        write_manifest(set_fba_name(source, year), manifest)
 
     return data_frames_list
 
 
+def stream_responses(config):
+    """
+    Whether to parse each url response on its own, from
+    config['stream_responses'] or the FLOWSA_STREAM_RESPONSES environment
+    variable. Only for sources whose parse_response_fxn handles the dfs of
+    each response independently of the others.
+    """
+    value = config.get('stream_responses',
+                       os.environ.get('FLOWSA_STREAM_RESPONSES', False))
+    return str2bool(value if isinstance(value, bool) else str(value))
+
+
+def stream_urls(*, url_list, source, year, config):
+    """
+    Streaming alternative to call_urls() and parse_data(). Each response is
+    parsed with the source's parse_response_fxn as soon as it arrives,
+    cleaned, and written to a parquet fragment, so that raw responses and
+    unparsed dfs are not held in memory. The fragments of each FBA are
+    concatenated once all urls are called.
+    :param url_list: list, urls to call
+    :param source: str, data source
+    :param year: str, year
+    :param config: dictionary, FBA yaml
+    :return: dict, FBA df for each source name
+    """
+    run_path = fragmentpath / uuid.uuid4().hex
+    fragments = {}
+    spill = True
+    manifest = []
+    try:
+        for i, (url, resp) in enumerate(
+                fetch_urls(url_list, config, manifest)):
+            df_list = call_response(resp=resp, url=url, source=source,
+                                    year=year, config=config)
+            del resp
+            if not df_list:
+                continue
+            dfs = parse_data(df_list=df_list, source=source, year=year,
+                             config=config)
+            del df_list
+            for j, frame in enumerate(dfs if isinstance(dfs, list)
+                                      else [dfs]):
+                source_name = source
+                if isinstance(dfs, list):
+                    if len(frame.index) == 0:
+                        continue
+                    if 'SourceName' in frame:
+                        source_name = frame['SourceName'].iloc[0]
+                frame = clean_df(frame, flow_by_activity_fields,
+                                 drop_description=False)
+                path = run_path / f'part-{i:05d}-{j:03d}.parquet'
+                spill = spill and write_part(
+                    frame, path, f'parsed fragments of {source} {year}')
+                fragments.setdefault(source_name, []).append(
+                    path if spill else frame)
+        write_manifest(set_fba_name(source, year), manifest)
+        log.info("Concat %s fragments of parsed data",
+                 sum(len(f) for f in fragments.values()))
+        return {source_name: pd.concat(
+                    [pd.read_parquet(p) if not isinstance(p, pd.DataFrame)
+                     else p for p in parts], ignore_index=True)
+                for source_name, parts in fragments.items()}
+    finally:
+        shutil.rmtree(run_path, ignore_errors=True)
+
+
 def parse_data(*, df_list, source, year, config):
     """
     Calls on functions defined in source.py files, as parsing rules
@@ -152,6 +255,23 @@ def parse_data(*, df_list, source, year, config):
     return df
 
 
+def standardize_fba(df):
+    """
+    Add any missing FBA columns, cast columns to the FBA datatypes and sort
+    :param df: df, FBA format
+    :return: df, FBA format, standardized
+    """
+    # add any missing columns of data and cast to appropriate data type
+    log.info("Add any missing columns and check field datatypes")
+    flow_df = clean_df(df, flow_by_activity_fields,
+                       drop_description=False)
+    # sort df and reset index
+    flow_df = flow_df.sort_values(['Class', 'Location', 'ActivityProducedBy',
+                                   'ActivityConsumedBy', 'FlowName',
+                                   'Compartment']).reset_index(drop=True)
+    return flow_df
+
+
 def process_data_frame(*, df, source, year, config):
     """
     Process the given dataframe, cleaning, converting data, and
@@ -162,18 +282,11 @@ def process_data_frame(*, df, source, year, config):
     :param source: str, source name
     :param year: str, year
     :param config: dict, items in method yaml
-    :return: df, FBA format, standardized
+    :return: int, number of rows of the FBA
     """
     # log that data was retrieved
     log.info("Retrieved data for %s %s", source, year)
-    # add any missing columns of data and cast to appropriate data type
-    log.info("Add any missing columns and check field datatypes")
-    flow_df = clean_df(df, flow_by_activity_fields,
-                       drop_description=False)
-    # sort df and reset index
-    flow_df = flow_df.sort_values(['Class', 'Location', 'ActivityProducedBy',
-                                   'ActivityConsumedBy', 'FlowName',
-                                   'Compartment']).reset_index(drop=True)
+    flow_df = standardize_fba(df)
     # save as parquet file
     name_data = set_fba_name(source, year)
     meta = set_fb_meta(name_data, "FlowByActivity")
@@ -182,13 +295,17 @@ def process_data_frame(*, df, source, year, config):
     log.info("FBA generated and saved for %s", name_data)
     # rename the log file saved to local directory
     reset_log_file(name_data, meta)
+    return len(flow_df)
 
 
 def main(**kwargs):
     """
     Generate FBA parquet(s)
-    :param kwargs: 'source' and 'year'
-    :return: parquet saved to local directory
+    :param kwargs: 'source' and 'year', optionally 'response_cache' (see
+        flowsa.response_cache), and 'year_executor' and 'max_workers' to
+        generate a range of years concurrently (see flowsa.parallel)
+    :return: df, FBA name, year, number of rows and seconds taken for each
+        FBA generated. Parquet saved to local directory
     """
     # assign arguments
     if len(kwargs) == 0:
@@ -206,6 +323,9 @@ def main(**kwargs):
         source = get_flowsa_base_name(sourceconfigpath, source, "yaml")
         log.info(f'Generating FBA for {source}')
         config = load_yaml_dict(source, flowbytype='FBA')
+    for key in ['response_cache', 'year_executor', 'max_workers']:
+        if kwargs.get(key):
+            config[key] = kwargs[key]
 
     log.info("Creating dataframe list")
     # year input can either be sequential years (e.g. 2007-2009) or single year
@@ -224,44 +344,101 @@ def main(**kwargs):
                     f'data might not exist')
 
     if config.get('call_all_years'):
+        if stream_responses(config):
+            log.warning('stream_responses is not supported with '
+                        'call_all_years, parsing all responses at once')
         urls = assemble_urls_for_query(source=source, year=None, config=config)
         df_list = call_urls(url_list=urls, source=source, year=None, config=config)
         dfs = parse_data(df_list=df_list, source=source, year=None, config=config)
-        call_all_years = True
     else:
-        call_all_years = False
-    for p_year in year_iter:
-        year = str(p_year)
-        if not call_all_years:
-            # replace parts of urls with specific instructions from source.py
-            urls = assemble_urls_for_query(source=source,
-                                           year=year, config=config)
-            # create a list with data from all source urls
-            df_list = call_urls(url_list=urls,
-                                source=source, year=year, config=config)
-            # concat the dataframes and parse data with specific
-            # instructions from source.py
-            log.info("Concat dataframe list and parse data")
-            dfs = parse_data(df_list=df_list, source=source,
-                             year=year, config=config)
-        if isinstance(dfs, list):
-            for frame in dfs:
-                if not len(frame.index) == 0:
-                    try:
-                        source_names = frame['SourceName']
-                        source_name = source_names.iloc[0]
-                    except KeyError:
-                        source_name = source
-                    process_data_frame(df=frame,
-                                       source=source_name, year=year,
-                                       config=config)
-        elif call_all_years:
-            process_data_frame(
-                df=dfs.query('Year == @year').reset_index(drop=True),
-                source=source, year=year, config=config)
-
-        else:
-            process_data_frame(df=dfs, source=source, year=year, config=config)
+        dfs = None
+
+    # years are generated by a pool of workers if year_executor is set, each
+    # with its own log file
+    executor = get_executor_settings(config, 'year_executor')
+    summary = ordered_map(
+        partial(_generate_year, source=source, config=config, dfs=dfs,
+                separate_log=(executor['executor_type'] != 'serial'
+                              and len(year_iter) > 1)),
+        [str(p_year) for p_year in year_iter], **executor)
+    summary = pd.DataFrame([row for rows in summary for row in rows],
+                           columns=['FBA', 'Year', 'Rows', 'Seconds'])
+    log.info('Generated %s FBA(s) for %s:\n%s', len(summary), source,
+             summary.to_string(index=False, float_format='{:.1f}'.format))
+    return summary
+
+
+def _generate_year(year, *, source, config, dfs=None, separate_log=False):
+    """
+    Generate the FBA(s) of a source for a single year
+    :param year: str, year
+    :param source: str, source name
+    :param config: dict, FBA yaml
+    :param dfs: df or list of dfs, parsed data of all years if the source's
+        urls are called for all years at once (call_all_years)
+    :param separate_log: bool, write the log of the year to its own file
+    :return: list, FBA name, year, number of rows and seconds taken for
+        each FBA generated
+    """
+    start = time.perf_counter()
+    if not separate_log:
+        return _process_year(year, source=source, config=config, dfs=dfs,
+                             start=start)
+    with thread_log_file(f'flowsa_{set_fba_name(source, year)}.log'):
+        return _process_year(year, source=source, config=config, dfs=dfs,
+                             start=start)
+
+
+def _process_year(year, *, source, config, dfs, start):
+    rows = []
+    if not config.get('call_all_years'):
+        # replace parts of urls with specific instructions from source.py
+        urls = assemble_urls_for_query(source=source,
+                                       year=year, config=config)
+        if stream_responses(config) and urls[0] is not None:
+            # parse each response as it arrives
+            for source_name, frame in stream_urls(
+                    url_list=urls, source=source, year=year,
+                    config=config).items():
+                rows.append((source_name, process_data_frame(
+                    df=frame, source=source_name, year=year,
+                    config=config)))
+            return _timed(rows, year, start)
+        # create a list with data from all source urls
+        df_list = call_urls(url_list=urls,
+                            source=source, year=year, config=config)
+        # concat the dataframes and parse data with specific
+        # instructions from source.py
+        log.info("Concat dataframe list and parse data")
+        dfs = parse_data(df_list=df_list, source=source,
+                         year=year, config=config)
+    if isinstance(dfs, list):
+        for frame in dfs:
+            if not len(frame.index) == 0:
+                try:
+                    source_names = frame['SourceName']
+                    source_name = source_names.iloc[0]
+                except KeyError:
+                    source_name = source
+                rows.append((source_name, process_data_frame(
+                    df=frame, source=source_name, year=year,
+                    config=config)))
+    elif config.get('call_all_years'):
+        rows.append((source, process_data_frame(
+            df=dfs.query('Year == @year').reset_index(drop=True),
+            source=source, year=year, config=config)))
+
+    else:
+        rows.append((source, process_data_frame(
+            df=dfs, source=source, year=year, config=config)))
+    return _timed(rows, year, start)
+
+
+def _timed(rows, year, start):
+    """Summary rows of the FBAs generated for a year"""
+    seconds = time.perf_counter() - start
+    return [(set_fba_name(source_name, year), year, n, seconds)
+            for source_name, n in rows]
 
 
 if __name__ == '__main__':
@@ -2,7 +2,7 @@ from typing import Literal
 import enum
 from functools import total_ordering
 import pandas as pd
-from . import settings
+from .common import crosswalk_registry, load_crosswalk
 from .flowsa_log import log
 
 
@@ -61,6 +61,7 @@ class scale(enum.Enum):
             raise ValueError(f'No geo.scale level corresponds to {geoscale}')
 
 
+@crosswalk_registry.memoize
 def get_all_fips(year: Literal[2010, 2013, 2015] = 2015) -> pd.DataFrame:
     '''
     Read fips based on year specified, year defaults to 2015
@@ -70,9 +71,7 @@ def get_all_fips(year: Literal[2010, 2013, 2015] = 2015) -> pd.DataFrame:
         'State' is NaN for national level FIPS ('00000'), and 'County'
         is Nan for national and each state level FIPS.
     '''
-    return (pd
-            .read_csv(settings.datapath / 'FIPS_Crosswalk.csv',
-                      header=0, dtype=object)
+    return (load_crosswalk('FIPS_Crosswalk')
             [['State', f'FIPS_{year}', f'County_{year}']]
             .rename(columns={f'FIPS_{year}': 'FIPS',
                              f'County_{year}': 'County'})
@@ -3,7 +3,91 @@ import pandas as pd
 import numpy as np
 from flowsa.flowbyfunctions import aggregator
 from flowsa.flowsa_log import vlog, log
-from . import (common, settings)
+from . import common
+
+
+class NAICSHierarchy:
+    """
+    Index of a set of NAICS codes (or any codes in which a child code
+    extends the code of its parent) for vectorized prefix operations.
+
+    Each code, and every prefix of it, is a node, numbered in sorted order
+    so that the descendants of a node are the nodes that follow it, up to
+    end[node]. parent[node] is the node of the code one character shorter
+    (-1 for single characters), and length[node] the length of its code.
+    Codes that are not in the index (including nulls) match nothing, so
+    an empty index matches no codes.
+    """
+    def __init__(self, codes):
+        codes = pd.Series(codes, dtype='object').dropna().astype(str).unique()
+        nodes = sorted({c[:n] for c in codes for n in range(1, len(c) + 1)})
+        self.codes = np.array(nodes, dtype='object')
+        self._index = pd.Index(self.codes)
+        self.length = np.array([len(c) for c in nodes], dtype=int)
+        self.end = np.searchsorted(
+            np.array(nodes, dtype='U'),
+            np.array([c + '\U0010ffff' for c in nodes], dtype='U'))
+        self.parent = self._index.get_indexer([c[:-1] for c in nodes])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def node(self, codes) -> np.ndarray:
+        """Node of each code, or -1 for codes not in the index"""
+        return self._index.get_indexer(
+            pd.Series(codes, dtype='object').astype(str))
+
+    def is_descendant(self, codes, ancestors, strict=False) -> np.ndarray:
+        """
+        Whether each code starts with the corresponding ancestor code
+        (or with ancestors, if a single code).
+        :param codes: list-like of codes
+        :param ancestors: code, or list-like of codes the length of codes
+        :param strict: bool, if True, a code is not its own descendant
+        :return: np.ndarray of bool
+        """
+        node = self.node(codes)
+        if len(self) == 0:
+            return np.zeros(len(node), dtype=bool)
+        if np.ndim(ancestors) == 0:
+            ancestors = np.repeat(
+                np.array(ancestors, dtype='object'), len(node))
+        ancestor = self.node(ancestors)
+        descendant = ((node >= 0) & (ancestor >= 0) & (node >= ancestor)
+                      & (node < self.end[ancestor]))
+        return descendant & (node != ancestor) if strict else descendant
+
+    def ancestors_at_level(self, codes, level: int) -> np.ndarray:
+        """
+        Ancestor of each code with a code of length level, i.e. the first
+        level characters of the code; None for codes that are shorter than
+        level or not in the index.
+        """
+        node = self.node(codes)
+        if len(self) == 0:
+            return np.full(len(node), None, dtype='object')
+        while True:
+            too_long = (node >= 0) & (self.length[node] > level)
+            if not too_long.any():
+                break
+            node[too_long] = self.parent[node[too_long]]
+        ancestors = self.codes[node].copy()
+        ancestors[(node < 0) | (self.length[node] != level)] = None
+        return ancestors
+
+    def leaf_filter(self, codes) -> np.ndarray:
+        """
+        Whether each code is the only one of codes to start with its code,
+        i.e. it has no descendants (or duplicates) in codes.
+        :return: np.ndarray of bool, aligned with codes
+        """
+        node = self.node(codes)
+        if len(self) == 0:
+            return np.zeros(len(node), dtype=bool)
+        counts = np.bincount(node[node >= 0], minlength=len(self) + 1)
+        cumulative = np.concatenate([[0], np.cumsum(counts)])
+        in_subtree = cumulative[self.end[node]] - cumulative[node]
+        return (node >= 0) & (in_subtree == 1)
 
 
 def return_naics_crosswalk(
@@ -24,6 +108,7 @@ def return_naics_crosswalk(
     return naics_crosswalk
 
 
+@common.crosswalk_registry.memoize
 def industry_spec_key(
     industry_spec: dict,
     year: Literal[2002, 2007, 2012, 2017]  # Year of NAICS code
@@ -93,6 +178,7 @@ def industry_spec_key(
     return naics_key
 
 
+@common.crosswalk_registry.memoize
 def map_target_sectors_to_less_aggregated_sectors(
     industry_spec: dict,
     year: Literal[2002, 2007, 2012, 2017]
@@ -139,6 +225,7 @@ def map_target_sectors_to_less_aggregated_sectors(
     return naics.drop_duplicates().reset_index(drop=True)
 
 
+@common.crosswalk_registry.memoize
 def map_source_sectors_to_more_aggregated_sectors(
     year: Literal[2002, 2007, 2012, 2017]
 ) -> pd.DataFrame:
@@ -177,6 +264,7 @@ def map_source_sectors_to_more_aggregated_sectors(
     return naics_key.drop_duplicates()
 
 
+@common.crosswalk_registry.memoize
 def map_source_sectors_to_less_aggregated_sectors(
     year: Literal[2002, 2007, 2012, 2017]
 ) -> pd.DataFrame:
@@ -216,6 +304,7 @@ def map_source_sectors_to_less_aggregated_sectors(
     return cw_melt
 
 
+@common.crosswalk_registry.memoize
 def year_crosswalk(
     source_year: Literal[2002, 2007, 2012, 2017],
     target_year: Literal[2002, 2007, 2012, 2017]
@@ -229,8 +318,7 @@ def year_crosswalk(
         corresponding to NAICS codes for the source and target specifications.
     '''
     return (
-        pd.read_csv(settings.datapath / 'NAICS_Crosswalk_TimeSeries.csv',
-                    dtype='object')
+        common.load_crosswalk('NAICS_Crosswalk_TimeSeries')
         .assign(source_naics=lambda x: x[f'NAICS_{source_year}_Code'],
                 target_naics=lambda x: x[f'NAICS_{target_year}_Code'])
         [['source_naics', 'target_naics']]
@@ -280,6 +368,7 @@ def check_if_sectors_are_naics(df_load, crosswalk_list, column_headers):
     return non_sectors
 
 
+@common.crosswalk_registry.memoize
 def melt_naics_crosswalk(targetsectorsourcename):
     """
     Create a melt version of the naics 07 to 17 crosswalk to map
@@ -0,0 +1,148 @@
+# parallel.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Helpers for running independent steps of a FlowBy build concurrently, such
+as the activity sets of a data source. Concurrency is opt-in: the executor
+is read from a method yaml key or an environment variable and defaults to
+running serially.
+
+Results are always returned in the order of the inputs. When using a process
+pool, log records from the workers are sent back to the main process and
+written by the usual flowsa.log/validation log handlers.
+"""
+
+import contextvars
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from flowsa.flowsa_log import log, vlog
+
+EXECUTOR_TYPES = ['serial', 'thread', 'process']
+
+# set in worker threads and processes so that nested calls run serially
+# instead of creating pools within pools
+_worker_state = threading.local()
+_in_worker_process = False
+
+
+def get_executor_settings(config: dict, key: str) -> dict:
+    """
+    Determine how to run a set of tasks. The executor type is taken from
+    config[key] if given, otherwise from the environment variable
+    FLOWSA_<KEY>, otherwise 'serial'. The number of workers is taken from
+    config['max_workers'] or the FLOWSA_MAX_WORKERS environment variable,
+    defaulting to the number of cpus.
+    :param config: dict, FlowBy config
+    :param key: str, config key, e.g. 'activity_set_executor'
+    :return: dict, kwargs for ordered_map()
+    """
+    executor_type = (config.get(key)
+                     or os.environ.get(f'FLOWSA_{key.upper()}')
+                     or 'serial')
+    executor_type = str(executor_type).lower()
+    if executor_type not in EXECUTOR_TYPES:
+        log.warning(f'Unrecognized {key} "{executor_type}", must be one of '
+                    f'{EXECUTOR_TYPES}. Running serially.')
+        executor_type = 'serial'
+    max_workers = (config.get('max_workers')
+                   or os.environ.get('FLOWSA_MAX_WORKERS'))
+    return {'executor_type': executor_type,
+            'max_workers': int(max_workers) if max_workers else None}
+
+
+def call_method(obj, method: str, *args, **kwargs):
+    """
+    Call obj.method(*args, **kwargs). Module level so that it can be
+    pickled and sent to a worker process.
+    """
+    return getattr(obj, method)(*args, **kwargs)
+
+
+def _run_in_thread(fxn, item):
+    _worker_state.active = True
+    try:
+        return fxn(item)
+    finally:
+        _worker_state.active = False
+
+
+class _DispatchToLogger(logging.Handler):
+    """Hand a record from a worker process to the logger that created it"""
+    def handle(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def _init_worker_process(queue) -> None:
+    """
+    Route the flowsa and flowsa.validation loggers of a worker process to
+    the main process through queue.
+    """
+    global _in_worker_process
+    _in_worker_process = True
+    for logger in [log, vlog]:
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+    # validation records propagate to the flowsa logger, so only one
+    # queue handler is needed
+    log.addHandler(logging.handlers.QueueHandler(queue))
+
+
+def ordered_map(fxn, items, executor_type: str = 'serial',
+                max_workers: int = None) -> list:
+    """
+    Apply fxn to each of items, returning results in the order of items.
+    :param fxn: callable taking a single item. Must be picklable (a module
+        level function or a functools.partial of one) for the process pool.
+    :param items: iterable of inputs
+    :param executor_type: str, one of 'serial', 'thread' or 'process'
+    :param max_workers: int, number of workers, default is the cpu count
+    :return: list, results
+    """
+    items = list(items)
+    if (executor_type == 'serial' or len(items) < 2 or _in_worker_process
+            or getattr(_worker_state, 'active', False)):
+        return [fxn(i) for i in items]
+
+    log.info(f'Running {len(items)} tasks with a {executor_type} pool')
+    if executor_type == 'thread':
+        # tasks run in a copy of the current context, so that their log
+        # records reach the log file of the dataset being generated
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run,
+                                       _run_in_thread, fxn, i)
+                       for i in items]
+            return [f.result() for f in futures]
+
+    with log_queue() as queue, process_pool(max_workers, queue) as executor:
+        return list(executor.map(fxn, items))
+
+
+@contextmanager
+def log_queue():
+    """
+    Queue for the log records of worker processes, which are written by the
+    handlers of the main process while the context is open.
+    """
+    queue = multiprocessing.get_context().Queue()
+    listener = logging.handlers.QueueListener(queue, _DispatchToLogger())
+    listener.start()
+    try:
+        yield queue
+    finally:
+        listener.stop()
+
+
+def process_pool(max_workers: int, queue) -> ProcessPoolExecutor:
+    """
+    Process pool whose workers send their log records to queue, see
+    log_queue(), and run any nested ordered_map() serially.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers,
+                               mp_context=multiprocessing.get_context(),
+                               initializer=_init_worker_process,
+                               initargs=(queue,))
@@ -0,0 +1,329 @@
+# planner.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Planning pass over an FBS method. Walks the resolved method config the same
+way FlowBySector generation does and builds a graph of every dataset that
+will be loaded and prepared: the primary sources, their activity sets, and
+the attribution and clean sources they use.
+
+Each dataset is identified by its name and effective config, so an
+attribution source that is used (with identical config) by several activity
+sets appears as a single, shared node. Shared nodes are prepared once during
+FBS generation and reused.
+"""
+
+import hashlib
+from functools import partial
+import pandas as pd
+from flowsa import common
+from flowsa.common import get_catalog_info
+from flowsa.flowsa_log import log
+
+# config keys that do not change the prepared dataset
+UNHASHED_KEYS = ['cache', 'method_config_keys', 'activity_set_executor',
+                 'source_executor', 'max_workers', 'intermediate_cache',
+                 'incremental', 'dtype_profile', 'attribution_engine',
+                 'aggregation_engine', 'prune_columns',
+                 'attribution_chunks', 'attribution_memory_budget',
+                 'attribution_chunk', 'source_names', 'display_tables',
+                 'method_plan']
+# attribution methods which load an attribution source
+LOADING_METHODS = ['proportional', 'multiplication', 'division']
+
+
+def _canonical(obj):
+    """
+    Convert a config value to a deterministic string representation, so
+    that configs loaded separately from the same yaml give the same key.
+    Functions are represented by their module and name.
+    """
+    if isinstance(obj, dict):
+        return '{' + ','.join(f'{k!r}:{_canonical(v)}' for k, v in
+                              sorted(obj.items(), key=lambda x: repr(x[0])))\
+            + '}'
+    if isinstance(obj, (list, tuple)):
+        return '[' + ','.join(_canonical(v) for v in obj) + ']'
+    if isinstance(obj, (set, frozenset)):
+        return '{' + ','.join(sorted(_canonical(v) for v in obj)) + '}'
+    if isinstance(obj, partial):
+        return (f'partial({_canonical(obj.func)},{_canonical(obj.args)},'
+                f'{_canonical(obj.keywords)})')
+    if callable(obj) and hasattr(obj, '__qualname__'):
+        return f'{getattr(obj, "__module__", "")}.{obj.__qualname__}'
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return pd.util.hash_pandas_object(obj, index=True).sum().astype(str)
+    return repr(obj)
+
+
+def node_key(name: str, config: dict) -> str:
+    """
+    Identify a dataset by its name and the config it is prepared with.
+    :param name: str, source name
+    :param config: dict, effective config passed to get_flowby_from_config
+    :return: str, key of the form '<name>#<hash>'
+    """
+    digest = hashlib.sha1(_canonical(
+        {k: v for k, v in config.items() if k not in UNHASHED_KEYS}
+    ).encode()).hexdigest()
+    return f'{name}#{digest[:12]}'
+
+
+def subsource_config(parent_config: dict, name: str, config: dict,
+                     catalog_info: dict = None) -> dict:
+    """
+    Effective config of an attribution or clean source loaded by a dataset
+    with parent_config: method level keys are inherited from the parent.
+    """
+    if catalog_info is None:
+        catalog_info = get_catalog_info(name)
+    return {**{k: v for k, v in parent_config.items()
+               if k in parent_config['method_config_keys']
+               or k == 'method_config_keys'},
+            **catalog_info,
+            **config}
+
+
+def _split_source(source):
+    """Return (name, config) from a str or single entry dict"""
+    if isinstance(source, str):
+        return source, {}
+    (name, config), = source.items()
+    return name, config or {}
+
+
+def _child_config(config: dict) -> dict:
+    """Config inherited by activity sets and attribution steps"""
+    return {k: v for k, v in config.items()
+            if k not in ['activity_sets', 'clean_fba_before_activity_sets']
+            and not k.startswith('_')}
+
+
+class MethodPlan:
+    """
+    Graph of the datasets used to generate an FBS method.
+
+    nodes: DataFrame with one row per dataset or activity set, the number
+        of times it is used, and whether it is prepared once and shared.
+    edges: DataFrame of parent node, child node, and relationship.
+    sources: dict, node of each of the method's source_names
+    """
+    def __init__(self, method: str):
+        self.method = method
+        self.names = {}
+        self.configs = {}
+        self._nodes = {}
+        self._edges = []
+        self._cached_names = {}
+        self.sources = {}
+        self._source_catalog = None
+
+    def __repr__(self):
+        return (f'MethodPlan({self.method}: {len(self._nodes)} nodes, '
+                f'{len(self.shared_nodes())} shared)')
+
+    @property
+    def nodes(self) -> pd.DataFrame:
+        height = self._heights()
+        nodes = pd.DataFrame(
+            [{**n, 'height': height[node_id]}
+             for node_id, n in self._nodes.items()],
+            columns=['node_id', 'name', 'kind', 'data_format', 'uses',
+                     'height'])
+        return nodes.assign(shared=nodes.node_id.isin(self.shared_nodes()))
+
+    @property
+    def edges(self) -> pd.DataFrame:
+        return pd.DataFrame(self._edges,
+                            columns=['parent', 'child', 'relation',
+                                     'attribution_method'])
+
+    @property
+    def cached(self) -> dict:
+        """Node of each of the method's sources_to_cache, by name"""
+        return dict(self._cached_names)
+
+    def descendants(self, node_id: str) -> set:
+        """All nodes used, directly or indirectly, by node_id"""
+        children = {}
+        for e in self._edges:
+            children.setdefault(e['parent'], []).append(e['child'])
+        found = set()
+        stack = [node_id]
+        while stack:
+            for child in children.get(stack.pop(), []):
+                if child not in found:
+                    found.add(child)
+                    stack.append(child)
+        return found
+
+    def shared_nodes(self) -> list:
+        """
+        Attribution and clean sources used more than once, ordered so that
+        a node comes after any shared node it depends on.
+        """
+        height = self._heights()
+        shared = [node_id for node_id, n in self._nodes.items()
+                  if n['kind'] in ['attribution', 'clean']
+                  and n['uses'] > 1]
+        return sorted(shared, key=lambda x: height[x])
+
+    def cache_placeholders(self) -> dict:
+        """
+        Entries to add to method_config['cache']. A None value marks a
+        shared dataset which is prepared the first time it is needed.
+        """
+        return dict.fromkeys(self.shared_nodes())
+
+    def _heights(self) -> dict:
+        """Length of the longest path from each node to a leaf"""
+        children = {}
+        for e in self._edges:
+            children.setdefault(e['parent'], []).append(e['child'])
+        height = {}
+
+        def _height(node_id):
+            if node_id not in height:
+                height[node_id] = 1 + max(
+                    [_height(c) for c in children.get(node_id, [])],
+                    default=-1)
+            return height[node_id]
+        return {node_id: _height(node_id) for node_id in self._nodes}
+
+    def catalog_info(self, name: str) -> dict:
+        """get_catalog_info(), loading source_catalog.yaml only once"""
+        if self._source_catalog is None:
+            self._source_catalog = common.load_yaml_dict('source_catalog')
+        return get_catalog_info(name, self._source_catalog)
+
+    def _add_node(self, node_id, name, kind, config, parent=None,
+                  relation=None, attribution_method=None) -> bool:
+        """Add a node and edge. Return True if the node is new."""
+        new = node_id not in self._nodes
+        if new:
+            self._nodes[node_id] = {
+                'node_id': node_id, 'name': name, 'kind': kind,
+                'data_format': config.get('data_format'), 'uses': 0}
+            self.names[node_id] = name
+            self.configs[node_id] = config
+        self._nodes[node_id]['uses'] += 1
+        if parent is not None:
+            self._edges.append({'parent': parent, 'child': node_id,
+                                'relation': relation,
+                                'attribution_method': attribution_method})
+        return new
+
+    def add_source(self, name: str, config: dict, kind: str = 'primary',
+                   parent: str = None, relation: str = None,
+                   attribution_method: str = None) -> str:
+        """Add a dataset that is loaded and prepared, and its dependencies"""
+        if kind == 'attribution' and name in self._cached_names:
+            # cached attribution sources are looked up by name
+            node_id = self._cached_names[name]
+            self._add_node(node_id, name, 'cached', config, parent,
+                           relation, attribution_method)
+            return node_id
+        node_id = node_key(name, config)
+        if self._add_node(node_id, name, kind, config, parent, relation,
+                          attribution_method):
+            self._add_prepare(node_id, name, config)
+        if kind == 'cached':
+            self._cached_names[name] = node_id
+        return node_id
+
+    def _add_clean_source(self, node_id: str, config: dict,
+                          clean_source) -> None:
+        name, clean_config = _split_source(clean_source)
+        self.add_source(name, subsource_config(config, name, clean_config,
+                                               self.catalog_info(name)),
+                        kind='clean', parent=node_id,
+                        relation='clean_source')
+
+    def _add_prepare(self, node_id: str, name: str, config: dict) -> None:
+        """Add the datasets used by prepare_fbs() for a dataset"""
+        if 'activity_sets' in config:
+            parent_config = _child_config(config)
+            for activity_set, activity_config in (
+                    config['activity_sets'].items()):
+                child_id = f'{node_id}/{activity_set}'
+                child_config = {**parent_config, **activity_config}
+                self._add_node(child_id, f'{name}.{activity_set}',
+                               'activity_set', child_config, node_id,
+                               'activity_set')
+                self._add_prepare(child_id, f'{name}.{activity_set}',
+                                  child_config)
+            return
+
+        steps = config.get('attribute', config)
+        if isinstance(steps, dict):
+            steps = [steps]
+        if 'attribute' in config and 'clean_source' in config:
+            self._add_clean_source(node_id, config, config['clean_source'])
+        for step_config in steps:
+            step_config = step_config or {}
+            merged = {**_child_config(config), **step_config}
+            if 'clean_source' in step_config:
+                self._add_clean_source(node_id, merged,
+                                       step_config['clean_source'])
+            method = step_config.get('attribution_method', 'direct')
+            if (method in LOADING_METHODS
+                    and 'attribution_source' in step_config):
+                a_name, a_config = _split_source(
+                    step_config['attribution_source'])
+                self.add_source(a_name,
+                                subsource_config(merged, a_name, a_config,
+                                                 self.catalog_info(a_name)),
+                                kind='attribution', parent=node_id,
+                                relation='attribution_source',
+                                attribution_method=method)
+
+
+def build_plan(method: str, method_config: dict,
+               sources_to_cache: dict = None) -> MethodPlan:
+    """
+    Build the plan for an FBS method from its loaded config, mirroring the
+    configs created in FlowBySector.generateFlowBySector().
+    :param method: str, FBS method name
+    :param method_config: dict, method config including source_names and
+        cache but with sources_to_cache removed. The plan is added to it as
+        'method_plan', so that the configs of all of the method's sources
+        refer to it (see cache.cache_key()).
+    :param sources_to_cache: dict, the method's sources_to_cache
+    :return: MethodPlan
+    """
+    method_plan = MethodPlan(method)
+    method_config['method_plan'] = method_plan
+    for name, config in (sources_to_cache or {}).items():
+        method_plan.add_source(name, {
+            **method_config,
+            'method_config_keys': set(method_config.keys()),
+            **method_plan.catalog_info(name),
+            **config}, kind='cached')
+
+    primary_config = {k: v for k, v in method_config.items()
+                      if k != 'source_names'}
+    for name, config in method_config.get('source_names', {}).items():
+        method_plan.sources[name] = method_plan.add_source(name, {
+            **primary_config,
+            'method_config_keys': set(primary_config.keys()),
+            **method_plan.catalog_info(name),
+            **config})
+    return method_plan
+
+
+def plan(method: str, external_config_path: str = None,
+         **kwargs) -> MethodPlan:
+    """
+    Inspect the datasets that will be used to generate an FBS method,
+    without loading any data.
+    :param method: str, name of FBS method yaml
+    :param external_config_path: str, optional path to the method yaml
+    :return: MethodPlan, with nodes and edges DataFrames
+    """
+    method_config = common.load_yaml_dict(method, 'FBS',
+                                          external_config_path, **kwargs)
+    to_cache = method_config.pop('sources_to_cache', {})
+    method_config['cache'] = {}
+    method_plan = build_plan(method, method_config, to_cache)
+    log.info('%s', method_plan)
+    return method_plan
@@ -0,0 +1,236 @@
+# response_cache.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+On-disk cache of the raw responses of FBA source urls, so that an FBA can
+be regenerated after changing its call or parse functions without
+downloading its source files again.
+
+Responses are keyed by a hash of the url and the request options
+(allow_http_request_cookies, confirm_gdrive), and stored as the raw
+response bytes alongside a json file of the status, headers and encoding.
+Entries older than the time to live are requested again, and the least
+recently used entries are evicted once the cache exceeds its size limit.
+
+The cache mode is set with the FBA method yaml key `response_cache`, the
+FLOWSA_RESPONSE_CACHE environment variable, or the --cache, --refresh-cache
+and --offline arguments of generateflowbyactivity:
+    off: (default) always request urls
+    use: reuse cached responses, requesting and storing missing ones
+    refresh: always request urls and store the responses
+    offline: only use cached responses, without making any requests
+
+Each FBA build also writes a manifest of the urls requested for it (with
+api keys redacted), the cache key, size and sha256 of each response, and
+whether it came from the cache, to <FBA name>_response_manifest.json in
+the FlowByActivity output folder.
+"""
+
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timezone
+from urllib import parse
+import requests
+from flowsa import settings
+from flowsa.cache import _atomic_write
+from flowsa.exceptions import ResponseNotCachedError
+from flowsa.flowsa_log import log
+
+responsepath = settings.outputpath / 'ResponseCache'
+CACHE_MODES = ['off', 'use', 'refresh', 'offline']
+DEFAULT_MAX_SIZE_GB = 5
+DEFAULT_TTL_DAYS = 30
+
+
+def mode(config: dict) -> str:
+    """
+    Cache mode, from config['response_cache'] or the FLOWSA_RESPONSE_CACHE
+    environment variable: one of CACHE_MODES, default 'off'. True is 'use'.
+    """
+    value = config.get('response_cache',
+                       os.environ.get('FLOWSA_RESPONSE_CACHE', 'off'))
+    if value is True:
+        return 'use'
+    value = str(value).lower() if value else 'off'
+    if value in ['false', 'none']:
+        return 'off'
+    if value == 'true':
+        return 'use'
+    if value not in CACHE_MODES:
+        log.warning(f'Unrecognized response_cache "{value}", must be one of '
+                    f'{CACHE_MODES}. Not caching responses.')
+        return 'off'
+    return value
+
+
+def max_size() -> int:
+    """Cache size limit in bytes, from FLOWSA_RESPONSE_CACHE_GB"""
+    gb = float(os.environ.get('FLOWSA_RESPONSE_CACHE_GB',
+                              DEFAULT_MAX_SIZE_GB))
+    return int(gb * 1024 ** 3)
+
+
+def ttl(config: dict) -> float:
+    """
+    Time to live of cached responses in seconds, from
+    config['response_cache_ttl'] or the FLOWSA_RESPONSE_CACHE_TTL
+    environment variable, in days.
+    """
+    days = (config.get('response_cache_ttl')
+            or os.environ.get('FLOWSA_RESPONSE_CACHE_TTL')
+            or DEFAULT_TTL_DAYS)
+    return float(days) * 24 * 60 * 60
+
+
+def redact(url: str) -> str:
+    """Replace the values of url query parameters named like 'key'"""
+    parts = parse.urlsplit(url)
+    query = [(k, 'REDACTED' if 'key' in k.lower() else v)
+             for k, v in parse.parse_qsl(parts.query,
+                                         keep_blank_values=True)]
+    return parse.urlunsplit(parts._replace(
+        query=parse.urlencode(query, safe='=&%,:')))
+
+
+def request_key(url: str, **request_kwargs) -> str:
+    """Cache key of a url requested with request_kwargs"""
+    return hashlib.sha256(json.dumps(
+        {'url': url, **request_kwargs}, sort_keys=True, default=str
+    ).encode()).hexdigest()
+
+
+def load(key: str, url: str, max_age: float = None):
+    """
+    Cached response for key, or None if there is none or it is older than
+    max_age seconds.
+    :return: requests.Response
+    """
+    content_file = responsepath / f'{key}.bin'
+    try:
+        with open(responsepath / f'{key}.json') as f:
+            meta = json.load(f)
+        content = content_file.read_bytes()
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if max_age is not None and time.time() - meta['fetched'] > max_age:
+        return None
+    # mark as recently used
+    os.utime(content_file)
+    response = requests.Response()
+    response._content = content
+    response.status_code = meta['status_code']
+    response.reason = meta['reason']
+    response.headers = requests.structures.CaseInsensitiveDict(
+        meta['headers'])
+    response.encoding = meta['encoding']
+    response.url = url
+    return response
+
+
+def save(key: str, url: str, response) -> None:
+    """Store the raw content, status and headers of a response"""
+    responsepath.mkdir(parents=True, exist_ok=True)
+    meta = {'url': redact(url),
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'headers': dict(response.headers),
+            'encoding': response.encoding,
+            'fetched': time.time()}
+    try:
+        _atomic_write(responsepath / f'{key}.bin',
+                      lambda p: p.write_bytes(response.content))
+        _atomic_write(responsepath / f'{key}.json',
+                      lambda p: p.write_text(json.dumps(meta)))
+    except Exception as e:
+        log.warning('Unable to cache response for %s: %s', redact(url), e)
+
+
+def cached_request(url: str, request, cache_mode: str,
+                   max_age: float = None, **request_kwargs):
+    """
+    Response for url, from the cache or from request(url, **request_kwargs)
+    depending on cache_mode.
+    :return: tuple, (response, cache key, whether it was cached)
+    """
+    key = request_key(url, **request_kwargs)
+    if cache_mode in ['use', 'offline']:
+        response = load(key, url,
+                        max_age=None if cache_mode == 'offline' else max_age)
+        if response is not None:
+            log.info('Using cached response for %s', redact(url))
+            return response, key, True
+        if cache_mode == 'offline':
+            raise ResponseNotCachedError(redact(url))
+    response = request(url, **request_kwargs)
+    if cache_mode != 'off':
+        save(key, url, response)
+    return response, key, False
+
+
+def manifest_record(url: str, response, key: str, cached: bool) -> dict:
+    """Manifest entry of a url requested for an FBA build"""
+    content = response.content or b''
+    return {'url': redact(url),
+            'key': key,
+            'status_code': response.status_code,
+            'size': len(content),
+            'sha256': hashlib.sha256(content).hexdigest(),
+            'from_cache': cached}
+
+
+def write_manifest(name: str, records: list) -> None:
+    """Write the manifest of the responses used to build FBA name"""
+    settings.fbaoutputpath.mkdir(parents=True, exist_ok=True)
+    manifest = {'name': name,
+                'created': datetime.now(timezone.utc).isoformat(),
+                'responses': records}
+    _atomic_write(settings.fbaoutputpath / f'{name}_response_manifest.json',
+                  lambda p: p.write_text(json.dumps(manifest, indent=2)))
+
+
+def entries() -> list:
+    """Cached response files, least recently used first"""
+    if not responsepath.exists():
+        return []
+    return sorted(responsepath.glob('*.bin'),
+                  key=lambda f: f.stat().st_mtime)
+
+
+def evict(size: int = None, max_age: float = None) -> list:
+    """
+    Remove entries fetched more than max_age seconds ago, then the least
+    recently used entries until the cache is at most size bytes, default
+    max_size().
+    :return: list, removed keys
+    """
+    size = max_size() if size is None else size
+    files = entries()
+    total = sum(f.stat().st_size for f in files)
+    removed = []
+    for f in files:
+        expired = False
+        if max_age is not None:
+            try:
+                with open(f.with_suffix('.json')) as m:
+                    expired = time.time() - json.load(m)['fetched'] > max_age
+            except (FileNotFoundError, json.JSONDecodeError):
+                expired = True
+        if total <= size and not expired:
+            continue
+        total -= f.stat().st_size
+        f.unlink()
+        f.with_suffix('.json').unlink(missing_ok=True)
+        removed.append(f.stem)
+    if removed:
+        log.info('Evicted %s entries from the response cache', len(removed))
+    return removed
+
+
+def clear() -> list:
+    """
+    Remove all entries.
+    :return: list, removed keys
+    """
+    return evict(size=0)
@@ -10,6 +10,7 @@ setup(
     packages=find_packages(),
     package_dir={'flowsa': 'flowsa'},
     include_package_data=True,
+    entry_points={'console_scripts': ['flowsa=flowsa.__main__:main']},
     python_requires=">=3.9",
     install_requires=[
         'fedelemflowlist @ git+https://github.com/USEPA/fedelemflowlist.git#egg=fedelemflowlist',
@@ -2,6 +2,7 @@
 Test FBS method yaml during github action for succesful loading
 """
 import pytest
+import flowsa
 from flowsa.common import check_method_status, load_yaml_dict, \
     seeAvailableFlowByModels
 
@@ -31,5 +32,17 @@ def test_FBS_methods():
         load_yaml_dict(m, flowbytype='FBS')
 
 
+def test_plan_shared_sources():
+    """Attribution sources used by multiple activity sets with the same
+    config are identified as shared nodes"""
+    plan = flowsa.plan('CNHW_national_2014')
+    nodes = plan.nodes
+    shared = nodes.query('shared')
+    assert 'Employment_state_2014' in shared['name'].values
+    assert (shared['uses'] > 1).all()
+    assert set(plan.shared_nodes()) == set(shared['node_id'])
+    # every edge connects nodes in the plan
+    assert set(plan.edges['child']).issubset(nodes['node_id'])
+
 if __name__ == "__main__":
     test_FBS_methods()
@@ -0,0 +1,168 @@
+"""
+Tests of batch builds of FBAs and FBSs (flowsa.build)
+"""
+import json
+import os
+import threading
+import time
+import numpy as np
+import pytest
+from flowsa import build, flowsa_log, generateflowbyactivity, settings
+
+
+@pytest.fixture(autouse=True)
+def local_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings.paths, 'local_path', tmp_path)
+    monkeypatch.setattr(flowsa_log, 'logoutputpath', tmp_path)
+    return tmp_path
+
+
+def make_job(kind, name, year=None, dependencies=(), inputs=()):
+    job_id = f'{kind}:{name}' + (f'_{year}' if year else '')
+    return job_id, {'job': job_id, 'kind': kind, 'name': name,
+                    'year': year, 'outputs': [name],
+                    'dependencies': list(dependencies),
+                    'inputs': [str(f) for f in inputs], 'requested': True,
+                    'excluded': None, 'error': None}
+
+
+def output_file(local_path, job):
+    category = {'FBA': 'FlowByActivity', 'FBS': 'FlowBySector'}[job['kind']]
+    name = job['name'] + (f'_{job["year"]}' if job['year'] else '')
+    return local_path / category / f'{name}_v2.0.4.parquet'
+
+
+@pytest.fixture
+def fake_run_job(local_path, monkeypatch):
+    """Write an empty output file, failing for 'broken' datasets"""
+    calls = []
+    lock = threading.Lock()
+
+    def run_job(job, download=False):
+        with lock:
+            calls.append(('start', job['job']))
+        time.sleep(0.05)
+        if job['name'] == 'broken':
+            status = 'failed'
+        else:
+            status = 'built'
+            f = output_file(local_path, job)
+            f.parent.mkdir(parents=True, exist_ok=True)
+            f.touch()
+        with lock:
+            calls.append(('end', job['job']))
+        return {'status': status, 'seconds': 0.05, 'peak_memory_mb': 1}
+    monkeypatch.setattr(build, 'run_job', run_job)
+    return calls
+
+
+def test_run_jobs_in_dependency_order(fake_run_job, local_path):
+    source_yaml = local_path / 'a.yaml'
+    source_yaml.touch()
+    jobs = dict([
+        make_job('FBA', 'a', '2020', inputs=[source_yaml]),
+        make_job('FBA', 'broken', '2020'),
+        make_job('FBS', 'x', dependencies=['FBA:a_2020']),
+        make_job('FBS', 'y', dependencies=['FBA:broken_2020']),
+        make_job('FBS', 'z', dependencies=['FBS:x', 'FBA:a_2020']),
+    ])
+    results = build.run_jobs(jobs, executor_type='thread', max_workers=4)
+    assert {k: r['status'] for k, r in results.items()} == {
+        'FBA:a_2020': 'built', 'FBA:broken_2020': 'failed',
+        'FBS:x': 'built', 'FBS:y': 'skipped', 'FBS:z': 'built'}
+    # a job starts once the jobs it depends on have ended
+    for job_id, job in jobs.items():
+        if ('start', job_id) in fake_run_job:
+            start = fake_run_job.index(('start', job_id))
+            assert all(fake_run_job.index(('end', d)) < start
+                       for d in job['dependencies'])
+
+    # current outputs are not built again
+    fake_run_job.clear()
+    results = build.run_jobs(jobs, executor_type='thread', max_workers=4)
+    assert [r['status'] for r in results.values()] == [
+        'current', 'failed', 'current', 'skipped', 'current']
+
+    # outputs older than their inputs, or than the outputs of the jobs they
+    # depend on, are built again
+    later = time.time() + 10
+    os.utime(source_yaml, (later, later))
+    results = build.run_jobs(jobs, executor_type='serial')
+    assert results['FBA:a_2020']['reason'] == 'a.yaml is newer than the output'
+    assert [r['status'] for r in results.values()] == [
+        'built', 'failed', 'built', 'skipped', 'built']
+
+    results = build.run_jobs(jobs, executor_type='serial', force=True)
+    assert results['FBS:x'] == {'status': 'built', 'seconds': 0.05,
+                                'peak_memory_mb': 1, 'reason': 'forced'}
+
+
+def test_excluded_jobs_do_not_block(fake_run_job):
+    jobs = dict([make_job('FBA', 'private', '2020'),
+                 make_job('FBS', 'x', dependencies=['FBA:private_2020'])])
+    jobs['FBA:private_2020']['excluded'] = 'Private data'
+    results = build.run_jobs(jobs)
+    assert results['FBA:private_2020'] == {'status': 'excluded',
+                                           'reason': 'Private data'}
+    assert results['FBS:x']['status'] == 'built'
+
+
+def test_write_report(fake_run_job, local_path):
+    jobs = dict([make_job('FBA', 'a', '2020'),
+                 make_job('FBA', 'broken', '2020')])
+    results = build.run_jobs(jobs)
+    started = build.datetime.now(build.timezone.utc)
+    report = build.write_report(jobs, results, started,
+                                local_path / 'report.json',
+                                executor_type='serial')
+    assert report == json.loads((local_path / 'report.json').read_text())
+    assert report['counts'] == {'built': 1, 'current': 0, 'failed': 1,
+                                'skipped': 0, 'excluded': 0}
+    assert [j['status'] for j in report['jobs']] == ['built', 'failed']
+    assert report['executor_type'] == 'serial'
+
+
+def test_run_job_records_failures_and_peak_memory(monkeypatch):
+    def generate(source, year):
+        if source == 'broken':
+            raise ValueError('no data')
+        # about 200 MB
+        np.ones(25_000_000).sum()
+    monkeypatch.setattr(generateflowbyactivity, 'main', generate)
+    _, job = make_job('FBA', 'a', '2020')
+    result = build.run_job(job)
+    assert result['status'] == 'built'
+    if result['peak_memory_mb'] is not None:
+        assert result['peak_memory_mb'] > 150
+
+    _, job = make_job('FBA', 'broken', '2020')
+    assert build.run_job(job)['error'] == 'ValueError: no data'
+
+
+def test_resolve_dependencies():
+    jobs = build.resolve(
+        fbs=['Water_national_2015_m1'],
+        method_status={'USGS_WU_Coef': {'Active': True,
+                                        'Status': 'Private data'}})
+    job_ids = list(jobs)
+    assert job_ids[-1] == 'FBS:Water_national_2015_m1'
+    # each job comes after the jobs it depends on
+    for n, job_id in enumerate(job_ids):
+        assert all(job_ids.index(d) < n
+                   for d in jobs[job_id]['dependencies'])
+    assert {'FBA:USGS_NWIS_WU_2015', 'FBS:Employment_state_2015'}.issubset(
+        jobs['FBS:Water_national_2015_m1']['dependencies'])
+    assert jobs['FBA:USGS_WU_Coef_2005']['excluded'] == 'Private data'
+
+    # requested jobs are not excluded
+    jobs = build.resolve(
+        fba=['USGS_WU_Coef:2005', 'USDA_CoA_*:2012,2017'],
+        method_status={'USGS_WU_Coef': {'Active': True}})
+    assert jobs['FBA:USGS_WU_Coef_2005']['excluded'] is None
+    assert {'FBA:USDA_CoA_Cropland_2012', 'FBA:USDA_CoA_Livestock_2017',
+            'FBA:USDA_CoA_Cropland_NAICS_2017'}.issubset(jobs)
+
+
+def test_parse_years():
+    assert build.parse_years('2015-2017') == ['2015', '2016', '2017']
+    assert build.parse_years('2015, 2017') == ['2015', '2017']
@@ -0,0 +1,277 @@
+"""
+Tests of FBA generation against a local http server: concurrent url
+requests (flowsa.fetch), the response cache (flowsa.response_cache), and
+streaming and multi-year generation (flowsa.generateflowbyactivity)
+"""
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+import pandas as pd
+import pytest
+import requests
+from types import SimpleNamespace
+from flowsa import fetch, flowsa_log, generateflowbyactivity, response_cache, \
+    settings
+from flowsa.exceptions import ResponseNotCachedError
+from flowsa.generateflowbyactivity import (call_urls, parse_data,
+                                           standardize_fba, stream_urls)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    /delay/<n>/<seconds>: respond n after seconds
+    /flaky/<key>: respond 503 the first time, then key
+    /csv/<n>: respond n rows of csv
+    anything else: respond 404
+    """
+    def do_GET(self):
+        self.server.requests.append((self.path, time.monotonic()))
+        parts = parse.urlsplit(self.path).path.strip('/').split('/')
+        if parts[0] == 'delay':
+            time.sleep(float(parts[2]))
+            self._respond(200, parts[1])
+        elif parts[0] == 'csv':
+            self._respond(200, 'Location,Kind,FlowAmount\n' + ''.join(
+                f'{n:05d},{"ab"[n % 2]},{n * 1.5}\n'
+                for n in range(int(parts[1]))))
+        elif parts[0] == 'flaky' and self.path in self.server.failed:
+            self._respond(200, parts[1])
+        elif parts[0] == 'flaky':
+            self.server.failed.add(self.path)
+            self._respond(503, 'unavailable')
+        else:
+            self._respond(404, 'not found')
+
+    def _respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(response_cache, 'responsepath', tmp_path / 'cache')
+    monkeypatch.setattr(settings, 'fbaoutputpath', tmp_path / 'fba')
+    monkeypatch.setattr(generateflowbyactivity, 'fragmentpath',
+                        tmp_path / 'fragments')
+    return tmp_path
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.requests, httpd.failed = [], set()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def base_url(server):
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def response_to_df(*, resp, url, **_):
+    return pd.DataFrame({'url': [url], 'text': [resp.text]})
+
+
+def test_call_urls_in_url_order(server):
+    # the first urls respond last
+    urls = [f'{base_url(server)}/delay/{n}/{0.05 * (8 - n)}'
+            for n in range(8)]
+    start = time.perf_counter()
+    df_list = call_urls(url_list=urls, source='test', year=None,
+                        config={'call_response_fxn': response_to_df,
+                                'max_concurrency': 8})
+    elapsed = time.perf_counter() - start
+    assert [df.url[0] for df in df_list] == urls
+    assert [df.text[0] for df in df_list] == [str(n) for n in range(8)]
+    # serially, the requests take 1.8 s
+    assert elapsed < 1
+
+
+def test_fetch_urls_rate_limit_per_host(server):
+    urls = [f'{base_url(server)}/delay/{n}/0' for n in range(4)]
+    list(fetch.fetch_urls(urls, {'time_delay': 0.1, 'max_concurrency': 4}))
+    starts = sorted(t for _, t in server.requests)
+    assert all(b - a > 0.09 for a, b in zip(starts, starts[1:]))
+
+
+def test_rate_limiter_hosts_are_independent():
+    limiter = fetch.RateLimiter(delay=10)
+    assert limiter.acquire('http://a.example/1') == 0
+    assert limiter.acquire('http://b.example/1') == 0
+
+
+def test_fetch_urls_retries(server):
+    config = {'retry_backoff': 0.01, 'max_concurrency': 2}
+    urls = [f'{base_url(server)}/flaky/{key}' for key in ['a', 'b']]
+    assert ([resp.text for _, resp in fetch.fetch_urls(urls, config)]
+            == ['a', 'b'])
+    assert len(server.requests) == 4
+
+    # client errors are not retried
+    server.requests.clear()
+    with pytest.raises(requests.exceptions.HTTPError):
+        list(fetch.fetch_urls([f'{base_url(server)}/missing'], config))
+    assert len(server.requests) == 1
+
+
+def test_fetch_thread_records_reach_thread_log(server, tmp_path,
+                                               monkeypatch):
+    monkeypatch.setattr(flowsa_log, 'logoutputpath', tmp_path)
+    config = {'retry_backoff': 0.01, 'max_concurrency': 2}
+    urls = [f'{base_url(server)}/flaky/{key}' for key in ['a', 'b']]
+    with flowsa_log.thread_log_file('flowsa_test.log'):
+        list(fetch.fetch_urls(urls, config))
+        thread_log = (tmp_path / 'flowsa_test.log').read_text()
+    assert thread_log.count('retrying') == 2
+
+
+def test_get_max_concurrency(monkeypatch, caplog):
+    monkeypatch.delenv('FLOWSA_MAX_CONCURRENCY', raising=False)
+    assert fetch.get_max_concurrency({}) == 1
+    assert fetch.get_max_concurrency({'max_concurrency': 4}) == 4
+    monkeypatch.setenv('FLOWSA_MAX_CONCURRENCY', '3')
+    assert fetch.get_max_concurrency({}) == 3
+    assert fetch.get_max_concurrency({'max_concurrency': 'all'}) == 1
+    assert 'Unrecognized max_concurrency "all"' in caplog.text
+
+
+def test_response_cache_replay(server, cache_path):
+    urls = [f'{base_url(server)}/delay/{n}/0?key=secret' for n in range(3)]
+    config = {'call_response_fxn': response_to_df, 'max_concurrency': 2,
+              'response_cache': 'use'}
+    first = call_urls(url_list=urls, source='test', year='2020',
+                      config=config)
+    assert len(server.requests) == 3
+    manifest_file = cache_path / 'fba' / 'test_2020_response_manifest.json'
+    manifest = json.loads(manifest_file.read_text())
+    assert [r['from_cache'] for r in manifest['responses']] == [False] * 3
+    assert 'secret' not in manifest_file.read_text()
+
+    # responses are replayed without requests, in both modes
+    for mode in ['use', 'offline']:
+        replayed = call_urls(url_list=urls, source='test', year='2020',
+                             config={**config, 'response_cache': mode})
+        pd.testing.assert_frame_equal(pd.concat(first), pd.concat(replayed))
+    assert len(server.requests) == 3
+    manifest = json.loads(manifest_file.read_text())
+    assert [r['from_cache'] for r in manifest['responses']] == [True] * 3
+
+    # refresh requests again, and offline fails for uncached urls
+    call_urls(url_list=urls, source='test', year='2020',
+              config={**config, 'response_cache': 'refresh'})
+    assert len(server.requests) == 6
+    with pytest.raises(ResponseNotCachedError):
+        call_urls(url_list=[f'{base_url(server)}/delay/9/0'], source='test',
+                  year='2020', config={**config, 'response_cache': 'offline'})
+
+
+def test_response_cache_eviction(server, cache_path):
+    urls = [f'{base_url(server)}/delay/{n}/0' for n in range(3)]
+    list(fetch.fetch_urls(urls, {'response_cache': 'use'}))
+    assert len(response_cache.entries()) == 3
+
+    # expired responses are requested again, and evicted
+    list(fetch.fetch_urls(urls[:1], {'response_cache': 'use',
+                                     'response_cache_ttl': 1e-9}))
+    assert len(server.requests) == 4
+    assert response_cache.entries() == []
+
+    # the least recently used responses are evicted first
+    list(fetch.fetch_urls(urls, {'response_cache': 'use'}))
+    list(fetch.fetch_urls(urls[:1], {'response_cache': 'use'}))
+    assert len(response_cache.evict(size=1)) == 2
+    list(fetch.fetch_urls(urls[:1], {'response_cache': 'offline'}))
+    with pytest.raises(ResponseNotCachedError):
+        list(fetch.fetch_urls(urls[1:], {'response_cache': 'offline'}))
+
+    assert len(response_cache.clear()) == 1
+
+
+def test_response_cache_mode(monkeypatch):
+    monkeypatch.delenv('FLOWSA_RESPONSE_CACHE', raising=False)
+    assert response_cache.mode({}) == 'off'
+    assert response_cache.mode({'response_cache': True}) == 'use'
+    assert response_cache.mode({'response_cache': 'Offline'}) == 'offline'
+    assert response_cache.mode({'response_cache': 'sometimes'}) == 'off'
+    monkeypatch.setenv('FLOWSA_RESPONSE_CACHE', 'refresh')
+    assert response_cache.mode({}) == 'refresh'
+
+
+def read_csv_response(*, resp, **_):
+    return pd.read_csv(io.StringIO(resp.text), dtype={'Location': str})
+
+
+def parse_csv(*, df_list, year, **_):
+    df = pd.concat(df_list, ignore_index=True)
+    return df.assign(SourceName='test', Class='Other', FlowName=df.Kind,
+                     Unit='p', Year=year, ActivityProducedBy='111',
+                     FlowType='ELEMENTARY_FLOW').drop(columns='Kind')
+
+
+def parse_csv_by_kind(*, df_list, year, **_):
+    df = parse_csv(df_list=df_list, year=year)
+    return [df.query('FlowName == @kind').assign(SourceName=f'test_{kind}')
+            for kind in ['a', 'b']]
+
+
+@pytest.mark.parametrize('parse_fxn', [parse_csv, parse_csv_by_kind])
+def test_stream_urls_matches_call_urls(server, parse_fxn):
+    urls = [f'{base_url(server)}/csv/{n}' for n in [5, 0, 40, 12]]
+    config = {'call_response_fxn': read_csv_response,
+              'parse_response_fxn': parse_fxn, 'max_concurrency': 2}
+    parsed = parse_data(df_list=call_urls(url_list=urls, source='test',
+                                          year='2020', config=config),
+                        source='test', year='2020', config=config)
+    streamed = stream_urls(url_list=urls, source='test', year='2020',
+                           config=config)
+    if isinstance(parsed, list):
+        parsed = {df.SourceName.iloc[0]: df for df in parsed}
+    else:
+        parsed = {'test': parsed}
+    assert list(streamed) == list(parsed)
+    for source_name, df in parsed.items():
+        pd.testing.assert_frame_equal(standardize_fba(streamed[source_name]),
+                                      standardize_fba(df))
+    assert not any((settings.fbaoutputpath.parent / 'fragments').glob('*/*'))
+
+
+def test_main_generates_years_in_parallel(server, tmp_path, monkeypatch):
+    config = {'url': {'base_url': f'{base_url(server)}/csv/__year__'},
+              'call_response_fxn': read_csv_response,
+              'parse_response_fxn': parse_csv, 'years': [3, 4, 5]}
+    monkeypatch.setattr(generateflowbyactivity, 'load_yaml_dict',
+                        lambda *_, **__: dict(config))
+    # FBAs are not written
+    monkeypatch.setattr(generateflowbyactivity, 'write_df_to_file',
+                        lambda *_: None)
+    monkeypatch.setattr(generateflowbyactivity, 'write_metadata',
+                        lambda *_, **__: None)
+    monkeypatch.setattr(generateflowbyactivity, 'set_fb_meta',
+                        lambda name, category: SimpleNamespace(
+                            tool_version='0', git_hash=None,
+                            category=category))
+    monkeypatch.setattr(flowsa_log, 'logoutputpath', tmp_path / 'log')
+    (tmp_path / 'log').mkdir()
+
+    summary = generateflowbyactivity.main(
+        source='test', year='3-5', year_executor='thread', max_workers=3)
+    assert summary.FBA.tolist() == ['test_3', 'test_4', 'test_5']
+    assert summary.Rows.tolist() == [3, 4, 5]
+    # each year has a log of its own records only
+    for year in [3, 4, 5]:
+        year_log = (tmp_path / 'log' / f'test_{year}_v0.log').read_text()
+        assert f'/csv/{year}' in year_log
+        assert all(f'/csv/{other}' not in year_log
+                   for other in [3, 4, 5] if other != year)
+    assert not list((tmp_path / 'log').glob('flowsa_test_*.log'))
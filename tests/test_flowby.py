@@ -0,0 +1,905 @@
+"""
+Tests of _FlowBy methods, and the functions they use, on small fixed
+datasets. Benchmarks on large synthetic datasets are marked `benchmark` and
+can be deselected with `-m "not benchmark"`.
+"""
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from flowsa import chunking, naics
+from flowsa.flowby import _FlowBy, _passthrough_columns, flowby_config
+from flowsa.flowbyactivity import FlowByActivity
+from flowsa.flowbysector import FlowBySector
+
+
+def sector_pairs_fb():
+    """FlowBy of the combinations of SectorProducedBy and ConsumedBy"""
+    return _FlowBy(pd.DataFrame({
+        'FlowType': ['ELEMENTARY_FLOW', 'ELEMENTARY_FLOW',
+                     'TECHNOSPHERE_FLOW', 'TECHNOSPHERE_FLOW', 'WASTE_FLOW',
+                     'ELEMENTARY_FLOW'],
+        'SectorProducedBy': ['221310', '311', '311', '111', None, '22'],
+        'SectorConsumedBy': ['F010', 'F010', '42', None, '42', 'F01000'],
+        'FlowAmount': 1.
+    }), full_name='sector_pairs', config={})
+
+
+def test_add_primary_secondary_columns():
+    fb = sector_pairs_fb().add_primary_secondary_columns('Sector')
+    # utilities delivering to final demand are attributed to final demand,
+    # and technosphere flows to the consuming sector
+    assert fb.PrimarySector.tolist() == ['F010', '311', '42', '111', '42',
+                                         'F01000']
+    assert fb.SecondarySector.tolist() == ['221310', 'F010', '311', None,
+                                           None, '22']
+
+
+def test_add_primary_secondary_columns_primary_action_type():
+    fb = sector_pairs_fb()
+    fb.config = {'primary_action_type': 'Consumed'}
+    fb = fb.add_primary_secondary_columns('Sector')
+    assert fb['PrimarySector'].equals(fb['SectorConsumedBy'])
+    assert fb['SecondarySector'].equals(fb['SectorProducedBy'])
+
+
+def synthetic_sector_pairs_fb(n, seed=0):
+    """FlowBy of n random combinations of SectorProducedBy and ConsumedBy"""
+    rng = np.random.default_rng(seed)
+    produced = np.array(['22', '221', '221310', '111', '311', '1114', 'A',
+                         None], dtype=object)
+    consumed = np.array(['F010', 'F01000', '221', '111', '42', 'B', None,
+                         None], dtype=object)
+    flow_types = np.array(['ELEMENTARY_FLOW', 'TECHNOSPHERE_FLOW',
+                           'WASTE_FLOW'], dtype=object)
+    return _FlowBy(pd.DataFrame({
+        'FlowType': flow_types[rng.integers(0, len(flow_types), n)],
+        'SectorProducedBy': produced[rng.integers(0, len(produced), n)],
+        'SectorConsumedBy': consumed[rng.integers(0, len(consumed), n)],
+        'FlowAmount': rng.random(n)
+    }), full_name='synthetic', config={})
+
+
+def row_wise_secondary(fb, col_type='Sector'):
+    """Secondary column found with a row-wise apply, as previously"""
+    def _identify_secondary(row):
+        sectors = [row[f'{col_type}ProducedBy'],
+                   row[f'{col_type}ConsumedBy']]
+        sectors.remove(row[f'Primary{col_type}'])
+        return sectors[0]
+    return fb.apply(_identify_secondary, axis='columns').astype('object')
+
+
+@pytest.mark.benchmark
+def test_benchmark_add_primary_secondary_columns():
+    n = 5_000_000
+    fb = synthetic_sector_pairs_fb(n)
+
+    start = time.perf_counter()
+    result = fb.add_primary_secondary_columns('Sector')
+    vectorized = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = row_wise_secondary(result)
+    row_wise = time.perf_counter() - start
+
+    print(f'\nSecondarySector of {n:,} rows: {vectorized:.2f}s vectorized, '
+          f'{row_wise:.2f}s row-wise')
+    pd.testing.assert_series_equal(result['SecondarySector'], expected,
+                                   check_names=False)
+    assert vectorized * 10 < row_wise
+
+
+def fbs_data():
+    """FlowBySector data with repeated identifiers"""
+    return pd.DataFrame({
+        'Flowable': ['Water'] * 3 + ['Carbon dioxide'] * 2 + ['Methane'] * 3,
+        'Class': 'Chemicals',
+        'SourceName': 'sample',
+        'Unit': ['Mgal'] * 3 + ['kg'] * 5,
+        'FlowType': 'ELEMENTARY_FLOW',
+        'Context': ['water'] * 3 + ['air'] * 3 + [''] * 2,
+        'Location': ['06000', '06000', '06037', '00000', '00000', '48000',
+                     '48000', '48000'],
+        'LocationSystem': 'FIPS_2015',
+        'SectorProducedBy': ['111', '111', '1111', '221', '221', None, None,
+                             None],
+        'SectorConsumedBy': None,
+        'SectorSourceName': 'NAICS_2012_Code',
+        'Year': 2015,
+        'FlowAmount': [1., 2., 4., 0., 5., 6., 7., 8.],
+        'DataReliability': [1., 3., np.nan, 2., 4., 5., 1., 3.],
+    })
+
+
+def sample_fbs(dtype_profile='object'):
+    return FlowBySector(fbs_data(), full_name='sample',
+                        config={'dtype_profile': dtype_profile})
+
+
+def as_object(fb):
+    df = pd.DataFrame(fb)
+    return (df.astype({c: 'object' for c in df.columns
+                       if isinstance(df[c].dtype, (pd.CategoricalDtype,
+                                                   pd.StringDtype))})
+            .replace({pd.NA: np.nan})
+            .sort_values(list(df.columns)).reset_index(drop=True))
+
+
+@pytest.mark.parametrize('dtype_profile', ['category', 'string'])
+def test_dtype_profile_matches_object(dtype_profile):
+    reference = sample_fbs()
+    fbs = sample_fbs(dtype_profile)
+    assert isinstance(fbs['Flowable'].dtype,
+                      (pd.CategoricalDtype, pd.StringDtype))
+    assert fbs.groupby_cols == reference.groupby_cols
+    pd.testing.assert_frame_equal(as_object(fbs), as_object(reference))
+    # aggregation and selection are unchanged
+    pd.testing.assert_frame_equal(as_object(fbs.aggregate_flowby()),
+                                  as_object(reference.aggregate_flowby()))
+    pd.testing.assert_frame_equal(
+        as_object(fbs.query('Location in ["06000", "06037"]')),
+        as_object(reference.query('Location in ["06000", "06037"]')))
+    pd.testing.assert_frame_equal(
+        as_object(fbs.add_primary_secondary_columns('Sector')),
+        as_object(reference.add_primary_secondary_columns('Sector')))
+
+
+def test_dtype_profile_category_memory():
+    data = pd.concat([fbs_data()] * 1_000, ignore_index=True)
+    reference = FlowBySector(data)
+    fbs = FlowBySector(data, config={'dtype_profile': 'category'})
+    assert (fbs.memory_usage(deep=True).sum()
+            < 0.25 * reference.memory_usage(deep=True).sum())
+
+
+@pytest.mark.parametrize('dtype_profile', ['category', 'string'])
+def test_dtype_profile_parquet_round_trip(dtype_profile, tmp_path):
+    pytest.importorskip('pyarrow', exc_type=ImportError)
+    fbs = sample_fbs(dtype_profile)
+    fbs.to_parquet(tmp_path / 'fbs.parquet')
+    stored = pd.read_parquet(tmp_path / 'fbs.parquet')
+    assert (stored.dtypes[fbs.groupby_cols[:3]] == 'object').all()
+    pd.testing.assert_frame_equal(as_object(stored), as_object(fbs))
+    reloaded = FlowBySector(stored, config={'dtype_profile': dtype_profile})
+    pd.testing.assert_frame_equal(as_object(reloaded), as_object(fbs))
+
+
+def test_normalize_nulls():
+    df = pd.DataFrame({
+        'Class': 'Water', 'SourceName': 'sample',
+        'FlowName': ['Water', 'nan', '<NA>', 'None', '', None],
+        'FlowAmount': [1., np.nan, 2., 3., 4., 5.],
+        'Unit': 'kg', 'Location': '06000', 'Year': 2015})
+    fba = FlowByActivity(df)
+    assert fba.FlowName.isna().tolist() == [False] + [True] * 5
+    assert fba.FlowAmount.tolist() == [1., 0., 2., 3., 4., 5.]
+    # missing fields are added, as nulls or zeros
+    assert set(fba.columns) == set(flowby_config['fba_fields'])
+    assert fba.Compartment.isna().all()
+    assert (fba.Spread == 0).all()
+    # the data passed to the constructor are unchanged
+    assert df.FlowName.tolist() == ['Water', 'nan', '<NA>', 'None', '',
+                                    None]
+
+
+def test_normalized_columns_are_tracked():
+    fba = FlowByActivity(pd.DataFrame({
+        'FlowName': ['a', 'b'], 'Location': ['06000', '00000'],
+        'FlowAmount': [1.0, 2.0], 'Unit': ['kg', 'kg']}))
+    fields = frozenset(flowby_config['fba_fields'])
+    assert fba._normalized == fields
+    assert fba.query('Location == "06000"')._normalized == fields
+    assert fba[['Location', 'Unit']]._normalized == {'Location', 'Unit'}
+    assert fba.sort_values('FlowAmount').copy()._normalized == fields
+    assert pd.concat([fba, fba])._normalized == fields
+    assert fba.merge(fba[['Location']])._normalized == set()
+
+    assigned = fba.assign(Unit='')
+    assert assigned._normalized == fields - {'Unit'}
+    assert FlowByActivity(assigned).Unit.isna().all()
+    assert fba._normalized == fields
+
+    modified = fba.copy()
+    modified.loc[modified.Location == '06000', 'FlowName'] = 'None'
+    assert modified._normalized == set()
+    modified = fba.copy()
+    modified.replace({'Location': {'06000': ''}}, inplace=True)
+    assert 'Location' not in modified._normalized
+
+
+def test_modified_flowby_is_normalized_again():
+    fba = FlowByActivity(pd.DataFrame({
+        'FlowName': ['a', 'b'], 'Location': ['06000', '00000'],
+        'FlowAmount': [1.0, 2.0], 'Unit': ['kg', 'kg']}))
+    modified = fba.copy()
+    modified.loc[modified.Location == '06000', 'FlowName'] = 'None'
+    modified.replace({'Location': {'00000': ''}}, inplace=True)
+    modified = FlowByActivity(modified.assign(Unit=''))
+    assert modified.FlowName.isna().tolist() == [True, False]
+    assert modified.Location.isna().tolist() == [False, True]
+    assert modified.Unit.isna().all()
+    assert fba.FlowName.tolist() == ['a', 'b']
+
+
+def synthetic_fba_data(n, seed=0):
+    """DataFrame of n FBA rows with the null values found in raw data"""
+    rng = np.random.default_rng(seed)
+    text = np.array(['Water', 'Employment', 'nan', '<NA>', 'None', '',
+                     None, np.nan], dtype=object)
+    activities = np.array(['Crops', 'Mining', 'Livestock', '', None],
+                          dtype=object)
+    return pd.DataFrame({
+        'Class': rng.choice(['Water', 'Employment'], n),
+        'SourceName': 'synthetic',
+        'FlowName': text[rng.integers(0, len(text), n)],
+        'FlowAmount': np.where(rng.random(n) < 0.1, np.nan, rng.random(n)),
+        'Unit': rng.choice(['kg', 'Mgal', 'None'], n),
+        'FlowType': 'ELEMENTARY_FLOW',
+        'ActivityProducedBy': activities[rng.integers(0, len(activities), n)],
+        'ActivityConsumedBy': None,
+        'Compartment': text[rng.integers(0, len(text), n)],
+        'Location': rng.choice(['00000', '06000', '06037', '48000'], n),
+        'LocationSystem': 'FIPS_2015',
+        'Year': 2015,
+    })
+
+
+@pytest.mark.benchmark
+def test_benchmark_flowby_construction():
+    n = 2_000_000
+    df = synthetic_fba_data(n)
+
+    start = time.perf_counter()
+    fba = FlowByActivity(df)
+    construction = time.perf_counter() - start
+
+    # a normalized FlowBy is re-wrapped without checking its fields again,
+    # and the same data without the flag are normalized in full
+    subset = fba.query('Location != "00000"')
+    start = time.perf_counter()
+    flagged = FlowBySector(subset)
+    rewrap = time.perf_counter() - start
+
+    start = time.perf_counter()
+    normalized = FlowBySector(pd.DataFrame(subset))
+    unflagged = time.perf_counter() - start
+
+    print(f'\nFlowByActivity construction of {n:,} rows: '
+          f'{construction:.2f}s; FlowBySector of {len(subset):,} of them: '
+          f'{rewrap:.2f}s already normalized, {unflagged:.2f}s normalized '
+          f'again')
+    pd.testing.assert_frame_equal(pd.DataFrame(flagged),
+                                  pd.DataFrame(normalized))
+    assert rewrap < unflagged
+
+
+def fba_data():
+    """FlowByActivity data of water and employment flows"""
+    return pd.DataFrame({
+        'Class': ['Water', 'Water', 'Employment', 'Employment', 'Water'],
+        'SourceName': 'sample',
+        'FlowName': ['Water', 'Water', 'Jobs', 'Jobs', 'Water'],
+        'FlowAmount': [1., 2., 3., 4., 5.],
+        'Unit': ['kg', 'Mgal', 'p', 'p', 'kg'],
+        'FlowType': 'ELEMENTARY_FLOW',
+        'ActivityProducedBy': ['Crops', 'Mining', 'Mining', 'Livestock',
+                               None],
+        'ActivityConsumedBy': [None, None, None, None, 'Crops'],
+        'Location': ['06000', '06037', '06000', '00000', '06000'],
+        'Year': 2015,
+    })
+
+
+@pytest.mark.parametrize('selection_fields, exclusion_fields, flows', [
+    ({'Class': 'Water'}, {}, [1., 2., 5.]),
+    ({'Class': 'Water', 'Unit': ['kg', 'Mgal']}, {'Location': '06037'},
+     [1., 5.]),
+    ({'Activity': ['Crops', 'Mining']},
+     {'conditional': {'Class': 'Employment', 'Location': '06000'}},
+     [1., 2., 5.]),
+    ({'PrimaryActivity': 'Crops', 'Unit': 'kg'}, {}, [1., 5.]),
+    ({'Location': ['99999']}, {}, []),
+])
+def test_select_by_fields(selection_fields, exclusion_fields, flows):
+    fba = FlowByActivity(fba_data())
+    result = fba.select_by_fields(selection_fields, exclusion_fields)
+    assert result.FlowAmount.tolist() == flows
+    assert list(result.columns) == list(fba.columns)
+    assert result.index.tolist() == list(range(len(flows)))
+
+
+def test_select_by_fields_replaces_values():
+    fba = FlowByActivity(fba_data())
+    result = fba.select_by_fields(
+        {'Activity': {'Crops': 'Agriculture', 'Mining': 'Mines'}})
+    assert result.ActivityProducedBy.fillna('').tolist() == [
+        'Agriculture', 'Mines', 'Mines', '']
+    assert result.ActivityConsumedBy.fillna('').tolist() == [
+        '', '', '', 'Agriculture']
+
+    # only the primary activity is selected and replaced
+    result = fba.select_by_fields({'PrimaryActivity': {'Mining': 'Mines'}})
+    assert result.FlowAmount.tolist() == [2., 3.]
+    assert result.ActivityProducedBy.tolist() == ['Mines', 'Mines']
+    assert 'PrimaryActivity' not in result
+
+    # columns replaced with empty strings only are null
+    result = fba.select_by_fields({'FlowName': {'Water': ''}})
+    assert result.FlowAmount.tolist() == [1., 2., 5.]
+    assert result.FlowName.isna().all()
+
+
+ACTIVITY_SETS = {
+    'water': {'selection_fields': {'Class': 'Water',
+                                   'Activity': ['Crops', 'Livestock']},
+              'exclusion_fields': {'Location': '00000'}},
+    'employment': {'selection_fields': {
+        'Class': 'Employment', 'PrimaryActivity': {'Mining': 'Mines'}}},
+    'units': {'selection_fields': {'Unit': {'kg': 'kilogram'},
+                                   'Location': ['06000', '06037']}},
+    'unselected': {'exclusion_fields': {'Class': 'Water'}},
+}
+
+
+def test_activity_sets(caplog):
+    fba = FlowByActivity(fba_data(), full_name='sample',
+                         config={'year': 2015,
+                                 'activity_sets': ACTIVITY_SETS})
+    result = fba.activity_sets()
+    assert [r.full_name for r in result] == [
+        f'sample.{activity_set}' for activity_set in ACTIVITY_SETS]
+    assert [r.config for r in result] == [
+        {'year': 2015, **activity_config}
+        for activity_config in ACTIVITY_SETS.values()]
+    assert [r.FlowAmount.tolist() for r in result] == [
+        [1., 5.], [3.], [1., 5.], [3., 4.]]
+    assert all((r.SourceName == r.full_name).all() for r in result)
+    assert result[1].ActivityProducedBy.tolist() == ['Mines']
+    assert result[2].Unit.tolist() == ['kilogram', 'kilogram']
+    # 'units' overlaps with 'water', and the row with Unit 'Mgal' is not
+    # in any activity set
+    assert 'multiple activity sets' in caplog.text
+    assert 'not assigned to an activity set' in caplog.text
+
+
+def test_equally_attribute():
+    # flows as mapped to NAICS 6 sectors: 1114 to its four sectors, 11111
+    # to 111110, and group 3 to two sectors of different secondary sectors
+    fb = _FlowBy(pd.DataFrame({
+        'group_id': [0, 0, 0, 0, 1, 2, 2, 3, 3],
+        'Location': '06000',
+        'FlowType': 'ELEMENTARY_FLOW',
+        'SectorProducedBy': ['111411', '111419', '111421', '111422',
+                             '111110', '111110', '221310', '111110',
+                             '111110'],
+        'SectorConsumedBy': [None] * 7 + ['F010', '221310'],
+        'FlowAmount': [100.] * 4 + [10., 60., 60., 8., 8.],
+    }), full_name='sample',
+        config={'industry_spec': {'default': 'NAICS_6'},
+                'target_naics_year': 2012})
+    result = fb.equally_attribute()
+    # each level of the hierarchy splits a flow between its sectors
+    assert result.FlowAmount.tolist() == [25.] * 4 + [10., 30., 30., 4., 4.]
+    assert list(result.columns) == list(fb.columns)
+
+
+def employment_attribution(attribute_on=None, second_unit=False):
+    """
+    State-level flows in four groups, and state-level employment by sector
+    to attribute them with. Employment is missing for the sectors of group 3.
+    """
+    config = {'geoscale': 'state'}
+    if attribute_on is not None:
+        config['attribute_on'] = attribute_on
+    fb = _FlowBy(pd.DataFrame({
+        'group_id': [0, 0, 1, 1, 2, 3, 3],
+        'Location': ['06000'] * 4 + ['48000'] * 3,
+        'Class': ['Employment'] * 2 + ['Other'] * 2 + ['Employment'] * 3,
+        'FlowType': 'TECHNOSPHERE_FLOW',
+        'SectorProducedBy': ['111110', '221310', '111110', '311111',
+                             '111110', '221310', '311111'],
+        'SectorConsumedBy': None,
+        'FlowAmount': [100., 100., 50., 50., 10., 20., 20.],
+        'Unit': 'USD',
+    }), full_name='flows', config=config)
+    employment = pd.DataFrame({
+        'SectorProducedBy': ['111110', '221310', '311111', '111110'],
+        'Location': ['06000', '06000', '06000', '48000'],
+        'Class': ['Employment', 'Employment', 'Other', 'Employment'],
+        'FlowAmount': [30., 10., 20., 5.],
+        'Unit': 'p'})
+    if second_unit:
+        # a sector also reported in a second unit
+        employment = pd.concat([employment, employment.iloc[[0]].assign(
+            FlowAmount=1., Unit='USD')], ignore_index=True)
+    other = _FlowBy(employment.assign(FlowType='TECHNOSPHERE_FLOW',
+                                      SectorConsumedBy=None),
+                    full_name='employment', config={'geoscale': 'state'})
+    return fb, other
+
+
+def with_engine(fb, engine):
+    fb = fb.copy()
+    fb.config = {**fb.config, 'attribution_engine': engine}
+    return fb
+
+
+@pytest.mark.parametrize('attribute_on, flows', [
+    (None, [(2, '111110', 10.), (0, '111110', 75.), (0, '221310', 25.),
+            (1, '111110', 30.), (1, '311111', 20.)]),
+    (['PrimarySector', 'Class'],
+     [(0, '111110', 75.), (0, '221310', 25.), (1, '311111', 50.),
+      (2, '111110', 10.)])])
+def test_proportionally_attribute(attribute_on, flows):
+    fb, other = employment_attribution(attribute_on)
+    result = fb.proportionally_attribute(other)
+    assert list(zip(result.group_id, result.SectorProducedBy,
+                    result.FlowAmount)) == flows
+
+
+@pytest.mark.parametrize('attribute_on, second_unit', [
+    (None, False), (None, True), (['PrimarySector', 'Class'], False),
+    (['PrimarySector', 'Class'], True)])
+def test_sparse_attribution_engine_matches_merge(attribute_on, second_unit):
+    pytest.importorskip('scipy')
+    fb, other = employment_attribution(attribute_on, second_unit)
+    expected = with_engine(fb, 'merge').proportionally_attribute(other)
+    result = with_engine(fb, 'sparse').proportionally_attribute(other)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(pd.DataFrame(result),
+                                  pd.DataFrame(expected))
+
+
+def synthetic_employment_attribution(n_groups, seed=0):
+    """
+    State-level flows in n_groups groups, each mapped to up to 12 NAICS 6
+    sectors, and state-level employment by NAICS 6 sector to attribute
+    them with
+    """
+    rng = np.random.default_rng(seed)
+    crosswalk = naics.map_target_sectors_to_less_aggregated_sectors(
+        {'default': 'NAICS_6'}, 2012)
+    sectors = crosswalk['_naics_6'].dropna().unique()
+    states = np.array([f'{i:02d}000' for i in range(1, 57)], dtype=object)
+    sizes = rng.integers(1, 13, n_groups)
+    group_id = np.repeat(np.arange(n_groups), sizes)
+    fb = _FlowBy(pd.DataFrame({
+        'group_id': group_id,
+        'Location': states[rng.integers(0, len(states), n_groups)][group_id],
+        'FlowType': 'TECHNOSPHERE_FLOW',
+        'SectorProducedBy': rng.choice(sectors, len(group_id)),
+        'SectorConsumedBy': None,
+        'FlowAmount': rng.random(len(group_id)) * 1000,
+        'Unit': 'USD',
+    }), full_name='synthetic_flows', config={'geoscale': 'state'})
+    employment = pd.MultiIndex.from_product(
+        [sectors, states], names=['SectorProducedBy', 'Location']
+    ).to_frame(index=False)
+    other = _FlowBy(employment.assign(
+        FlowType='TECHNOSPHERE_FLOW', SectorConsumedBy=None, Unit='p',
+        FlowAmount=rng.integers(0, 5000, len(employment)).astype(float)),
+        full_name='synthetic_employment', config={'geoscale': 'state'})
+    return fb, other
+
+
+@pytest.mark.benchmark
+def test_benchmark_sparse_attribution_engine():
+    pytest.importorskip('scipy')
+    import tracemalloc
+    fb, other = synthetic_employment_attribution(200_000)
+    results, timing, peak = {}, {}, {}
+    for engine in ['merge', 'sparse']:
+        tracemalloc.start()
+        start = time.perf_counter()
+        results[engine] = (with_engine(fb, engine)
+                           .proportionally_attribute(other))
+        timing[engine] = time.perf_counter() - start
+        peak[engine] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    print(f'\nproportionally_attribute of {len(fb):,} rows using state '
+          f'employment by NAICS 6 sector: ' + ', '.join(
+              f'{timing[e]:.2f}s and {peak[e]:.0f} MiB peak with {e}'
+              for e in results))
+    pd.testing.assert_frame_equal(pd.DataFrame(results['sparse']),
+                                  pd.DataFrame(results['merge']))
+
+
+@pytest.mark.parametrize('second_unit, temp_location', [
+    (False, False), (True, False), (True, True)])
+def test_join_other_matches_merge(second_unit, temp_location):
+    fb, other = employment_attribution(second_unit=second_unit)
+    if temp_location:
+        fb = fb.assign(temp_location=fb.Location,
+                       Location=fb.Location.str[:2] + '001')
+    _, _, fb, other = fb.harmonize_geoscale(other)
+    # null keys match null keys, as in pandas merges
+    fb.loc[fb.index[:1], 'PrimarySector'] = None
+    other.loc[other.index[:1], 'PrimarySector'] = None
+    result = fb.join_other(other, ['FlowAmount', 'Unit'])
+    expected = (
+        fb
+        .merge(other[['PrimarySector', 'Location', 'FlowAmount', 'Unit']],
+               how='left',
+               left_on=['PrimarySector', 'temp_location' if temp_location
+                        else 'Location'],
+               right_on=['PrimarySector', 'Location'],
+               suffixes=[None, '_other'])
+        .fillna({'FlowAmount_other': 0})
+        .drop(columns=['Location_other'], errors='ignore')
+    )
+    assert (result.FlowAmount_other == 0).any()
+    pd.testing.assert_frame_equal(pd.DataFrame(result),
+                                  pd.DataFrame(expected))
+    assert result.full_name == fb.full_name
+
+
+def county_fbs():
+    """County-level FBS at NAICS 4 in three states, to be equally attributed"""
+    return FlowBySector(pd.DataFrame({
+        'Flowable': 'Water',
+        'Class': 'Water',
+        'SectorProducedBy': ['1114', '2213', '1114', '3112', '1111', '2213',
+                             '3112', '1114'],
+        'Location': ['48201', '01001', '06037', '48201', '01003', '48453',
+                     '06037', '48453'],
+        'FlowAmount': [10., 20., 30., 40., 50., 60., 70., 80.],
+        'Unit': 'kg',
+        'FlowType': 'ELEMENTARY_FLOW',
+        'SectorSourceName': 'NAICS_2012_Code',
+    }), full_name='sample_county', config={
+        'data_format': 'FBS', 'geoscale': 'county', 'cache': {},
+        'target_naics_year': 2012, 'industry_spec': {'default': 'NAICS_6'},
+        'attribution_method': 'equal'})
+
+
+def row_bytes(fb):
+    """Estimated memory use per row while mapping and attributing fb"""
+    return (fb.memory_usage(deep=True).sum() / len(fb)
+            * chunking.MAPPING_EXPANSION)
+
+
+def test_plan_chunks_keeps_states_together():
+    fbs = county_fbs()
+    # five rows per chunk
+    budget = int(row_bytes(fbs) * 5.5)
+    chunks = chunking.plan_chunks(fbs, 'state', budget)
+    assert [c.tolist() for c in chunks] == [[1, 2, 4, 6], [0, 3, 5, 7]]
+    chunks = chunking.plan_chunks(fbs, 'group_id', budget)
+    assert [c.tolist() for c in chunks] == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert len(chunking.plan_chunks(fbs, 'state', budget * 100)) == 1
+
+
+def test_filter_to_chunk():
+    other = pd.DataFrame({'Location': ['00000', '01000', '01003', '02000'],
+                          'FlowAmount': [1, 2, 3, 4]})
+    assert (chunking.filter_to_chunk(other, {'attribution_chunk': ['01']})
+            .FlowAmount.tolist() == [1, 2, 3])
+    assert len(chunking.filter_to_chunk(
+        other, {'attribution_chunk': ['00', '01']})) == 4
+    assert len(chunking.filter_to_chunk(other, {})) == 4
+
+
+@pytest.mark.parametrize('by', ['state', 'group_id'])
+def test_chunked_attribution_matches_whole(by, caplog):
+    fbs = county_fbs()
+    expected = fbs.attribute_and_aggregate()
+    fbs.config = {**fbs.config, 'attribution_chunks': by,
+                  'attribution_memory_budget':
+                      row_bytes(fbs) * 5.5 / 1024 ** 3}
+    caplog.clear()
+    result = fbs.attribute_and_aggregate()
+
+    assert 'Attributing sample_county in 2 chunks' in caplog.text
+    assert caplog.text.count('FlowAmount after attribution') == 1
+    assert 'attribution_chunk' not in result.config
+    assert result.config['cache'] is fbs.config['cache'] == {}
+    sort_cols = ['Location', 'SectorProducedBy', 'FlowAmount']
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(result.sort_values(sort_cols).reset_index(drop=True)),
+        pd.DataFrame(expected.sort_values(sort_cols).reset_index(drop=True)))
+    # 1114 is split equally between its four NAICS 6 sectors
+    assert (result.query('Location == "06037"')
+            .set_index('SectorProducedBy').FlowAmount
+            [['111411', '111419', '111421', '111422']].tolist()
+            == [7.5] * 4)
+
+    # with no chunks, flows are attributed as a single chunk
+    result = chunking.attribute_in_chunks(fbs, [], [])
+    assert result.FlowAmount.sum() == pytest.approx(
+        expected.FlowAmount.sum())
+
+
+def with_aggregation_engine(fb, engine):
+    fb = fb.copy()
+    fb.config = {**fb.config, 'aggregation_engine': engine}
+    return fb
+
+
+def test_aggregate_flowby():
+    result = sample_fbs().aggregate_flowby()
+    # null Context ('') is a group of its own, and DataReliability is
+    # weighted by FlowAmount
+    assert list(zip(result.Flowable, result.Context.fillna(''),
+                    result.Location, result.FlowAmount)) == [
+        ('Carbon dioxide', 'air', '00000', 5.),
+        ('Methane', 'air', '48000', 6.), ('Methane', '', '48000', 15.),
+        ('Water', 'water', '06000', 3.), ('Water', 'water', '06037', 4.)]
+    np.testing.assert_allclose(result.DataReliability,
+                               [4., 5., 31 / 15, 7 / 3, 0.])
+
+
+@pytest.mark.parametrize('dtype_profile', ['object', 'category', 'string'])
+def test_factorized_aggregation_matches_groupby(dtype_profile):
+    fbs = sample_fbs(dtype_profile)
+    fbs.loc[fbs.index[::7], 'DataReliability'] = np.nan
+    expected = with_aggregation_engine(fbs, 'groupby').aggregate_flowby()
+    result = with_aggregation_engine(fbs, 'factorized').aggregate_flowby()
+    assert result.FlowAmount.tolist() == [5., 6., 15., 3., 4.]
+    pd.testing.assert_frame_equal(pd.DataFrame(result),
+                                  pd.DataFrame(expected))
+
+
+def test_aggregate_parquet_matches_aggregate_flowby(tmp_path):
+    pytest.importorskip('pyarrow', exc_type=ImportError)
+    from flowsa.flowby import aggregate_parquet
+    fbs = sample_fbs()
+    fbs.loc[fbs.index[::7], 'DataReliability'] = np.nan
+    parts = [tmp_path / 'part-0.parquet', tmp_path / 'part-1.parquet']
+    fbs.iloc[:5].to_parquet(parts[0])
+    fbs.iloc[5:].to_parquet(parts[1])
+    expected = fbs.aggregate_flowby()
+    result = aggregate_parquet(parts, fbs.groupby_cols,
+                               ['DataReliability'], batch_rows=2)
+    pd.testing.assert_frame_equal(
+        as_object(result), as_object(expected[result.columns]),
+        check_dtype=False)
+
+
+def test_passthrough_columns():
+    fb = pd.DataFrame({'group_id': [0, 0, 1, 2, 2],
+                       'DataReliability': [1., 1., 2., np.nan, np.nan],
+                       'Description': ['a', 'b', 'c', 'd', 'd'],
+                       'Year': 2015, 'Location': '06000'})
+    assert (_passthrough_columns(fb, {'prune_columns': True})
+            == ['DataReliability', 'Year'])
+    assert _passthrough_columns(fb, {'prune_columns': True,
+                                     'attribute_on': ['Year']}) == [
+        'DataReliability']
+    assert _passthrough_columns(fb, {}) == []
+
+
+def county_fba():
+    """
+    County-level FBA of the NAICS 4 activities of county_fbs(), to be
+    mapped to NAICS 6 and proportionally attributed with state employment
+    """
+    fbs = county_fbs()
+    return FlowByActivity(pd.DataFrame({
+        'Flowable': 'Water',
+        'Class': 'Water',
+        'SourceName': 'sample_county',
+        'ActivityProducedBy': fbs.SectorProducedBy,
+        'Location': fbs.Location,
+        'FlowAmount': fbs.FlowAmount,
+        'Unit': 'kg',
+        'FlowType': 'ELEMENTARY_FLOW',
+        'Year': 2015,
+        'DataReliability': [1., 2., 3., 4., 5., 1., 2., 3.],
+        'Description': ['a', 'b'] * 4,
+    }), full_name='sample_county', config={
+        **fbs.config, 'data_format': 'FBA', 'year': 2015,
+        'activity_schema': 'NAICS_2012_Code',
+        'attribution_method': 'proportional',
+        'attribution_source': 'state_employment'})
+
+
+def state_employment():
+    """State employment in the NAICS 6 sectors of county_fba()"""
+    crosswalk = naics.map_target_sectors_to_less_aggregated_sectors(
+        {'default': 'NAICS_6'}, 2012)
+    sectors = (crosswalk.query('_naics_4 in ["1111", "1114", "2213", "3112"]')
+               ['_naics_6'].dropna().unique())
+    employment = pd.MultiIndex.from_product(
+        [sectors, ['01000', '06000', '48000']],
+        names=['SectorProducedBy', 'Location']).to_frame(index=False)
+    # employment is missing (zero) for some sectors and states
+    return FlowBySector(employment.assign(
+        Class='Employment', FlowType='TECHNOSPHERE_FLOW',
+        SectorConsumedBy=None, Unit='p',
+        FlowAmount=np.arange(len(employment)) % 7 * 10.),
+        full_name='state_employment', config={'geoscale': 'state'})
+
+
+def test_pruned_attribution_matches_unpruned(monkeypatch):
+    fba = county_fba()
+    employment = state_employment()
+
+    attributed_columns = []
+    proportionally_attribute = FlowByActivity.proportionally_attribute
+
+    def recording_proportionally_attribute(fb, other):
+        attributed_columns.append(list(fb.columns))
+        return proportionally_attribute(fb, other)
+    monkeypatch.setattr(FlowByActivity, 'load_prepare_attribution_source',
+                        lambda *args, **kwargs: employment)
+    monkeypatch.setattr(FlowByActivity, 'proportionally_attribute',
+                        recording_proportionally_attribute)
+    expected = fba.attribute_flows_to_sectors()
+    pruned = fba.copy()
+    pruned.config = {**fba.config, 'prune_columns': True}
+    result = pruned.attribute_flows_to_sectors()
+
+    assert {'DataReliability', 'Description'} < set(attributed_columns[0])
+    assert not {'DataReliability', 'Description'} & set(
+        attributed_columns[1])
+    assert len(result) > len(fba)
+    pd.testing.assert_frame_equal(pd.DataFrame(result),
+                                  pd.DataFrame(expected))
+
+
+def test_naics_hierarchy():
+    hierarchy = naics.NAICSHierarchy(['311', '3112', '311221', '31-33',
+                                      '42', None])
+    codes = ['311221', '311221', '3112', '311', '312', None, '31-33']
+    assert (hierarchy.is_descendant(codes, ['3112', '311221', '311221',
+                                            '311', '31', '31', '31'])
+            .tolist() == [True, True, False, True, False, False, True])
+    assert (hierarchy.is_descendant(codes, '311', strict=True).tolist()
+            == [True, True, True, False, False, False, False])
+    assert (hierarchy.ancestors_at_level(codes, 4).tolist()
+            == ['3112', '3112', '3112', None, None, None, '31-3'])
+    assert (hierarchy.leaf_filter(['311', '3112', '311221', '42', '42'])
+            .tolist() == [False, False, True, False, False])
+
+    empty = naics.NAICSHierarchy([None])
+    assert len(empty) == 0
+    assert empty.is_descendant(['311', None], '31').tolist() == [False] * 2
+    assert empty.ancestors_at_level(['311'], 2).tolist() == [None]
+    assert empty.leaf_filter(['311']).tolist() == [False]
+
+
+def test_naics_hierarchy_matches_startswith():
+    rng = np.random.default_rng(0)
+    crosswalk = naics.map_target_sectors_to_less_aggregated_sectors(
+        {'default': 'NAICS_6'}, 2012)
+    codes = pd.unique(crosswalk[[f'_naics_{n}' for n in range(2, 7)]]
+                      .to_numpy().ravel())
+    codes = codes[pd.notna(codes)]
+    sample = rng.choice(codes, 2_000)
+    ancestors = np.array([c[:rng.integers(1, 7)] for c in
+                          rng.choice(codes, 2_000)], dtype=object)
+    hierarchy = naics.NAICSHierarchy(np.concatenate([sample, ancestors]))
+    assert (hierarchy.is_descendant(sample, ancestors).tolist()
+            == [c.startswith(a) for c, a in zip(sample, ancestors)])
+    sectors = pd.Series(rng.choice(codes, 300)).drop_duplicates()
+    assert (naics.NAICSHierarchy(sectors).leaf_filter(sectors).tolist()
+            == [sectors.str.startswith(s).sum() == 1 for s in sectors])
+    assert (hierarchy.ancestors_at_level(sample, 4).tolist()
+            == [c[:4] if len(c) >= 4 else None for c in sample])
+
+
+def mecs_fba():
+    """MECS-like FBA of nested activities, see
+    define_parentincompletechild_descendants()"""
+    return pd.DataFrame({
+        'Flowable': ['Natural Gas'] * 5 + ['Coal'] * 2,
+        'Location': '06000',
+        'ActivityConsumedBy': ['31-33', '311', '3112', '311221', '312',
+                               '311', '31122'],
+        'ActivityProducedBy': None,
+        'FlowAmount': [500., 110., 65., 55., 40., 20., 30.],
+        'group_id': [0, 1, 1, 2, 2, 3, 3],
+        'group_total': 1.,
+    })
+
+
+def test_define_parentincompletechild_descendants():
+    from flowsa.flowbyclean import define_parentincompletechild_descendants
+    defined = define_parentincompletechild_descendants(mecs_fba())
+    # 31-33 is dropped, and detailed flows are subtracted from their
+    # ancestors, to no less than 0
+    assert defined.ActivityConsumedBy.tolist() == [
+        '311', '3112', '311221', '312', '311', '31122']
+    assert defined.FlowAmount.tolist() == [45., 10., 55., 40., 0., 30.]
+    assert defined.descendants.tolist() == [2, 1, 0, 0, 1, 0]
+    assert defined.group_total.tolist() == [55., 55., 95., 95., 30., 30.]
+
+
+def test_drop_parentincompletechild_descendants():
+    from flowsa.flowbyclean import (define_parentincompletechild_descendants,
+                                    drop_parentincompletechild_descendants)
+    mapped = define_parentincompletechild_descendants(mecs_fba()).merge(
+        pd.DataFrame({
+            'ActivityConsumedBy': ['311', '311', '3112', '3112', '311221',
+                                   '312', '31122'],
+            'SectorConsumedBy': ['311111', '311221', '311221', '311230',
+                                 '311221', '312120', '311221']}),
+        how='left')
+    result = drop_parentincompletechild_descendants(mapped)
+    # sectors contained in a more detailed activity of the same Flowable
+    # and Location are dropped
+    assert list(zip(result.Flowable, result.ActivityConsumedBy,
+                    result.SectorConsumedBy)) == [
+        ('Natural Gas', '311', '311111'), ('Natural Gas', '3112', '311230'),
+        ('Natural Gas', '311221', '311221'), ('Natural Gas', '312', '312120'),
+        ('Coal', '311', '311111'), ('Coal', '31122', '311221')]
+    assert 'descendants' not in result
+
+
+def test_estimate_suppressed_qcew():
+    from flowsa.data_source_scripts.BLS_QCEW import estimate_suppressed_qcew
+    fba = FlowByActivity(pd.DataFrame({
+        'FlowName': (['Number of employees, Private'] * 7
+                     + ['Number of employees, Local Government'] * 3),
+        'ActivityProducedBy': ['31-33', '311', '3111', '3112', '312',
+                               '44-45', '441', '31-33', '311', '312'],
+        'FlowAmount': [100., 30., 10., 0., 0., 50., 0., 10., 0., 4.],
+        'Location': '06037', 'Class': 'Employment', 'Unit': 'p',
+        'Year': 2020, 'SourceName': 'BLS_QCEW',
+        'FlowType': 'ELEMENTARY_FLOW',
+    }), full_name='BLS_QCEW', config={'geoscale': 'county'})
+    result = estimate_suppressed_qcew(fba)
+    # suppressed private and government employment is estimated separately
+    # and then summed, e.g. 312 gets 70 private and 4 government employees
+    assert list(zip(result.ActivityProducedBy, result.FlowAmount)) == [
+        ('31-33', 110.), ('311', 36.), ('3111', 10.), ('3112', 20.),
+        ('312', 74.), ('44-45', 50.), ('441', 50.)]
+    assert result.FlowName.unique().tolist() == ['Number of employees']
+
+
+def test_estimate_suppressed_flows():
+    from flowsa.flowbyclean import SECTOR_RANGES, estimate_suppressed_flows
+    flows = pd.DataFrame({
+        'FlowName': 'Employment', 'Location': '00000',
+        'ActivityProducedBy': ['31-33', '311', '3111', '3112', '312', '332',
+                               '3321'],
+        'FlowAmount': [100., 30., 10., 0., 0., 0., 0.]})
+    # 20 unattributed by 311 goes to 3112, the remaining 70 of 31-33 is
+    # split between 312 and 332, and 3321 gets all of 332
+    np.testing.assert_array_equal(
+        estimate_suppressed_flows(flows, 'ActivityProducedBy',
+                                  sector_ranges=SECTOR_RANGES),
+        [100., 30., 10., 20., 35., 35., 35.])
+
+
+def test_estimate_suppressed_flows_verifies_integrity():
+    from flowsa.flowbyclean import estimate_suppressed_flows
+    flows = pd.DataFrame({'FlowName': 'Employment', 'Location': '00000',
+                          'ActivityProducedBy': ['311', '3111', '3111'],
+                          'FlowAmount': [10., 0., 0.]})
+    with pytest.raises(ValueError, match='duplicate sectors'):
+        estimate_suppressed_flows(flows, 'ActivityProducedBy',
+                                  verify_integrity=True)
+
+
+def test_estimate_suppressed_sectors_equal_attribution():
+    from flowsa.flowbyclean import \
+        estimate_suppressed_sectors_equal_attribution
+    fba = FlowByActivity(pd.DataFrame({
+        'Class': 'Land', 'SourceName': 'USDA_CoA_Cropland_NAICS',
+        'FlowName': 'AREA HARVESTED', 'Unit': 'ACRES',
+        'FlowType': 'ELEMENTARY_FLOW', 'Year': 2017,
+        'Location': ['06000'] * 8 + ['08000'] * 4,
+        'ActivityConsumedBy': ['111', '1111', '11111', '11112', '1112',
+                               '1113', '112', '1121',
+                               '111', '1111', '1112', '11211'],
+        'FlowAmount': [100., 40., 10., 0., 0., 0., 50., 0.,
+                       80., 0., 30., 5.],
+    }), full_name='USDA_CoA_Cropland_NAICS',
+        config={'data_format': 'FBA', 'target_naics_year': 2012})
+    result = estimate_suppressed_sectors_equal_attribution(fba)
+    # as estimated by the previous, grouped implementation. The 30 acres of
+    # 1111 not in 11111 go to 11112, the 60 of 111 not in 1111 are split
+    # between 1112 and 1113, and 1:1 child sectors (e.g. 111110) are added
+    assert list(zip(result.Location, result.ActivityConsumedBy,
+                    result.FlowAmount)) == [
+        ('06000', '111', 100.), ('08000', '111', 80.),
+        ('06000', '1111', 40.), ('08000', '1111', 50.),
+        ('06000', '11111', 10.), ('06000', '111110', 10.),
+        ('06000', '11112', 30.), ('06000', '111120', 30.),
+        ('06000', '1112', 30.), ('08000', '1112', 30.),
+        ('06000', '11121', 30.), ('08000', '11121', 30.),
+        ('06000', '1113', 30.), ('06000', '112', 50.),
+        ('06000', '1121', 50.), ('08000', '11211', 5.)]